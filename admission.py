@@ -0,0 +1,192 @@
+"""Admission control for the heavy routes.
+
+Each gunicorn worker has a fixed number of threads. A burst of long
+downloads can occupy every thread and a lot of buffer memory, and then
+``/_health``, pages and transcripts queue behind it. Routes registered
+here (media downloads, batches, job results) are admitted only when:
+
+* the route has a free slot (``ADMISSION_SLOTS``, per route),
+* a heavy slot is free across all registered routes (``ADMISSION_HEAVY_SLOTS``;
+  keep it below gunicorn's ``--threads`` so cheap routes always find a thread),
+* the route's estimated buffer memory fits the worker's
+  ``ADMISSION_MEMORY_BUDGET``.
+
+A request that doesn't fit waits up to ADMISSION_WAIT seconds. At most
+ADMISSION_QUEUE requests wait at once. Otherwise it gets a fast ``503``
+with ``Retry-After``. Unregistered routes are never limited. A slot is
+held until the response body has been sent, not just until the view
+returns, because streaming is where the time and memory go.
+"""
+import os
+import time
+import threading
+
+ADMISSION = os.getenv("ADMISSION", "1").lower() not in ("0", "false", "no")
+# Slots shared by every registered route, per worker
+ADMISSION_HEAVY_SLOTS = int(os.getenv("ADMISSION_HEAVY_SLOTS", "4"))
+# Estimated buffer bytes all admitted requests may hold, per worker; 0 disables
+ADMISSION_MEMORY_BUDGET = int(os.getenv("ADMISSION_MEMORY_BUDGET", str(256 * 1024 ** 2)))
+ADMISSION_QUEUE = int(os.getenv("ADMISSION_QUEUE", "2"))
+ADMISSION_WAIT = float(os.getenv("ADMISSION_WAIT", "1"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+
+
+def _parse_slots(value: str) -> dict:
+    # "download_video=2,batch_download=1"
+    out = {}
+    for part in (value or "").split(","):
+        name, _, n = part.partition("=")
+        if name.strip() and n.strip().isdigit():
+            out[name.strip()] = int(n)
+    return out
+
+
+# Per-route slot overrides, by endpoint name
+ADMISSION_SLOTS = _parse_slots(os.getenv("ADMISSION_SLOTS", ""))
+
+
+class Ticket:
+    __slots__ = ("endpoint", "cost", "_released")
+
+    def __init__(self, endpoint: str, cost: int):
+        self.endpoint = endpoint
+        self.cost = cost
+        self._released = False
+
+
+class AdmissionController:
+    def __init__(self, heavy_slots: int, memory_budget: int, queue: int, wait: float):
+        self.heavy_slots = heavy_slots
+        self.memory_budget = memory_budget
+        self.queue = queue
+        self.wait = wait
+        self._routes = {}  # endpoint -> (slots, cost)
+        self._cond = threading.Condition()
+        self._in_use = {}
+        self._heavy = 0
+        self._reserved = 0
+        self._waiting = 0
+        self._stats = {"admitted": 0, "waited": 0, "rejected": 0}
+        self._rejected = {}
+
+    def register(self, endpoint: str, slots: int, cost: int = 0):
+        """Limit ``endpoint`` to ``slots`` concurrent requests (0 = only the
+        heavy cap applies), each reserving ``cost`` bytes of the budget.
+        ADMISSION_SLOTS overrides ``slots``."""
+        self._routes[endpoint] = (ADMISSION_SLOTS.get(endpoint, slots), cost)
+
+    def _fits(self, endpoint: str, slots: int, cost: int) -> bool:
+        if slots and self._in_use.get(endpoint, 0) >= slots:
+            return False
+        if self.heavy_slots and self._heavy >= self.heavy_slots:
+            return False
+        # A request larger than the whole budget still runs, alone
+        return not self.memory_budget or not self._reserved or self._reserved + cost <= self.memory_budget
+
+    def acquire(self, endpoint: str):
+        """A Ticket, None when ``endpoint`` isn't limited, or False when the
+        request should be turned away."""
+        policy = self._routes.get(endpoint)
+        if policy is None:
+            return None
+        slots, cost = policy
+        with self._cond:
+            if not self._fits(endpoint, slots, cost):
+                if self._waiting >= self.queue or self.wait <= 0:
+                    return self._reject(endpoint)
+                self._waiting += 1
+                self._stats["waited"] += 1
+                deadline = time.monotonic() + self.wait
+                try:
+                    while not self._fits(endpoint, slots, cost):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return self._reject(endpoint)
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use[endpoint] = self._in_use.get(endpoint, 0) + 1
+            self._heavy += 1
+            self._reserved += cost
+            self._stats["admitted"] += 1
+        return Ticket(endpoint, cost)
+
+    def _reject(self, endpoint: str):
+        self._stats["rejected"] += 1
+        self._rejected[endpoint] = self._rejected.get(endpoint, 0) + 1
+        return False
+
+    def release(self, ticket: Ticket):
+        with self._cond:
+            if ticket._released:
+                return
+            ticket._released = True
+            self._in_use[ticket.endpoint] -= 1
+            self._heavy -= 1
+            self._reserved -= ticket.cost
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(self._stats, in_use=dict(self._in_use), heavy_in_use=self._heavy,
+                        heavy_slots=self.heavy_slots, reserved_bytes=self._reserved,
+                        memory_budget=self.memory_budget, waiting=self._waiting,
+                        rejected_by_route=dict(self._rejected),
+                        routes={k: {"slots": s, "cost": c} for k, (s, c) in self._routes.items()})
+
+
+class ReleaseOnClose:
+    """WSGI wrapper releasing the request's ticket (``environ["deetalk.admission"]``)
+    once the server closes the response body."""
+
+    def __init__(self, wsgi_app, controller: AdmissionController):
+        self.wsgi_app = wsgi_app
+        self.controller = controller
+
+    def __call__(self, environ, start_response):
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self._release(environ)
+            raise
+        if not environ.get("deetalk.admission"):
+            return body
+        if hasattr(body, "filelike"):
+            # Server file wrapper (sendfile): wrapping it would lose the
+            # zero-copy path, so hook its close instead
+            close = getattr(body, "close", None)
+
+            def _close():
+                try:
+                    if close:
+                        close()
+                finally:
+                    self._release(environ)
+            body.close = _close
+            return body
+        return _Closing(body, lambda: self._release(environ))
+
+    def _release(self, environ):
+        ticket = environ.pop("deetalk.admission", None)
+        if ticket:
+            self.controller.release(ticket)
+
+
+class _Closing:
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+
+    def __iter__(self):
+        return iter(self._body)
+
+    def close(self):
+        try:
+            close = getattr(self._body, "close", None)
+            if close:
+                close()
+        finally:
+            self._on_close()
+
+
+controller = AdmissionController(ADMISSION_HEAVY_SLOTS, ADMISSION_MEMORY_BUDGET, ADMISSION_QUEUE, ADMISSION_WAIT)
@@ -2,4 +2,8 @@
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))  # add project root to sys.path
 
+import time
+_started = time.perf_counter()
 from app import app  # Flask instance defined in app.py
+import lazy_imports
+lazy_imports.record("app (total)", time.perf_counter() - _started)
@@ -2,19 +2,54 @@ import os
 import sys
 import io
 import glob
+import hashlib
+import json
+import threading
 import shutil
 import tempfile
 import mimetypes
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+import lazy_imports
+_eager_started = time.perf_counter()
 from flask import (
-    Flask, request, send_file, jsonify, render_template, after_this_request
+    Flask, Response, request, send_file, jsonify, render_template, url_for, redirect
 )
-from urllib.parse import urlparse, parse_qs
-import requests
-import yt_dlp
-from pytubefix import YouTube
-from youtube_transcript_api import YouTubeTranscriptApi
+lazy_imports.record("flask", time.perf_counter() - _eager_started)
+_eager_started = time.perf_counter()
+
+from streaming import (
+    safe_title, media_response, ranged_stream_response, iter_url_range, probe_length,
+    iter_media, media_etag, pytube_filesize, pytube_etag, stream_response, iter_url,
+    STREAM_CHUNK_SIZE, PARALLEL_CONNECTIONS, PARALLEL_SEGMENT_SIZE
+)
+from media_cache import media_cache
+import media_urls
+import metadata_cache
+import transcripts
+import thumbnails
+from transcript_index import transcript_index
+import singleflight
+from jobs import jobs, QueueFull
+from zipstream import ZipStream
+from delivery import send_path, DELIVERY_DIR
+from extractors import extractors, Resolved
+import upstream
+from upstream import CircuitOpen
+from scratch import scratch, ScratchFull, SCRATCH_DEFAULT_RESERVE
+import ffmpeg_pool
+from ffmpeg_pool import FfmpegBusy
+import metrics
+import tracing
+import admission
+
+lazy_imports.record("app (local modules)", time.perf_counter() - _eager_started)
+
+# Heavy extractors load on first use of a route that needs them (or during warmup)
+yt_dlp = lazy_imports.lazy_module("yt_dlp")
+pytubefix = lazy_imports.lazy_module("pytubefix")
 
 # --------------------------
 # Flask app + paths
@@ -37,21 +72,55 @@ logging.basicConfig(
 )
 app.logger.setLevel(LOG_LEVEL)
 
+# Admission slots are held until the body is sent (see admission.py)
+app.wsgi_app = admission.ReleaseOnClose(app.wsgi_app, admission.controller)
+# Per-route counts, latency and bytes for /_metrics
+app.wsgi_app = metrics.MetricsMiddleware(app.wsgi_app)
+
+@app.before_request
+def _route_label():
+    # Label by URL rule rather than path so ids don't mint new series
+    request.environ["deetalk.route"] = request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.before_request
+def _admit():
+    if not admission.ADMISSION:
+        return None
+    ticket = admission.controller.acquire(request.endpoint)
+    if ticket is False:
+        app.logger.info("admission: rejected %s (busy)", request.endpoint)
+        resp = jsonify({"error": "Server is busy, please retry shortly"})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = str(admission.ADMISSION_RETRY_AFTER)
+        return resp
+    if ticket:
+        request.environ["deetalk.admission"] = ticket
+    return None
+
 @app.before_request
 def _log_request():
-    app.logger.info("➡️ %s %s", request.method, request.path)
+    app.logger.info("➡️ %s %s [%s]", request.method, request.path, request.environ.get("deetalk.request_id"))
 
 @app.after_request
 def _log_response(resp):
     app.logger.info("⬅️ %s %s %s", request.method, request.path, resp.status_code)
     return resp
 
+@app.after_request
+def _timing_headers(resp):
+    # Stages done before the headers; the transfer is in the trace log
+    trace = tracing.current()
+    if trace is not None:
+        resp.headers["X-Request-ID"] = trace.request_id
+        resp.headers["Server-Timing"] = trace.server_timing()
+    return resp
+
 # Optional: catch-all error logger (keeps JSON consistent for API-ish paths)
 @app.errorhandler(Exception)
 def _unhandled(e):
     app.logger.exception("Unhandled error")
     # If it looks like an API route (starts with /download_ or /get_), return JSON
-    if request.path.startswith(("/download_", "/get_")):
+    if request.path.startswith(("/download_", "/get_", "/search_", "/jobs", "/batch")):
         return jsonify({"error": str(e)}), 500
     # otherwise let Flask show HTML 500
     return ("Internal Server Error", 500)
@@ -60,7 +129,8 @@ def _unhandled(e):
 # Helpers
 # --------------------------
 def _has_ffmpeg() -> bool:
-    return shutil.which("ffmpeg") is not None or shutil.which("ffmpeg.exe") is not None
+    # Probed once per process, not on every format pick
+    return ffmpeg_pool.available()
 
 def _final_download_path(ydl, info_dict: dict, temp_dir: str) -> str:
     for d in info_dict.get("requested_downloads", []):
@@ -69,6 +139,193 @@ def _final_download_path(ydl, info_dict: dict, temp_dir: str) -> str:
             return p
     return ydl.prepare_filename(info_dict)
 
+def _media_ref(url: str, platform: str):
+    """Canonical MediaRef for ``url`` if it's a ``platform`` link, else None.
+    Garbage is rejected here, before any upstream round trip."""
+    ref = media_urls.parse(url)
+    return ref if ref and ref.platform == platform else None
+
+def _get_youtube(ref):
+    def _construct():
+        with metrics.stage("youtube_init"):
+            return pytubefix.YouTube(ref.url)
+    return metadata_cache.get_youtube(ref.id, _construct)
+
+def _pick_stream(yt, kind: str):
+    with metrics.stage("stream_select"):
+        streams = metadata_cache.youtube_streams(yt)
+        if kind == "audio":
+            return streams.filter(only_audio=True).order_by('abr').desc().first()
+        return streams.get_highest_resolution()
+
+# kind -> (extension, mimetype, media-cache format tag)
+_YT_KINDS = {
+    "video": (".mp4", "video/mp4", "video:highest"),
+    "audio": (".m4a", "audio/mp4", "audio:best"),
+}
+
+# The same single-file formats, as yt-dlp selectors (no merge, plain HTTP)
+_YT_YTDLP_FORMATS = {
+    "video": "best[ext=mp4][vcodec!=none][acodec!=none][protocol^=http]",
+    "audio": "bestaudio[ext=m4a][protocol^=http]",
+}
+
+def _resolve_pytubefix(ref, kind: str):
+    yt = _get_youtube(ref)
+    stream, title = upstream.call(upstream.YOUTUBE, lambda: (_pick_stream(yt, kind), yt.title))
+    if not stream:
+        return None
+    length = pytube_filesize(stream)
+    return Resolved(stream.url, title, length, pytube_etag(stream, length), None, None)
+
+def _resolve_ytdlp_youtube(ref, kind: str):
+    ydl_opts = {"format": _YT_YTDLP_FORMATS[kind], "noplaylist": True, "quiet": True, "logger": app.logger}
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = _ytdlp_extract(ydl, ref.url, download=False)
+        if info.get("requested_formats") or not info.get("url"):
+            return None
+        headers = dict(info.get("http_headers") or {})
+        cookie = ydl.cookiejar.get_cookie_header(info["url"])
+        if cookie:
+            headers["Cookie"] = cookie
+    length = info.get("filesize") or probe_length(info["url"], headers)
+    # format_id is the itag, so the ETag matches pytubefix's for the same file
+    return Resolved(info["url"], info.get("title") or ref.id, length,
+                    media_etag(info["url"], info.get("format_id"), length), headers, None)
+
+# Errors about the video itself: another backend won't do better
+_UNAVAILABLE_ERRORS = {
+    "AccountTerminated", "MembersOnly", "VideoPrivate", "VideoRegionBlocked", "VideoBlockedByCopyright",
+    "VideoRemovedByUploader", "VideoRemovedByYouTubeForViolatingTOS", "RecordingUnavailable",
+    "LiveStreamError", "LiveStreamOffline", "LiveStreamEnded",
+}
+_UNAVAILABLE_MESSAGES = ("Private video", "members-only", "has been removed", "not available in your country",
+                         "account associated with this video has been terminated")
+
+def _item_unavailable(exc) -> bool:
+    return type(exc).__name__ in _UNAVAILABLE_ERRORS or any(m in str(exc) for m in _UNAVAILABLE_MESSAGES)
+
+extractors.register("pytubefix", ("youtube",), _resolve_pytubefix, _item_unavailable)
+extractors.register("yt-dlp", ("youtube",), _resolve_ytdlp_youtube, _item_unavailable)
+
+def _resolve_youtube(ref, kind: str):
+    """A Resolved stream for ``kind`` from the fastest healthy backend, or
+    None when the video has no such stream."""
+    with metrics.stage("extract"):
+        return extractors.resolve(ref, kind)
+
+def _youtube_media_response(resolved, kind: str, name: str, label: str, cache_key: str):
+    _, mimetype, _ = _YT_KINDS[kind]
+    return media_response(resolved.url, mimetype, name, length=resolved.filesize, etag=resolved.etag,
+                          headers=resolved.headers, range_param=True, label=label,
+                          on_full=_shared_body(cache_key, name, mimetype))
+
+def _youtube_fetch(url: str, kind: str, dest: str, progress=None):
+    """Fetch a YouTube video/audio into ``dest`` (or find it in the media
+    cache). Returns (path, download_name, mimetype); path is the shared
+    cache entry on a hit, so callers must not delete it."""
+    ext, mimetype, fmt = _YT_KINDS[kind]
+    ref = _media_ref(url, "youtube")
+    if not ref:
+        raise ValueError("Not a valid YouTube URL")
+    cache_key = media_cache.key(ref.platform, ref.id, fmt)
+    cached = media_cache.get(cache_key)
+    if cached:
+        return cached.path, cached.download_name, cached.mimetype
+    resolved = _resolve_youtube(ref, kind)
+    if not resolved:
+        raise ValueError(f"No {kind} stream found for the provided URL")
+    name = f"{safe_title(resolved.title)}{ext}"
+    total = resolved.filesize
+    # Counted here rather than via pytubefix's on_progress: the YouTube object
+    # is shared through the metadata cache, so per-caller callbacks can't live on it.
+    chunks = _shared_body(cache_key, name, mimetype)(
+        iter_media(resolved.url, total, resolved.headers, range_param=True), total, resolved.etag)
+    done = 0
+    with open(dest, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+            done += len(chunk)
+            if progress:
+                progress(done, total)
+    return dest, name, mimetype
+
+def _unavailable(message: str, retry_after: int):
+    resp = jsonify({"error": message})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(retry_after)
+    return resp
+
+def _upstream_down(e):
+    # A circuit breaker is open: fail fast rather than wait on a dead upstream
+    app.logger.info("upstream down: %s", e)
+    return _unavailable(f"Upstream temporarily unavailable: {e}", e.retry_after)
+
+def _scratch_full(e):
+    app.logger.warning("scratch: %s", e)
+    return _unavailable("Server is short on disk space, please retry shortly", e.retry_after)
+
+def _ffmpeg_busy(e):
+    app.logger.warning("ffmpeg: %s", e)
+    return _unavailable("Server is busy encoding, please retry shortly", e.retry_after)
+
+def _send_cached(entry):
+    # Range/If-Range are answered against the cached copy
+    return send_path(entry.path, entry.download_name, entry.mimetype, etag=entry.etag)
+
+# ?mode= on media routes: proxy the bytes (default), 302 to the signed
+# upstream URL, or return that URL as JSON
+_MODES = ("proxy", "redirect", "resolve")
+
+def _request_mode():
+    mode = (request.args.get("mode") or "proxy").lower()
+    return mode if mode in _MODES else None
+
+def _direct_response(entry, mode: str):
+    """Answer mode=redirect/resolve from a metadata_cache.get_direct entry.
+    Returns None when the caller should proxy the bytes after all."""
+    if not entry:
+        if mode == "resolve":
+            return jsonify({"error": "No single direct URL for this item (it needs a server-side "
+                                     "merge or cookies); download it without 'mode'"}), 409
+        return None
+    now = time.time()
+    expires_at = entry.get("expires_at")
+    if mode == "resolve":
+        entry["expires_in"] = int(expires_at - now) if expires_at else None
+        return jsonify(entry)
+    resp = redirect(entry["url"], 302)
+    # Clients may reuse the redirect only while we would hand out the same URL
+    max_age = int(min(expires_at - metadata_cache.SIGNED_URL_MARGIN - now, metadata_cache.META_CACHE_TTL)) if expires_at else 0
+    resp.headers["Cache-Control"] = f"private, max-age={max_age}" if max_age > 0 else "no-store"
+    resp.headers["Referrer-Policy"] = "no-referrer"
+    return resp
+
+def _youtube_direct(ref, kind: str):
+    resolved = _resolve_youtube(ref, kind)
+    # Cookie-bound URLs only work with our cookie jar, so they stay proxied
+    if not resolved or "Cookie" in (resolved.headers or {}):
+        return None
+    ext, mimetype, _ = _YT_KINDS[kind]
+    entry = {"url": resolved.url, "filename": f"{safe_title(resolved.title)}{ext}", "mimetype": mimetype,
+             "filesize": resolved.filesize}
+    if resolved.headers:
+        entry["http_headers"] = resolved.headers
+    return entry
+
+def _shared_body(key: str, download_name: str, mimetype: str):
+    # Full-body YouTube downloads: one upstream fetch per key across all
+    # threads/workers, fanned out to every waiting client and then cached.
+    def _wrap(chunks, length, etag):
+        if not singleflight.COALESCE_DOWNLOADS:
+            return media_cache.tee(key, chunks, length, download_name, mimetype, etag)
+        return singleflight.shared_stream(
+            key, chunks, length,
+            on_complete=lambda path: media_cache.put_file(key, path, download_name, mimetype, etag),
+            lookup=lambda: getattr(media_cache.get(key), "path", None),
+        )
+    return _wrap
+
 # --------------------------
 # Debug / health
 # --------------------------
@@ -87,6 +344,121 @@ def _debug_templates():
         "templates": listing
     })
 
+@app.route("/_debug/startup")
+def _debug_startup():
+    return jsonify(lazy_imports.report())
+
+@app.route("/_debug/slow")
+def _debug_slow():
+    return jsonify({"threshold_seconds": tracing.SLOW_REQUEST_SECONDS, "requests": tracing.slow_requests()})
+
+@app.route("/_debug/admission")
+def _debug_admission():
+    return jsonify(admission.controller.stats())
+
+@app.route("/_debug/extractors")
+def _debug_extractors():
+    return jsonify(extractors.stats())
+
+@app.route("/_debug/scratch")
+def _debug_scratch():
+    return jsonify(scratch.stats())
+
+@app.route("/_debug/ffmpeg")
+def _debug_ffmpeg():
+    return jsonify(ffmpeg_pool.pool.stats())
+
+@app.route("/_debug/upstreams")
+def _debug_upstreams():
+    return jsonify(upstream.stats())
+
+@app.route("/_debug/cache")
+def _debug_cache():
+    return jsonify({
+        "media": media_cache.stats(),
+        "metadata": metadata_cache.stats(),
+        "singleflight": singleflight.stats(),
+        "jobs": jobs.stats(),
+        "thumbnails": thumbnails.stats(),
+        "transcripts": transcripts.stats(),
+        "transcript_index": transcript_index.stats(),
+    })
+
+@app.route("/_metrics")
+def _metrics():
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+@metrics.registry.source
+def _cache_metrics():
+    caches = {
+        "media": media_cache.counters(),
+        "thumbnails": thumbnails.thumb_cache.counters(),
+        "youtube_metadata": metadata_cache.youtube_cache.stats(),
+        "ytdlp_metadata": metadata_cache.ytdlp_cache.stats(),
+        "direct_urls": metadata_cache.direct_cache.stats(),
+        "transcripts": transcripts.stats(),
+    }
+    out = []
+    for cache, counts in caches.items():
+        for field in ("hits", "misses", "evictions"):
+            out.append(("counter", f"deetalk_cache_{field}_total", {"cache": cache}, counts.get(field, 0)))
+    job_stats = jobs.stats()
+    out.append(("gauge", "deetalk_jobs_queued", None, job_stats["queued"]))
+    out.append(("gauge", "deetalk_jobs_running", None, job_stats["running"]))
+    counts = scratch.counters()
+    out.append(("counter", "deetalk_scratch_rejected_total", None, counts["rejected"]))
+    for reason in ("orphan", "expired"):
+        out.append(("counter", "deetalk_scratch_reaped_total", {"reason": reason}, counts[f"reaped_{reason}"]))
+    adm = admission.controller.stats()
+    for route, n in adm["in_use"].items():
+        out.append(("gauge", "deetalk_admission_in_use", {"route": route}, n))
+    for route, n in adm["rejected_by_route"].items():
+        out.append(("counter", "deetalk_admission_rejected_total", {"route": route}, n))
+    out.append(("gauge", "deetalk_admission_reserved_bytes", None, adm["reserved_bytes"]))
+    out.append(("gauge", "deetalk_admission_waiting", None, adm["waiting"]))
+    out.append(("gauge", "deetalk_singleflight_in_flight", None, singleflight.stats()["in_flight"]))
+    for name, b in extractors.stats()["backends"].items():
+        for field in ("successes", "failures", "unavailable", "hedges", "wins"):
+            out.append(("counter", f"deetalk_extractor_{field}_total", {"backend": name}, b[field]))
+        out.append(("gauge", "deetalk_extractor_demoted", {"backend": name}, int(b["demoted"])))
+    for host, b in upstream.stats().items():
+        out.append(("gauge", "deetalk_upstream_breaker_open", {"host": host}, int(b["state"] != "closed")))
+    ff = ffmpeg_pool.pool.stats()
+    out.append(("gauge", "deetalk_ffmpeg_in_use", None, ff["in_use"]))
+    out.append(("gauge", "deetalk_ffmpeg_waiting", None, ff["waiting"]))
+    for kind, counts in ff["by_kind"].items():
+        for field in ("completed", "failed", "rejected"):
+            out.append(("counter", f"deetalk_ffmpeg_{field}_total", {"kind": kind}, counts.get(field, 0)))
+    return out
+
+# Scratch and cache areas every worker shares, measured once per scrape
+_DISK_AREAS = {
+    "media_cache": media_cache.root,
+    "thumbnails": thumbnails.THUMB_CACHE_DIR,
+    "spool": singleflight.SPOOL_DIR,
+    "jobs": jobs.root,
+    "delivery": DELIVERY_DIR,
+    "scratch": scratch.root,
+    "tmp": tempfile.gettempdir(),
+}
+
+@metrics.registry.shared
+def _disk_metrics():
+    out = []
+    for area, path in _DISK_AREAS.items():
+        if area != "tmp":
+            out.append(("deetalk_disk_usage_bytes", {"area": area}, metrics.dir_bytes(path)))
+        try:
+            out.append(("deetalk_disk_free_bytes", {"area": area}, shutil.disk_usage(path).free))
+        except OSError:
+            pass
+    usage = scratch.usage()
+    out.append(("deetalk_scratch_committed_bytes", None, usage["committed_bytes"]))
+    out.append(("deetalk_scratch_dirs", None, usage["dirs"]))
+    if scratch.quota:
+        out.append(("deetalk_scratch_quota_bytes", None, scratch.quota))
+    return out
+
 # Silence favicon 404 noise
 @app.route("/favicon.ico")
 def favicon():
@@ -119,22 +491,83 @@ def contact():
 # --------------------------
 # YouTube tools
 # --------------------------
+def _transcoded_audio(ref, fmt: str, kbps: int):
+    """The audio track re-encoded as ``fmt``, streamed as FFmpeg produces
+    it. Reads the cached m4a when there is one, otherwise the upstream
+    stream; the output is cached per format and bitrate."""
+    _, _, mimetype, ext, _, _ = ffmpeg_pool.AUDIO_FORMATS[fmt]
+    cache_key = media_cache.key(ref.platform, ref.id, f"audio:{fmt}:{kbps}k")
+    cached = media_cache.get(cache_key)
+    if cached:
+        return _send_cached(cached)
+    source = media_cache.get(media_cache.key(ref.platform, ref.id, "audio:best"))
+    if source:
+        name = f"{os.path.splitext(source.download_name)[0]}{ext}"
+        etag, chunks = source.etag, source.path
+    else:
+        resolved = _resolve_youtube(ref, "audio")
+        if not resolved:
+            return jsonify({"error": "No audio stream found for the provided URL"}), 404
+        upstream.check(resolved.url)
+        name = f"{safe_title(resolved.title)}{ext}"
+        etag = resolved.etag
+        chunks = None
+    if request.method == "HEAD":
+        # Headers only: no slot, no encode nobody would read
+        return stream_response(iter(()), mimetype, name, label="download_audio")
+    if chunks is None:
+        chunks = iter_media(resolved.url, resolved.filesize, resolved.headers, range_param=True)
+    encoded = ffmpeg_pool.transcode(chunks, fmt, kbps)
+    # Length unknown until the encoder finishes, so no Content-Length or Range
+    # The body may never be iterated; closing it still frees the slot
+    return stream_response(media_cache.tee(cache_key, encoded, None, name, mimetype, etag=f"{etag}-{fmt}{kbps}"),
+                           mimetype, name, label="download_audio", on_close=encoded.close)
+
 @app.route('/download_audio', methods=['GET'])
 def download_audio():
     video_url = request.args.get('url')
     if not video_url:
         return jsonify({"error": "Missing 'url' parameter"}), 400
+    ref = _media_ref(video_url, "youtube")
+    if not ref:
+        return jsonify({"error": "Not a valid YouTube URL"}), 400
+    mode = _request_mode()
+    if not mode:
+        return jsonify({"error": "Invalid 'mode' (use proxy, redirect or resolve)"}), 400
+    fmt = (request.args.get('format') or 'm4a').lower()
+    if fmt != "m4a":
+        if fmt not in ffmpeg_pool.AUDIO_FORMATS:
+            return jsonify({"error": "Invalid 'format' (use m4a, mp3 or opus)"}), 400
+        kbps = ffmpeg_pool.parse_bitrate(fmt, request.args.get('bitrate'))
+        if kbps is None:
+            low, high = ffmpeg_pool.AUDIO_FORMATS[fmt][5]
+            return jsonify({"error": f"Invalid 'bitrate' for {fmt} (use {low}-{high} kbps)"}), 400
+        if mode != "proxy":
+            return jsonify({"error": f"mode={mode} is only available for format=m4a"}), 400
+        if fmt not in ffmpeg_pool.audio_formats():
+            return jsonify({"error": f"{fmt} encoding is not available on this server"}), 501
     try:
-        yt = YouTube(video_url)
-        audio_stream = yt.streams.filter(only_audio=True).order_by('abr').desc().first()
-        if not audio_stream:
+        if fmt != "m4a":
+            return _transcoded_audio(ref, fmt, kbps)
+        if mode != "proxy":
+            entry = metadata_cache.get_direct(f"{ref.key}:audio", lambda: _youtube_direct(ref, "audio"))
+            resp = _direct_response(entry, mode)
+            if resp is not None:
+                return resp
+        cache_key = media_cache.key(ref.platform, ref.id, "audio:best")
+        cached = media_cache.get(cache_key)
+        if cached:
+            return _send_cached(cached)
+        resolved = _resolve_youtube(ref, "audio")
+        if not resolved:
             return jsonify({"error": "No audio stream found for the provided URL"}), 404
-        buf = io.BytesIO()
-        audio_stream.stream_to_buffer(buf)
-        buf.seek(0)
-        title = "".join(c for c in yt.title if c.isalnum() or c in (' ', '_')).rstrip().replace(' ', '_')
-        # m4a container (no ffmpeg on Vercel, so do NOT say mp3)
-        return send_file(buf, as_attachment=True, mimetype="audio/mp4", download_name=f"{title}.m4a")
+        name = f"{safe_title(resolved.title)}.m4a"
+        # m4a container as YouTube serves it; mp3/opus go through _transcoded_audio
+        return _youtube_media_response(resolved, "audio", name, "download_audio", cache_key)
+    except CircuitOpen as e:
+        return _upstream_down(e)
+    except FfmpegBusy as e:
+        return _ffmpeg_busy(e)
     except Exception as e:
         app.logger.exception("download_audio failed")
         return jsonify({"error": str(e)}), 500
@@ -144,63 +577,284 @@ def download_video():
     video_url = request.args.get('url')
     if not video_url:
         return jsonify({"error": "Missing 'url' parameter"}), 400
+    ref = _media_ref(video_url, "youtube")
+    if not ref:
+        return jsonify({"error": "Not a valid YouTube URL"}), 400
+    mode = _request_mode()
+    if not mode:
+        return jsonify({"error": "Invalid 'mode' (use proxy, redirect or resolve)"}), 400
     try:
-        yt = YouTube(video_url)
-        stream = yt.streams.get_highest_resolution()
-        if not stream:
+        if mode != "proxy":
+            entry = metadata_cache.get_direct(f"{ref.key}:video", lambda: _youtube_direct(ref, "video"))
+            resp = _direct_response(entry, mode)
+            if resp is not None:
+                return resp
+        cache_key = media_cache.key(ref.platform, ref.id, "video:highest")
+        cached = media_cache.get(cache_key)
+        if cached:
+            return _send_cached(cached)
+        resolved = _resolve_youtube(ref, "video")
+        if not resolved:
             return jsonify({"error": "No video stream found for the provided URL"}), 404
-        buf = io.BytesIO()
-        stream.stream_to_buffer(buf)
-        buf.seek(0)
-        title = "".join(c for c in yt.title if c.isalnum() or c in (' ', '_')).rstrip().replace(' ', '_')
-        return send_file(buf, as_attachment=True, mimetype="video/mp4", download_name=f"{title}.mp4")
+        name = f"{safe_title(resolved.title)}.mp4"
+        return _youtube_media_response(resolved, "video", name, "download_video", cache_key)
+    except CircuitOpen as e:
+        return _upstream_down(e)
     except Exception as e:
         app.logger.exception("download_video failed")
         return jsonify({"error": str(e)}), 500
 
+def _thumbnail(ref, variant: str):
+    # Derived from the id; the full resolve is only the last resort
+    return thumbnails.get(ref.id, variant, fallback_url=lambda: _get_youtube(ref).thumbnail_url)
+
+def _send_thumbnail(thumb, download_name: str):
+    if thumb.path:
+        resp = send_path(thumb.path, download_name, thumb.mimetype, etag=thumb.etag)
+    else:
+        resp = send_file(io.BytesIO(thumb.data), as_attachment=True, mimetype=thumb.mimetype,
+                         download_name=download_name, etag=thumb.etag)
+        resp.make_conditional(request)
+    resp.headers["Cache-Control"] = f"public, max-age={thumbnails.THUMB_MAX_AGE}"
+    resp.headers["X-Thumbnail-Variant"] = thumb.variant
+    return resp
+
 @app.route('/download_thumbnail', methods=['GET'])
 def download_thumbnail():
     video_url = request.args.get('url')
     if not video_url:
         return jsonify({"error": "Missing 'url' parameter"}), 400
+    ref = _media_ref(video_url, "youtube")
+    if not ref:
+        return jsonify({"error": "Not a valid YouTube URL"}), 400
+    variant = request.args.get('size', 'maxres')
+    if variant not in thumbnails.VARIANTS:
+        return jsonify({"error": f"'size' must be one of {', '.join(thumbnails.VARIANTS)}"}), 400
     try:
-        yt = YouTube(video_url)
-        if not yt.thumbnail_url:
+        thumb = _thumbnail(ref, variant)
+        if not thumb:
             return jsonify({"error": "No thumbnail found for the provided URL"}), 404
-        image_data = requests.get(yt.thumbnail_url, timeout=15).content
-        filename = "".join(c for c in yt.title if c.isalnum() or c in (' ', '_')).rstrip().replace(' ', '_')
-        return send_file(io.BytesIO(image_data), as_attachment=True, mimetype="image/jpeg",
-                         download_name=f"{filename}_thumbnail.jpg")
+        return _send_thumbnail(thumb, f"{ref.id}_thumbnail.jpg")
+    except CircuitOpen as e:
+        return _upstream_down(e)
     except Exception as e:
         app.logger.exception("download_thumbnail failed")
         return jsonify({"error": str(e)}), 500
 
+TRANSCRIPT_BATCH_MAX = int(os.getenv("TRANSCRIPT_BATCH_MAX", "5000"))
+
+def _transcript_languages(value) -> tuple:
+    # "de,en" or ["de", "en"]: preference order, first available wins
+    if isinstance(value, str):
+        value = value.split(",")
+    langs = tuple(v.strip() for v in (value or ()) if isinstance(v, str) and v.strip())
+    return langs or ("en",)
+
+def _fetch_transcript(video_id: str, languages=("en",)) -> str:
+    return transcripts.text(transcripts.get(video_id, languages))
+
 @app.route('/get_transcript', methods=['GET'])
 def get_transcript():
     video_url = request.args.get('url')
     if not video_url:
         return jsonify({"error": "Missing 'url' parameter"}), 400
+    ref = _media_ref(video_url, "youtube")
+    if not ref:
+        return jsonify({"error": "Could not extract video ID from the provided URL."}), 400
     try:
-        video_id = parse_qs(urlparse(video_url).query).get('v', [None])[0]
-        if not video_id:
-            path = urlparse(video_url).path.strip('/')
-            video_id = path if path and len(path) >= 8 else None
-        if not video_id:
-            return jsonify({"error": "Could not extract video ID from the provided URL."}), 400
-        transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
-        text = " ".join(entry.get('text', '') for entry in transcript_list if entry.get('text'))
-        return jsonify({"transcript": text})
+        entry = transcripts.get(ref.id, _transcript_languages(request.args.get('lang')))
+        body = {"transcript": transcripts.text(entry), "language_code": entry["language_code"]}
+        if request.args.get('timestamps', '').lower() in ("1", "true", "yes"):
+            body["snippets"] = entry["snippets"]
+        return jsonify(body)
+    except CircuitOpen as e:
+        return _upstream_down(e)
     except Exception as e:
+        if transcripts.no_transcript(e):
+            return jsonify({"error": str(e)}), 404
         app.logger.exception("get_transcript failed")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/search_transcripts', methods=['GET'])
+def search_transcripts():
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"error": "Missing 'q' parameter"}), 400
+    if not transcript_index.enabled:
+        return jsonify({"error": "Transcript search is disabled"}), 503
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), 500))
+    except ValueError:
+        return jsonify({"error": "'limit' must be an integer"}), 400
+    video_id = None
+    if request.args.get('url'):
+        ref = _media_ref(request.args['url'], "youtube")
+        if not ref:
+            return jsonify({"error": "Not a valid YouTube URL"}), 400
+        video_id = ref.id
+    try:
+        videos = transcript_index.search(query, limit=limit, video_id=video_id,
+                                         language=request.args.get('lang'))
+    except Exception as e:
+        app.logger.exception("search_transcripts failed")
+        return jsonify({"error": str(e)}), 500
+    for video in videos:
+        video["url"] = media_urls.MediaRef("youtube", video["video_id"]).url
+    return jsonify({"query": query, "videos": videos})
+
+def _transcript_lines(items: list, languages: tuple, timestamps: bool):
+    refs = [media_urls.parse(item) if isinstance(item, str) else None for item in items]
+    ids = []
+    for idx, (item, ref) in enumerate(zip(items, refs)):
+        if ref and ref.platform == "youtube":
+            ids.append((idx, ref.id))
+        else:
+            yield _ndjson({"index": idx, "input": item, "status": "error", "error": "Not a valid YouTube URL or id"})
+    for pos, entry, error in transcripts.fetch_many([vid for _, vid in ids], languages):
+        idx, video_id = ids[pos]
+        line = {"index": idx, "input": items[idx], "video_id": video_id}
+        if error is not None:
+            # The library's messages are paragraphs; the class name says it all
+            reason = type(error).__name__ if transcripts.no_transcript(error) else str(error)
+            line.update(status="error", error=reason or type(error).__name__)
+        else:
+            line.update(status="ok", language_code=entry["language_code"], transcript=transcripts.text(entry))
+            if timestamps:
+                line["snippets"] = entry["snippets"]
+        yield _ndjson(line)
+
+def _ndjson(obj) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+@app.route('/batch/transcripts', methods=['POST'])
+def batch_transcripts():
+    payload = request.get_json(silent=True) or request.form
+    items = payload.get('urls') or payload.get('ids') or []
+    if isinstance(items, str):
+        items = items.split()
+    if not items:
+        return jsonify({"error": "Provide 'urls' (YouTube URLs or video ids)"}), 400
+    if len(items) > TRANSCRIPT_BATCH_MAX:
+        return jsonify({"error": f"At most {TRANSCRIPT_BATCH_MAX} items per batch"}), 400
+    timestamps = str(payload.get('timestamps', '')).lower() in ("1", "true", "yes")
+    return stream_response(_transcript_lines(list(items), _transcript_languages(payload.get('lang')), timestamps),
+                           "application/x-ndjson", None, label="batch_transcripts")
+
 # --------------------------
 # Instagram / TikTok
 # --------------------------
-def _dl_with_ytdlp(target_url: str) -> str:
-    temp_dir = tempfile.mkdtemp()
+def _ytdlp_format() -> str:
+    return ("bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best") if _has_ffmpeg() else "best[ext=mp4]/best"
+
+def _file_etag(name: str, size) -> str:
+    # Stable across requests even though every download lands in a new temp dir
+    return hashlib.sha1(f"{name}:{size}".encode("utf-8")).hexdigest()[:20]
+
+def _ytdlp_extract(ydl, target_url: str, download: bool) -> dict:
+    # Resolve once per TTL (bounded by signed-URL expiry), then let this ydl
+    # re-run format selection/download on a private copy of the info dict.
+    # Only the resolve goes through upstream.call: retrying a download from
+    # scratch would redo a partial multi-GB fetch, so that's left to yt-dlp's
+    # own (fragment) retries.
+    key = _ytdlp_cache_key(target_url, "info") or target_url
+    info = metadata_cache.get_ytdlp_info(
+        key, lambda: upstream.call(target_url, lambda: ydl.extract_info(target_url, download=False)))
+    return ydl.process_ie_result(info, download=download)
+
+def _ytdlp_direct(target_url: str):
+    """Resolve the format _dl_with_ytdlp would pick without downloading it.
+    Returns (info, headers, download_name) when it's a single progressive
+    HTTP file we can range-fetch, otherwise None (merges, HLS/DASH)."""
+    ydl_opts = {
+        "outtmpl": "%(title)s [%(id)s].%(ext)s",
+        "format": _ytdlp_format(),
+        "noplaylist": True,
+        "restrictfilenames": True,
+        "quiet": True,
+        "logger": app.logger,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = _ytdlp_extract(ydl, target_url, download=False)
+        if info.get("requested_formats") or info.get("protocol") not in ("http", "https") or not info.get("url"):
+            return None
+        headers = dict(info.get("http_headers") or {})
+        cookie = ydl.cookiejar.get_cookie_header(info["url"])
+        if cookie:
+            headers["Cookie"] = cookie
+        return info, headers, os.path.basename(ydl.prepare_filename(info))
+
+def _ytdlp_cache_key(target_url: str, fmt: str):
+    ref = media_urls.parse(target_url)
+    if ref:
+        return media_cache.key(ref.platform, ref.id, fmt)
+    # Other sites (playlist entries): the first extractor that claims the URL
+    # and can read an id from it without a network round trip.
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.ie_key() == "Generic" or not ie.suitable(target_url):
+            continue
+        video_id = ie.get_temp_id(target_url)
+        return media_cache.key(ie.ie_key().lower(), video_id, fmt) if video_id else None
+    return None
+
+def _dl_with_ytdlp(target_url: str, progress_hooks=None):
+    """Download ``target_url`` (or reuse the cached copy). Returns
+    (path, download_name, temp_dir); the caller removes temp_dir when it's
+    not None (it's None when path is a shared cache entry)."""
+    fmt = _ytdlp_format()
+    cache_key = _ytdlp_cache_key(target_url, fmt) if media_cache.enabled else None
+    if not cache_key:
+        return _ytdlp_download(target_url, fmt, None, progress_hooks)
+
+    def _lookup():
+        cached = media_cache.get(cache_key)
+        return (cached.path, cached.download_name, None) if cached else None
+
+    cached = _lookup()
+    if cached:
+        return cached
+    if not singleflight.COALESCE_DOWNLOADS:
+        return _ytdlp_download(target_url, fmt, cache_key, progress_hooks)
+    # Concurrent requests for the same item wait for one download, then share the cached file
+    return singleflight.run_once(
+        cache_key, lambda: _ytdlp_download(target_url, fmt, cache_key, progress_hooks), _lookup)
+
+def _postprocessor_timer(held: list):
+    """yt-dlp postprocessor hook timing each step; the FFmpeg merge shows up
+    as the ``ffmpeg_merge`` stage. A merge first waits for an ffmpeg_pool
+    slot, kept in ``held`` so the caller can release it if yt-dlp fails
+    mid-merge."""
+    started = {}
+
+    def _hook(d):
+        name = d.get("postprocessor") or "postprocess"
+        if d.get("status") == "started":
+            if name == "Merger":
+                held.append(ffmpeg_pool.pool.acquire("merge", wait=ffmpeg_pool.FFMPEG_MERGE_WAIT))
+            started[name] = time.perf_counter()
+        elif d.get("status") == "finished" and name in started:
+            t0 = started.pop(name)
+            stage = "ffmpeg_merge" if name == "Merger" else f"postprocess_{name.lower()}"
+            metrics.record_stage(stage, t0, time.perf_counter() - t0)
+            if name == "Merger":
+                while held:
+                    held.pop().release()
+    return _hook
+
+def _ytdlp_scratch_estimate(target_url: str, fmt: str) -> int:
+    """Scratch bytes downloading ``target_url`` as ``fmt`` will take: the
+    selected formats, twice over for a merge (the parts plus the output)."""
+    with yt_dlp.YoutubeDL({"format": fmt, "noplaylist": True, "quiet": True, "logger": app.logger}) as ydl:
+        info = _ytdlp_extract(ydl, target_url, download=False)
+    formats = info.get("requested_formats") or [info]
+    sizes = [f.get("filesize") or f.get("filesize_approx") for f in formats]
+    if not all(sizes):
+        return SCRATCH_DEFAULT_RESERVE
+    return sum(sizes) * 2 if len(formats) > 1 else sum(sizes)
+
+def _ytdlp_download(target_url: str, fmt: str, cache_key, progress_hooks=None):
+    temp_dir = scratch.allocate(_ytdlp_scratch_estimate(target_url, fmt))
+    merge_slots = []
     try:
-        fmt = ("bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best") if _has_ffmpeg() else "best[ext=mp4]/best"
         ydl_opts = {
             "outtmpl": os.path.join(temp_dir, "%(title)s [%(id)s].%(ext)s"),
             "format": fmt,
@@ -209,35 +863,99 @@ def _dl_with_ytdlp(target_url: str) -> str:
             "quiet": True,
             "logger": app.logger,
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(target_url, download=True)
+        if progress_hooks:
+            ydl_opts["progress_hooks"] = progress_hooks
+        ydl_opts["postprocessor_hooks"] = [_postprocessor_timer(merge_slots)]
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl, metrics.stage("ytdlp_download"):
+            info = _ytdlp_extract(ydl, target_url, download=True)
             final_path = _final_download_path(ydl, info, temp_dir)
         if not os.path.exists(final_path):
             candidates = glob.glob(os.path.join(temp_dir, "*"))
             if not candidates:
                 raise FileNotFoundError("Download completed but file not found.")
             final_path = candidates[0]
-
-        @after_this_request
-        def _cleanup(resp):
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            return resp
-
-        return final_path
+        name = os.path.basename(final_path)
+        if cache_key:
+            guessed_mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            cached_path = media_cache.put_file(cache_key, final_path, name, guessed_mime,
+                                               etag=_file_etag(name, os.path.getsize(final_path)))
+            if cached_path:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                return cached_path, name, None
+        return final_path, name, temp_dir
     except Exception:
         shutil.rmtree(temp_dir, ignore_errors=True)
         raise
+    finally:
+        for slot in merge_slots:
+            slot.release(ok=False)
+
+def _ytdlp_direct_entry(target_url: str):
+    direct = _ytdlp_direct(target_url)
+    # Cookie-bound URLs only work with our cookie jar, so they stay proxied
+    if not direct or "Cookie" in direct[1]:
+        return None
+    info, headers, name = direct
+    return {"url": info["url"], "filename": name,
+            "mimetype": mimetypes.guess_type(name)[0] or "application/octet-stream",
+            "filesize": info.get("filesize"), "http_headers": headers}
+
+def _serve_ytdlp(target_url: str, label: str, mode: str = "proxy"):
+    if mode != "proxy":
+        key = _ytdlp_cache_key(target_url, "direct:" + _ytdlp_format()) or f"url:{target_url}"
+        resp = _direct_response(metadata_cache.get_direct(key, lambda: _ytdlp_direct_entry(target_url)), mode)
+        if resp is not None:
+            return resp
+    # Keyed even with the media cache off: the key also drives coalescing
+    cache_key = _ytdlp_cache_key(target_url, _ytdlp_format())
+    cached = media_cache.get(cache_key) if cache_key else None
+    if cached:
+        return _send_cached(cached)
+    # Single progressive file: pipe upstream bytes straight into the response
+    # (full body or the requested Range) with no temp-dir round trip.
+    direct = _ytdlp_direct(target_url)
+    if direct:
+        info, headers, name = direct
+        upstream.check(info["url"])
+        length = info.get("filesize") or probe_length(info["url"], headers)
+        if length:
+            guessed_mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            etag = _file_etag(name, length)
+
+            def _open(rng):
+                if rng is None:
+                    chunks = iter_url(info["url"], headers)
+                    if cache_key:
+                        return _shared_body(cache_key, name, guessed_mime)(chunks, length, etag)
+                    return chunks
+                return iter_url_range(info["url"], rng[0], rng[1], headers=headers)
+            return ranged_stream_response(_open, guessed_mime, name, length=length, etag=etag, label=label)
+    # Merges (ffmpeg) and HLS/DASH still need yt-dlp to build the file on disk
+    final_path, name, temp_dir = _dl_with_ytdlp(target_url)
+    guessed_mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    # Range/If-Range are answered against the local copy; temp_dir is removed
+    # once delivery is done (or parked for the proxy in offload mode)
+    return send_path(final_path, name, guessed_mime, etag=_file_etag(name, os.path.getsize(final_path)),
+                     cleanup_dir=temp_dir)
 
 @app.route('/download_insta_video', methods=['GET'])
 def download_insta_video():
     insta_url = request.args.get('url')
     if not insta_url:
         return jsonify({"error": "Missing 'url' parameter"}), 400
+    if not _media_ref(insta_url, "instagram"):
+        return jsonify({"error": "Not a valid Instagram URL"}), 400
+    mode = _request_mode()
+    if not mode:
+        return jsonify({"error": "Invalid 'mode' (use proxy, redirect or resolve)"}), 400
     try:
-        final_path = _dl_with_ytdlp(insta_url)
-        guessed_mime = mimetypes.guess_type(final_path)[0] or "application/octet-stream"
-        return send_file(final_path, as_attachment=True,
-                         download_name=os.path.basename(final_path), mimetype=guessed_mime)
+        return _serve_ytdlp(insta_url, "download_insta_video", mode)
+    except CircuitOpen as e:
+        return _upstream_down(e)
+    except ScratchFull as e:
+        return _scratch_full(e)
+    except FfmpegBusy as e:
+        return _ffmpeg_busy(e)
     except Exception as e:
         app.logger.exception("download_insta_video failed")
         return jsonify({"error": f"Failed to download Instagram video: {e}"}), 500
@@ -247,14 +965,320 @@ def download_tiktok_video():
     tiktok_url = request.args.get('url')
     if not tiktok_url:
         return jsonify({"error": "Missing 'url' parameter"}), 400
+    if not _media_ref(tiktok_url, "tiktok"):
+        return jsonify({"error": "Not a valid TikTok URL"}), 400
+    mode = _request_mode()
+    if not mode:
+        return jsonify({"error": "Invalid 'mode' (use proxy, redirect or resolve)"}), 400
     try:
-        final_path = _dl_with_ytdlp(tiktok_url)
-        guessed_mime = mimetypes.guess_type(final_path)[0] or "application/octet-stream"
-        return send_file(final_path, as_attachment=True,
-                         download_name=os.path.basename(final_path), mimetype=guessed_mime)
+        return _serve_ytdlp(tiktok_url, "download_tiktok_video", mode)
+    except CircuitOpen as e:
+        return _upstream_down(e)
+    except ScratchFull as e:
+        return _scratch_full(e)
+    except FfmpegBusy as e:
+        return _ffmpeg_busy(e)
     except Exception as e:
         app.logger.exception("download_tiktok_video failed")
         return jsonify({"error": f"Failed to download TikTok video: {e}"}), 500
 
+# --------------------------
+# Background jobs
+# --------------------------
+def _job_youtube_media(job, url: str, kind: str) -> dict:
+    filename = "result" + _YT_KINDS[kind][0]
+    path, name, mimetype = _youtube_fetch(url, kind, job.path(filename), progress=job.progress)
+    if path != job.path(filename):
+        job.adopt(path, filename)
+    return {"filename": filename, "download_name": name, "mimetype": mimetype}
+
+def _job_thumbnail(job, url: str, kind: str) -> dict:
+    ref = _media_ref(url, "youtube")
+    thumb = _thumbnail(ref, "maxres")
+    if not thumb:
+        raise ValueError("No thumbnail found for the provided URL")
+    if thumb.path:
+        job.adopt(thumb.path, "result.jpg")
+    else:
+        with open(job.path("result.jpg"), "wb") as f:
+            f.write(thumb.data)
+    return {"filename": "result.jpg", "download_name": f"{ref.id}_thumbnail.jpg", "mimetype": thumb.mimetype}
+
+def _job_transcript(job, url: str, kind: str) -> dict:
+    video_id = _media_ref(url, "youtube").id
+    with open(job.path("result.json"), "w", encoding="utf-8") as f:
+        json.dump({"transcript": _fetch_transcript(video_id)}, f)
+    return {"filename": "result.json", "download_name": f"{video_id}_transcript.json",
+            "mimetype": "application/json"}
+
+def _job_ytdlp(job, url: str, kind: str) -> dict:
+    files = {}
+
+    def _hook(d):
+        # Merged formats download video and audio separately; report the sum
+        files[d.get("filename")] = (d.get("downloaded_bytes") or 0,
+                                    d.get("total_bytes") or d.get("total_bytes_estimate") or 0)
+        total = sum(t for _, t in files.values())
+        job.progress(sum(b for b, _ in files.values()), total or None)
+
+    path, name, temp_dir = _dl_with_ytdlp(url, progress_hooks=[_hook])
+    try:
+        filename = "result" + os.path.splitext(name)[1]
+        job.adopt(path, filename, move=temp_dir is not None)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return {"filename": filename, "download_name": name,
+            "mimetype": mimetypes.guess_type(name)[0] or "application/octet-stream"}
+
+_JOB_RUNNERS = {
+    "video": _job_youtube_media,
+    "audio": _job_youtube_media,
+    "thumbnail": _job_thumbnail,
+    "transcript": _job_transcript,
+    "insta": _job_ytdlp,
+    "tiktok": _job_ytdlp,
+}
+
+# Platform each job kind accepts URLs for
+_JOB_PLATFORMS = {"insta": "instagram", "tiktok": "tiktok"}
+
+def _job_view(state: dict) -> dict:
+    view = {k: v for k, v in state.items() if k != "filename"}
+    view["status_url"] = url_for("job_status", job_id=state["id"])
+    view["result_url"] = url_for("job_result", job_id=state["id"])
+    return view
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    payload = request.get_json(silent=True) or request.form
+    url = payload.get('url')
+    kind = payload.get('kind', 'video')
+    if not url:
+        return jsonify({"error": "Missing 'url' parameter"}), 400
+    runner = _JOB_RUNNERS.get(kind)
+    if not runner:
+        return jsonify({"error": f"Unknown kind '{kind}'", "kinds": sorted(_JOB_RUNNERS)}), 400
+    platform = _JOB_PLATFORMS.get(kind, "youtube")
+    if not _media_ref(url, platform):
+        return jsonify({"error": f"Unsupported URL for kind '{kind}'"}), 400
+    try:
+        state = jobs.submit(kind, url, lambda job: runner(job, url, kind))
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "30"}
+    view = _job_view(state)
+    return jsonify(view), 202, {"Location": view["status_url"]}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    state = jobs.get(job_id)
+    if not state:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(_job_view(state))
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    path, state = jobs.result_path(job_id)
+    if not state:
+        return jsonify({"error": "Unknown job"}), 404
+    if not path:
+        return jsonify(_job_view(state)), 409
+    return send_path(path, state["download_name"], state["mimetype"], etag=f"{job_id}-{state.get('bytes_total')}",
+                     as_attachment=state["kind"] != "transcript")
+
+# --------------------------
+# Batch / playlist ZIP
+# --------------------------
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", "4"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "200"))
+
+def _expand_playlist(playlist_url: str, limit: int) -> list:
+    ydl_opts = {
+        "extract_flat": "in_playlist",
+        "playlistend": limit,
+        "quiet": True,
+        "logger": app.logger,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(playlist_url, download=False)
+    entries = info.get("entries") or [info]
+    urls = [e.get("url") or e.get("webpage_url") for e in entries if e]
+    return [u for u in urls if u][:limit]
+
+def _batch_item(ref, kind: str, work_dir: str) -> dict:
+    """Download one batch entry; the returned file handle pins the bytes
+    even if a cache entry is evicted before the ZIP writer gets to it."""
+    item_dir = tempfile.mkdtemp(dir=work_dir)
+    if ref.platform == "youtube" and kind in _YT_KINDS:
+        path, name, _ = _youtube_fetch(ref.url, kind, os.path.join(item_dir, "item" + _YT_KINDS[kind][0]))
+    else:
+        path, name, temp_dir = _dl_with_ytdlp(ref.url)
+        if temp_dir:
+            shutil.move(path, os.path.join(item_dir, "item"))
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            path = os.path.join(item_dir, "item")
+    f = open(path, "rb")
+    return {"name": name, "file": f, "size": os.fstat(f.fileno()).st_size, "dir": item_dir}
+
+def _release_item(item):
+    item["file"].close()
+    shutil.rmtree(item["dir"], ignore_errors=True)
+
+def _batch_zip(urls: list, kind: str, parallel: int, work_dir: str):
+    pool = ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="batch")
+    pending = {}
+    todo = []
+    manifest = [None] * len(urls)
+    for idx, url in enumerate(urls):
+        # Only supported platforms reach yt-dlp; its generic extractor would fetch any host
+        ref = media_urls.parse(url)
+        if ref:
+            todo.append((idx, url, ref))
+        else:
+            manifest[idx] = {"url": url, "status": "error", "error": "Unsupported or invalid URL"}
+    archive = ZipStream()
+    try:
+        # Only `parallel` items are ever downloaded-but-unwritten, which bounds scratch disk
+        while todo or pending:
+            while todo and len(pending) < parallel:
+                idx, url, ref = todo.pop(0)
+                pending[pool.submit(_batch_item, ref, kind, work_dir)] = (idx, url)
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                idx, url = pending.pop(fut)
+                try:
+                    item = fut.result()
+                except Exception as e:
+                    app.logger.warning("batch item %s failed: %s", url, e)
+                    manifest[idx] = {"url": url, "status": "error", "error": str(e)}
+                    continue
+                try:
+                    yield from archive.add_file(item["name"], item["file"], item["size"])
+                finally:
+                    _release_item(item)
+                manifest[idx] = {"url": url, "status": "ok", "file": item["name"], "bytes": item["size"]}
+        yield from archive.add_bytes("manifest.json", json.dumps({"items": manifest}, indent=2).encode("utf-8"))
+        yield from archive.close()
+    finally:
+        # Client may have gone away mid-archive: drop queued work, and reap
+        # whatever in-flight items still finish once the pool drains.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+        def _reap():
+            for fut in list(pending):
+                try:
+                    _release_item(fut.result())
+                except Exception:
+                    pass
+            pool.shutdown(wait=True)
+            shutil.rmtree(work_dir, ignore_errors=True)
+        threading.Thread(target=_reap, name="batch-reap", daemon=True).start()
+
+@app.route('/batch', methods=['POST'])
+def batch_download():
+    payload = request.get_json(silent=True) or request.form
+    urls = payload.get('urls') or []
+    if isinstance(urls, str):
+        urls = urls.split()
+    playlist = payload.get('playlist')
+    kind = payload.get('kind', 'video')
+    try:
+        parallel = max(1, min(int(payload.get('parallel', BATCH_PARALLELISM)), BATCH_PARALLELISM))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'parallel' must be an integer"}), 400
+    if kind not in ("video", "audio"):
+        return jsonify({"error": "'kind' must be 'video' or 'audio'"}), 400
+    if playlist:
+        playlist = media_urls.playlist(playlist) if isinstance(playlist, str) else None
+        if not playlist:
+            return jsonify({"error": "'playlist' must be a YouTube playlist or channel URL"}), 400
+    try:
+        if playlist:
+            urls = list(urls) + _expand_playlist(playlist, BATCH_MAX_ITEMS)
+        urls = [u.strip() for u in urls if isinstance(u, str) and u.strip()]
+        if not urls:
+            return jsonify({"error": "Provide 'urls' and/or a 'playlist' URL"}), 400
+        if len(urls) > BATCH_MAX_ITEMS:
+            return jsonify({"error": f"At most {BATCH_MAX_ITEMS} items per batch"}), 400
+        # yt-dlp items reserve their own scratch; this dir holds at most `parallel` finished items
+        work_dir = scratch.allocate(0, prefix="batch-")
+        return stream_response(_batch_zip(urls, kind, parallel, work_dir), "application/zip", "batch.zip",
+                               label="batch")
+    except ScratchFull as e:
+        return _scratch_full(e)
+    except Exception as e:
+        app.logger.exception("batch_download failed")
+        return jsonify({"error": str(e)}), 500
+
+THUMB_BATCH_MAX = int(os.getenv("THUMB_BATCH_MAX", "1000"))
+
+def _thumbnail_zip(items: list, variant: str):
+    refs = [media_urls.parse(item) if isinstance(item, str) else None for item in items]
+    manifest = [None] * len(items)
+    ids = []
+    for idx, (item, ref) in enumerate(zip(items, refs)):
+        if ref and ref.platform == "youtube":
+            ids.append((idx, ref.id))
+        else:
+            manifest[idx] = {"url": item, "status": "error", "error": "Not a valid YouTube URL or id"}
+    archive = ZipStream()
+    for pos, thumb, error in thumbnails.get_many([vid for _, vid in ids], variant):
+        idx, video_id = ids[pos]
+        if thumb is None:
+            manifest[idx] = {"url": items[idx], "status": "error", "error": str(error) if error else "No thumbnail found"}
+            continue
+        name = f"{video_id}_{thumb.variant}.jpg"
+        if thumb.path:
+            with open(thumb.path, "rb") as f:
+                yield from archive.add_file(name, f, os.fstat(f.fileno()).st_size)
+        else:
+            yield from archive.add_bytes(name, thumb.data)
+        manifest[idx] = {"url": items[idx], "status": "ok", "file": name, "variant": thumb.variant}
+    yield from archive.add_bytes("manifest.json", json.dumps({"items": manifest}, indent=2).encode("utf-8"))
+    yield from archive.close()
+
+@app.route('/batch/thumbnails', methods=['POST'])
+def batch_thumbnails():
+    payload = request.get_json(silent=True) or request.form
+    items = payload.get('urls') or []
+    if isinstance(items, str):
+        items = items.split()
+    variant = payload.get('size', 'maxres')
+    if not items:
+        return jsonify({"error": "Provide 'urls' (YouTube URLs or video ids)"}), 400
+    if len(items) > THUMB_BATCH_MAX:
+        return jsonify({"error": f"At most {THUMB_BATCH_MAX} items per batch"}), 400
+    if variant not in thumbnails.VARIANTS:
+        return jsonify({"error": f"'size' must be one of {', '.join(thumbnails.VARIANTS)}"}), 400
+    return stream_response(_thumbnail_zip(list(items), variant), "application/zip", "thumbnails.zip",
+                           label="batch_thumbnails")
+
+# Heavy routes and the buffer memory each one may hold: a YouTube download
+# buffers up to PARALLEL_CONNECTIONS segments, piped IG/TikTok bodies a chunk
+# or two, batches their ZIP/NDJSON stream. Everything else (pages, health,
+# single transcripts and thumbnails) is never limited.
+_STREAM_COST = PARALLEL_CONNECTIONS * PARALLEL_SEGMENT_SIZE + STREAM_CHUNK_SIZE
+admission.controller.register("download_video", slots=4, cost=_STREAM_COST)
+admission.controller.register("download_audio", slots=4, cost=_STREAM_COST)
+admission.controller.register("download_insta_video", slots=2, cost=2 * STREAM_CHUNK_SIZE)
+admission.controller.register("download_tiktok_video", slots=2, cost=2 * STREAM_CHUNK_SIZE)
+admission.controller.register("batch_download", slots=1, cost=BATCH_PARALLELISM * _STREAM_COST)
+admission.controller.register("batch_thumbnails", slots=1, cost=2 * STREAM_CHUNK_SIZE)
+admission.controller.register("batch_transcripts", slots=1, cost=STREAM_CHUNK_SIZE)
+admission.controller.register("job_result", slots=2)
+
+# Preload the lazy extractors in the background on long-lived workers.
+# "auto" warms up under gunicorn but not on serverless, where a cold start
+# should only pay for the route it serves.
+WARMUP = os.getenv("WARMUP", "auto").lower()
+
+@lazy_imports.on_warmup
+def _warm_pools():
+    from streaming import http_session
+    http_session()
+
+if WARMUP in ("1", "true", "yes") or (WARMUP == "auto" and "gunicorn" in sys.modules and not os.getenv("VERCEL")):
+    lazy_imports.warmup()
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,541 @@
+"""asyncio serving mode for the download routes (aiohttp).
+
+Under gthread every transfer holds an OS thread until the client has read
+the last byte, so `-w 2 --threads 8` caps the service at 16 downloads, and
+slow clients hold those threads for minutes. This app serves the same
+download routes from an event loop:
+
+* upstream bytes are read with aiohttp's client and written to the client
+  with backpressure, so one worker holds thousands of slow transfers for a
+  few socket buffers each;
+* extraction (pytubefix, yt-dlp, and yt-dlp downloads that need an FFmpeg
+  merge) runs on a bounded thread pool (ASYNC_EXTRACT_WORKERS) through the
+  same helpers as ``app``, so caches, canonical URLs and yt-dlp download
+  coalescing are shared. When more than ASYNC_EXTRACT_QUEUE calls are
+  pending, requests get a ``503``;
+* upstream opens go through ``upstream.call_async``: the same retries and
+  per-host circuit breakers as the WSGI app;
+* cached and merged files go out with ``loop.sendfile`` (Range included).
+
+Routes: ``/download_video``, ``/download_audio``, ``/download_insta_video``,
+``/download_tiktok_video`` (with ``mode``), plus ``/_health`` and
+``/_metrics``. Everything else stays on the WSGI app. Route the download
+paths here at the proxy, or run both side by side::
+
+    gunicorn async_app:create_app -k aiohttp.GunicornWebWorker -w 2 -b 0.0.0.0:8001
+    python async_app.py --port 8001
+
+YouTube bodies are fetched in sequential STREAM_CHUNK_SIZE windows rather
+than parallel segments. Buffering several segments per transfer would cost
+megabytes per slow client, and a slow client is the bottleneck anyway.
+
+Proxied YouTube and progressive IG/TikTok bodies are not coalesced through
+the spool (that would put blocking file tails on the loop): concurrent
+misses each fetch upstream, and the first complete body fills the media
+cache for everyone after.
+"""
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+import argparse
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector, ClientError
+from werkzeug.http import parse_range_header, parse_if_range_header, parse_etags
+
+import app as wsgi
+import metrics
+import upstream
+import metadata_cache
+from media_cache import media_cache
+from scratch import ScratchFull
+from ffmpeg_pool import FfmpegBusy
+from upstream import CircuitOpen
+from streaming import (
+    safe_title, attachment_headers, probe_length,
+    STREAM_CHUNK_SIZE, UPSTREAM_TIMEOUT, SEGMENT_RETRIES
+)
+
+log = logging.getLogger("async_app")
+
+ASYNC_EXTRACT_WORKERS = int(os.getenv("ASYNC_EXTRACT_WORKERS", "16"))
+# Extraction calls allowed to wait for a pool thread before requests get 503
+ASYNC_EXTRACT_QUEUE = int(os.getenv("ASYNC_EXTRACT_QUEUE", "256"))
+# Total upstream connections per worker (0 = unlimited)
+ASYNC_UPSTREAM_CONNECTIONS = int(os.getenv("ASYNC_UPSTREAM_CONNECTIONS", "1000"))
+READ_SIZE = 64 * 1024
+
+_executor = ThreadPoolExecutor(max_workers=ASYNC_EXTRACT_WORKERS, thread_name_prefix="extract")
+_pending = 0
+
+
+class Busy(Exception):
+    pass
+
+
+async def offload(fn, *args):
+    """Run blocking ``fn(*args)`` on the extraction pool."""
+    global _pending
+    if _pending >= ASYNC_EXTRACT_WORKERS + ASYNC_EXTRACT_QUEUE:
+        raise Busy()
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    finally:
+        _pending -= 1
+
+
+def _error(status: int, message: str, **headers) -> web.Response:
+    return web.json_response({"error": message}, status=status, headers=headers or None)
+
+
+def _requested_range(request: web.Request, length, etag=None):
+    """Same rules as ``streaming.requested_range``: ``(start, end)``, None for
+    the whole body, or False when unsatisfiable."""
+    if not length or "Range" not in request.headers:
+        return None
+    if_range = parse_if_range_header(request.headers.get("If-Range"))
+    if if_range.date or (if_range.etag and if_range.etag != (etag or "").strip('"')):
+        return None
+    parsed = parse_range_header(request.headers.get("Range"))
+    if parsed is None or len(parsed.ranges) != 1:
+        return None
+    bounds = parsed.range_for_length(length)
+    if bounds is None:
+        return False
+    return bounds[0], bounds[1] - 1
+
+
+async def _iter_upstream(session: ClientSession, url: str, start: int, end: int, headers=None,
+                         range_param: bool = False):
+    """Yield bytes ``start..end`` of ``url`` in STREAM_CHUNK_SIZE windows,
+    resuming from the first missing byte when a window fails."""
+    pos, failures = start, 0
+    while pos <= end:
+        stop = min(pos + STREAM_CHUNK_SIZE, end + 1) - 1
+        if range_param:
+            target = f"{url}{'&' if '?' in url else '?'}range={pos}-{stop}"
+            hdrs = headers
+        else:
+            target, hdrs = url, {**(headers or {}), "Range": f"bytes={pos}-{stop}"}
+        async def _open():
+            r = await session.get(target, headers=hdrs)
+            try:
+                r.raise_for_status()
+                if not range_param and pos and r.status != 206:
+                    raise ClientError(f"upstream ignored range {pos}-{stop}")
+            except Exception:
+                r.release()
+                raise
+            return r
+        try:
+            async with await upstream.call_async(url, _open) as r:
+                async for chunk in r.content.iter_chunked(READ_SIZE):
+                    chunk = chunk[:stop - pos + 1]
+                    pos += len(chunk)
+                    yield chunk
+                    if pos > stop:
+                        break
+        except (ClientError, asyncio.TimeoutError):
+            failures += 1
+            if failures > SEGMENT_RETRIES:
+                raise
+            log.warning("upstream window %d-%d failed; resuming (attempt %d)", pos, stop, failures)
+            await asyncio.sleep(0.2 * failures)
+            continue
+        if pos <= stop:
+            raise ClientError(f"upstream ended early at byte {pos}")
+
+
+async def _proxy(request: web.Request, url: str, length, name: str, mimetype: str, etag: str,
+                 headers=None, range_param: bool = False, cache_key=None) -> web.StreamResponse:
+    rng = _requested_range(request, length, etag)
+    if rng is False:
+        return web.Response(status=416, headers={"Content-Range": f"bytes */{length}", "Accept-Ranges": "bytes"})
+    resp = web.StreamResponse(status=206 if rng else 200)
+    resp.content_type = mimetype
+    resp.headers.update(attachment_headers(name))
+    resp.headers["X-Accel-Buffering"] = "no"
+    if etag:
+        resp.headers["ETag"] = f'"{etag.strip(chr(34))}"'
+    if length:
+        resp.headers["Accept-Ranges"] = "bytes"
+        start, end = rng or (0, length - 1)
+        resp.content_length = end - start + 1
+        if rng:
+            resp.headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    else:
+        start, end = 0, None
+    # Fail before the headers go out when the host's breaker is open
+    upstream.check(url)
+    await resp.prepare(request)
+    if request.method == "HEAD":
+        await resp.write_eof()
+        return resp
+
+    # Full bodies are also written to the media cache, like the WSGI path
+    tee = None
+    if cache_key and not rng and length and media_cache.enabled:
+        tee = _CacheWriter(cache_key, length, name, mimetype, etag)
+        await tee.open()
+    session = request.app["upstream"]
+    complete = False
+    try:
+        chunks = (_iter_upstream(session, url, start, end, headers, range_param) if end is not None
+                  else _iter_unsized(session, url, headers))
+        async for chunk in chunks:
+            await resp.write(chunk)
+            if tee:
+                await tee.write(chunk)
+        await resp.write_eof()
+        complete = True
+    except (ClientError, asyncio.TimeoutError, CircuitOpen):
+        # Headers are already out; all we can do is log and cut the body
+        # short, closing the connection so the client sees it was truncated
+        log.exception("%s: upstream failed mid-stream", request.path)
+        resp.force_close()
+    except ConnectionResetError:
+        log.info("%s: client went away", request.path)
+    finally:
+        if tee:
+            await tee.close(complete)
+    return resp
+
+
+async def _iter_unsized(session: ClientSession, url: str, headers=None):
+    async def _open():
+        r = await session.get(url, headers=headers)
+        try:
+            r.raise_for_status()
+        except Exception:
+            r.release()
+            raise
+        return r
+    async with await upstream.call_async(url, _open) as r:
+        async for chunk in r.content.iter_chunked(READ_SIZE):
+            yield chunk
+
+
+class _CacheWriter:
+    """Copies a proxied full body into the media cache without blocking the
+    loop: writes are batched and run on the default executor, one at a time
+    while the next bytes go to the client. Stored only if exactly
+    ``length`` bytes went by, like ``media_cache.tee``."""
+
+    def __init__(self, key: str, length: int, name: str, mimetype: str, etag: str):
+        self.key, self.length, self.name, self.mimetype, self.etag = key, length, name, mimetype, etag
+        self._tmp = os.path.join(media_cache.root, f".{uuid.uuid4().hex}.part")
+        self._f = None
+        self._buf = []
+        self._buffered = 0
+        self._queued = 0
+        self._pending = None
+        self._failed = False
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    async def open(self):
+        try:
+            os.makedirs(media_cache.root, exist_ok=True)
+            self._f = await self._run(open, self._tmp, "wb")
+        except OSError:
+            log.warning("media cache unavailable for %s; not caching", self.key)
+            self._failed = True
+
+    async def _settle(self):
+        if self._pending is not None:
+            try:
+                await self._pending
+            except OSError:
+                # Disk trouble must never break the client's download
+                log.warning("media cache write failed for %s; not caching", self.key)
+                self._failed = True
+            self._pending = None
+
+    async def _flush(self):
+        await self._settle()
+        if self._buf and not self._failed:
+            data, self._buf, self._buffered = b"".join(self._buf), [], 0
+            self._queued += len(data)
+            self._pending = asyncio.ensure_future(self._run(self._f.write, data))
+
+    async def write(self, chunk: bytes):
+        if self._failed:
+            return
+        self._buf.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered >= STREAM_CHUNK_SIZE:
+            await self._flush()
+
+    async def close(self, complete: bool):
+        if self._f is not None:
+            if complete:
+                await self._flush()
+            await self._settle()
+            await self._run(self._f.close)
+            if complete and not self._failed and self._queued == self.length:
+                try:
+                    await offload(media_cache.put_file, self.key, self._tmp, self.name, self.mimetype, self.etag)
+                except Exception:
+                    log.exception("media cache store failed for %s", self.key)
+        if os.path.exists(self._tmp):
+            await self._run(os.unlink, self._tmp)
+
+
+class _SentFile(web.FileResponse):
+    # Sent inside the handler (so temp files can be removed right after);
+    # the second prepare() aiohttp makes on the returned response is a no-op.
+    def __init__(self, path, etag: str = "", **kwargs):
+        super().__init__(path, **kwargs)
+        self._fixed_etag = etag
+
+    async def prepare(self, request):
+        if self.prepared:
+            return None
+        return await super().prepare(request)
+
+    @property
+    def etag(self):
+        return web.FileResponse.etag.fget(self)
+
+    @etag.setter
+    def etag(self, value):
+        # aiohttp derives its own from mtime and size; the media cache bumps
+        # mtime on every hit, so keep the stable one the WSGI app sends
+        web.FileResponse.etag.fset(self, self._fixed_etag or value)
+
+
+def _validated(request: web.Request, etag: str) -> web.Request:
+    """``request`` with If-Range applied against our ``etag`` (the Range
+    header is dropped when it doesn't match) and the other validators
+    removed, so FileResponse doesn't check them against its own tag."""
+    headers = request.headers.copy()
+    if "If-Range" in headers:
+        if_range = parse_if_range_header(headers["If-Range"])
+        if if_range.date or if_range.etag != etag:
+            headers.popall("Range", None)
+    for name in ("If-Range", "If-Match", "If-None-Match", "If-Modified-Since", "If-Unmodified-Since"):
+        headers.popall(name, None)
+    return request.clone(headers=headers)
+
+
+async def _send_file(request: web.Request, path: str, name: str, mimetype: str, etag: str = "",
+                     cleanup_dir=None) -> web.StreamResponse:
+    """Send a file on disk with sendfile (Range handled by aiohttp).
+    Conditionals are answered against ``etag``, as ``delivery.send_path`` does."""
+    if etag and parse_etags(request.headers.get("If-None-Match")).contains_weak(etag):
+        if cleanup_dir:
+            await asyncio.get_running_loop().run_in_executor(_executor, shutil.rmtree, cleanup_dir, True)
+        return web.Response(status=304, headers={"ETag": f'"{etag}"'})
+    resp = _SentFile(path, etag=etag, headers={**attachment_headers(name), "Content-Type": mimetype})
+    if etag:
+        request = _validated(request, etag)
+    try:
+        await resp.prepare(request)
+        await resp.write_eof()
+    except ConnectionResetError:
+        log.info("%s: client went away", request.path)
+    finally:
+        if cleanup_dir:
+            # The file is fully sent (or abandoned) once prepare() returns
+            await asyncio.get_running_loop().run_in_executor(_executor, shutil.rmtree, cleanup_dir, True)
+    return resp
+
+
+def _direct_response(entry, mode: str):
+    # Mirrors app._direct_response
+    if not entry:
+        if mode == "resolve":
+            return _error(409, "No single direct URL for this item (it needs a server-side "
+                               "merge or cookies); download it without 'mode'")
+        return None
+    now = time.time()
+    expires_at = entry.get("expires_at")
+    if mode == "resolve":
+        entry["expires_in"] = int(expires_at - now) if expires_at else None
+        return web.json_response(entry)
+    max_age = int(min(expires_at - metadata_cache.SIGNED_URL_MARGIN - now, metadata_cache.META_CACHE_TTL)) if expires_at else 0
+    return web.Response(status=302, headers={
+        "Location": entry["url"], "Referrer-Policy": "no-referrer",
+        "Cache-Control": f"private, max-age={max_age}" if max_age > 0 else "no-store"})
+
+
+def _request_mode(request: web.Request):
+    mode = (request.query.get("mode") or "proxy").lower()
+    return mode if mode in wsgi._MODES else None
+
+
+# --------------------------
+# Routes
+# --------------------------
+def _youtube_handler(kind: str):
+    label = f"download_{kind}"
+
+    async def handler(request: web.Request):
+        url = request.query.get("url")
+        if not url:
+            return _error(400, "Missing 'url' parameter")
+        ref = wsgi._media_ref(url, "youtube")
+        if not ref:
+            return _error(400, "Not a valid YouTube URL")
+        mode = _request_mode(request)
+        if not mode:
+            return _error(400, "Invalid 'mode' (use proxy, redirect or resolve)")
+        if kind == "audio" and (request.query.get("format") or "m4a").lower() != "m4a":
+            # Transcodes stream from an FFmpeg pipe; the WSGI app serves them
+            return _error(400, "Only format=m4a is served here; use the main app for mp3/opus")
+        try:
+            if mode != "proxy":
+                entry = await offload(lambda: metadata_cache.get_direct(
+                    f"{ref.key}:{kind}", lambda: wsgi._youtube_direct(ref, kind)))
+                resp = _direct_response(entry, mode)
+                if resp is not None:
+                    return resp
+            _, mimetype, fmt = wsgi._YT_KINDS[kind]
+            cache_key = media_cache.key(ref.platform, ref.id, fmt)
+            cached = await offload(media_cache.get, cache_key)
+            if cached:
+                return await _send_file(request, cached.path, cached.download_name, cached.mimetype, cached.etag)
+            resolved = await offload(wsgi._resolve_youtube, ref, kind)
+            if not resolved:
+                return _error(404, f"No {kind} stream found for the provided URL")
+            length = resolved.filesize or await offload(probe_length, resolved.url, resolved.headers)
+            name = f"{safe_title(resolved.title)}{wsgi._YT_KINDS[kind][0]}"
+            return await _proxy(request, resolved.url, length, name, mimetype, resolved.etag,
+                                headers=resolved.headers, range_param=True, cache_key=cache_key)
+        except Busy:
+            return _error(503, "Server is busy, please retry shortly", **{"Retry-After": "5"})
+        except CircuitOpen as e:
+            return _error(503, f"Upstream temporarily unavailable: {e}", **{"Retry-After": str(e.retry_after)})
+        except Exception as e:
+            log.exception("%s failed", label)
+            return _error(500, str(e))
+    return handler
+
+
+def _ytdlp_handler(platform: str, display: str, label: str):
+    async def handler(request: web.Request):
+        url = request.query.get("url")
+        if not url:
+            return _error(400, "Missing 'url' parameter")
+        if not wsgi._media_ref(url, platform):
+            return _error(400, f"Not a valid {display} URL")
+        mode = _request_mode(request)
+        if not mode:
+            return _error(400, "Invalid 'mode' (use proxy, redirect or resolve)")
+        try:
+            fmt = wsgi._ytdlp_format()
+            if mode != "proxy":
+                key = wsgi._ytdlp_cache_key(url, "direct:" + fmt) or f"url:{url}"
+                entry = await offload(metadata_cache.get_direct, key, lambda: wsgi._ytdlp_direct_entry(url))
+                resp = _direct_response(entry, mode)
+                if resp is not None:
+                    return resp
+            cache_key = wsgi._ytdlp_cache_key(url, fmt)
+            cached = await offload(media_cache.get, cache_key) if cache_key else None
+            if cached:
+                return await _send_file(request, cached.path, cached.download_name, cached.mimetype, cached.etag)
+            direct = await offload(wsgi._ytdlp_direct, url)
+            if direct:
+                info, headers, name = direct
+                length = info.get("filesize") or await offload(probe_length, info["url"], headers)
+                if length:
+                    mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                    return await _proxy(request, info["url"], length, name, mimetype, wsgi._file_etag(name, length),
+                                        headers=headers, cache_key=cache_key)
+            # Merges and HLS/DASH: yt-dlp builds the file on the pool, then sendfile
+            final_path, name, temp_dir = await offload(wsgi._dl_with_ytdlp, url)
+            mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            return await _send_file(request, final_path, name, mimetype,
+                                    wsgi._file_etag(name, os.path.getsize(final_path)), cleanup_dir=temp_dir)
+        except Busy:
+            return _error(503, "Server is busy, please retry shortly", **{"Retry-After": "5"})
+        except CircuitOpen as e:
+            return _error(503, f"Upstream temporarily unavailable: {e}", **{"Retry-After": str(e.retry_after)})
+        except ScratchFull as e:
+            return _error(503, "Server is short on disk space, please retry shortly",
+                          **{"Retry-After": str(e.retry_after)})
+        except FfmpegBusy as e:
+            return _error(503, "Server is busy encoding, please retry shortly", **{"Retry-After": str(e.retry_after)})
+        except Exception as e:
+            log.exception("%s failed", label)
+            return _error(500, f"Failed to download {display} video: {e}")
+    return handler
+
+
+async def _health(request):
+    return web.Response(text="ok")
+
+
+async def _metrics(request):
+    text = await offload(metrics.registry.render)
+    return web.Response(body=text.encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+@web.middleware
+async def _metrics_middleware(request: web.Request, handler):
+    # Same series as metrics.MetricsMiddleware, labelled by route path
+    route = request.match_info.route.resource.canonical if request.match_info.route.resource else "unmatched"
+    labels = {"route": route}
+    started = time.perf_counter()
+    metrics.registry.gauge_add("deetalk_http_in_flight", labels, 1)
+    status, sent = "500", 0
+    try:
+        resp = await handler(request)
+        # Declared length; a client that hangs up early is counted in full
+        status, sent = str(resp.status), resp.content_length or 0
+        return resp
+    except web.HTTPException as e:
+        status = str(e.status)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.registry.gauge_add("deetalk_http_in_flight", labels, -1)
+        metrics.registry.inc("deetalk_http_requests_total", {"route": route, "method": request.method, "status": status})
+        metrics.registry.inc("deetalk_http_response_bytes_total", labels, sent)
+        metrics.registry.observe("deetalk_http_request_duration_seconds", labels, elapsed)
+
+
+async def _open_upstream(app: web.Application):
+    app["upstream"] = ClientSession(
+        connector=TCPConnector(limit=ASYNC_UPSTREAM_CONNECTIONS, limit_per_host=0),
+        timeout=ClientTimeout(total=None, sock_connect=UPSTREAM_TIMEOUT, sock_read=UPSTREAM_TIMEOUT),
+        auto_decompress=False,
+    )
+
+
+async def _close_upstream(app: web.Application):
+    await app["upstream"].close()
+
+
+async def create_app() -> web.Application:
+    """Application factory (also what ``aiohttp.GunicornWebWorker`` calls)."""
+    app = web.Application(middlewares=[_metrics_middleware])
+    app.on_startup.append(_open_upstream)
+    app.on_cleanup.append(_close_upstream)
+    app.router.add_get("/download_video", _youtube_handler("video"))
+    app.router.add_get("/download_audio", _youtube_handler("audio"))
+    app.router.add_get("/download_insta_video",
+                       _ytdlp_handler("instagram", "Instagram", "download_insta_video"))
+    app.router.add_get("/download_tiktok_video",
+                       _ytdlp_handler("tiktok", "TikTok", "download_tiktok_video"))
+    app.router.add_get("/_health", _health)
+    app.router.add_get("/_metrics", _metrics)
+    return app
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="asyncio server for the download routes")
+    p.add_argument("--host", default="0.0.0.0")
+    p.add_argument("--port", type=int, default=8001)
+    args = p.parse_args(argv)
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
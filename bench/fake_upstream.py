@@ -0,0 +1,131 @@
+"""Local stand-in for googlevideo / i.ytimg.com / the transcript API / IG & TikTok CDNs.
+
+Serves synthetic bytes, so benchmarks never touch the network:
+
+* ``/media/<id>.<ext>?size=N`` - N bytes, with ``Range`` headers and
+  googlevideo-style ``&range=a-b`` query ranges, ``HEAD`` for lengths;
+* ``/vi/<id>/<file>.jpg`` - a thumbnail-sized image;
+* ``/transcript/<id>?lines=N`` - transcript snippets as JSON.
+
+``--rate`` throttles every connection to that many bytes per second (like
+googlevideo does per connection) and ``--latency`` delays each response's
+first byte.
+
+    python bench/fake_upstream.py --port 9000 --rate 2000000 --latency 50
+"""
+import re
+import sys
+import json
+import time
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+_BLOCK = bytes(range(256)) * 4096  # 1 MiB pattern the bodies are cut from
+_RANGE = re.compile(r"bytes=(\d+)-(\d*)")
+THUMB_BYTES = 24 * 1024
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+    rate = 0         # bytes/s per connection, 0 = unthrottled
+    latency = 0.0    # seconds before each response
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._route(head=True)
+
+    def do_GET(self):
+        self._route(head=False)
+
+    def _route(self, head: bool):
+        url = urlparse(self.path)
+        q = parse_qs(url.query)
+        if self.latency:
+            time.sleep(self.latency)
+        if url.path.startswith("/media/"):
+            return self._body(int(q.get("size", ["1048576"])[0]), "video/mp4", head, q.get("range", [None])[0])
+        if url.path.startswith("/vi/"):
+            return self._body(THUMB_BYTES, "image/jpeg", head, None)
+        if url.path.startswith("/transcript/"):
+            lines = int(q.get("lines", ["300"])[0])
+            data = json.dumps([{"text": f"synthetic line {i} about benchmarks", "start": i * 2.5, "duration": 2.5}
+                               for i in range(lines)]).encode()
+            return self._send(200, "application/json", data, head)
+        self._send(404, "text/plain", b"not found", head)
+
+    def _send(self, status: int, ctype: str, data: bytes, head: bool):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+    def _body(self, size: int, ctype: str, head: bool, query_range):
+        start, end, status = 0, size - 1, 200
+        m = _RANGE.match(self.headers.get("Range", "")) or (
+            re.match(r"(\d+)-(\d*)", query_range) if query_range else None)
+        if m:
+            start = int(m.group(1))
+            end = min(int(m.group(2)) if m.group(2) else size - 1, size - 1)
+            status = 206 if not query_range else 200
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if head:
+            return
+        pos, chunk = start, 64 * 1024
+        began = time.perf_counter()
+        try:
+            while pos <= end:
+                n = min(chunk, end - pos + 1)
+                off = pos % len(_BLOCK)
+                piece = _BLOCK[off:off + n]
+                if len(piece) < n:
+                    piece += _BLOCK[:n - len(piece)]
+                self.wfile.write(piece)
+                pos += n
+                if self.rate:
+                    ahead = (pos - start) / self.rate - (time.perf_counter() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+def serve(host: str, port: int, rate: int = 0, latency_ms: float = 0) -> ThreadingHTTPServer:
+    Handler.rate = rate
+    Handler.latency = latency_ms / 1000.0
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=9000)
+    p.add_argument("--rate", type=int, default=0, help="bytes/s per connection (0 = unthrottled)")
+    p.add_argument("--latency", type=float, default=0, help="ms before each response")
+    args = p.parse_args(argv)
+    server = serve(args.host, args.port, args.rate, args.latency)
+    print(f"fake upstream on http://{args.host}:{args.port}", file=sys.stderr, flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
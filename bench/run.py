@@ -0,0 +1,321 @@
+"""Offline throughput/latency/memory benchmark for the download routes.
+
+Starts ``fake_upstream`` and the app (``stubs:app``, real code with fake
+extractors) as subprocesses, then drives each route at each concurrency
+level and reports req/s, p50/p99 latency, p50/p99 time to first byte,
+throughput and the server's peak RSS during the scenario::
+
+    python bench/run.py                                  # every route, concurrency 1,8,32
+    python bench/run.py --routes video,tiktok --concurrency 16 --requests 400
+    python bench/run.py --size 64MiB --rate 4MB          # big files, throttled upstream
+    python bench/run.py --server gunicorn --workers 2 --threads 8
+    python bench/run.py --json out.json                  # save results
+    python bench/run.py --baseline out.json              # exit 1 on a regression
+
+Each request uses a new video id unless ``--hot`` is given, so by default
+the numbers are for the uncached path.
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+# route name -> (method, path, params(video_id))
+ROUTES = {
+    "video": ("GET", "/download_video", lambda vid: {"url": f"https://youtu.be/{vid}"}),
+    "audio": ("GET", "/download_audio", lambda vid: {"url": f"https://youtu.be/{vid}"}),
+    "thumbnail": ("GET", "/download_thumbnail", lambda vid: {"url": f"https://youtu.be/{vid}", "size": "hq"}),
+    "transcript": ("GET", "/get_transcript", lambda vid: {"url": f"https://youtu.be/{vid}"}),
+    "insta": ("GET", "/download_insta_video", lambda vid: {"url": f"https://www.instagram.com/reel/{vid}/"}),
+    "tiktok": ("GET", "/download_tiktok_video",
+               lambda vid: {"url": f"https://www.tiktok.com/@bench/video/{int.from_bytes(vid.encode(), 'big') % 10 ** 19}"}),
+}
+# Thresholds for --baseline: a scenario regresses when req/s drops or p99 /
+# peak RSS grow by more than --tolerance
+_COMPARED = {"rps": -1, "p99_ms": 1, "peak_rss_mb": 1}
+
+
+def _size(text: str) -> int:
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMG]i?B?|B)?", text.strip(), re.I)
+    if not m:
+        raise argparse.ArgumentTypeError(f"bad size: {text}")
+    unit = (m.group(2) or "").upper()
+    mult = {"": 1, "B": 1, "K": 1000, "KB": 1000, "KIB": 1024, "M": 1000 ** 2, "MB": 1000 ** 2,
+            "MIB": 1024 ** 2, "G": 1000 ** 3, "GB": 1000 ** 3, "GIB": 1024 ** 3}[unit]
+    return int(float(m.group(1)) * mult)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(url: str, proc, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{proc.args[0]} exited with {proc.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def _video_id(hot: bool) -> str:
+    if hot:
+        return "benchHOTid0"
+    return uuid.uuid4().hex[:11]
+
+
+def _percentile(values, pct: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+# -- memory ------------------------------------------------------------------
+def _tree_pids(pid: int) -> list:
+    pids, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        pids.append(p)
+        try:
+            for task in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{task}/children") as f:
+                    todo.extend(int(c) for c in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def _rss_bytes(pid: int):
+    total = 0
+    for p in _tree_pids(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total or None
+
+
+class RssSampler(threading.Thread):
+    """Peak RSS of the server process tree (Linux /proc), sampled every 20 ms."""
+
+    def __init__(self, pid: int):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.peak = None
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            rss = _rss_bytes(self.pid)
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            self._done.wait(0.02)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.peak
+
+
+# -- load --------------------------------------------------------------------
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+    s = getattr(_local, "session", None)
+    if s is None:
+        s = _local.session = requests.Session()
+    return s
+
+
+def _one(base: str, route: str, hot: bool) -> dict:
+    method, path, params = ROUTES[route]
+    started = time.perf_counter()
+    ttfb, size = None, 0
+    try:
+        with _session().request(method, base + path, params=params(_video_id(hot)), stream=True, timeout=300) as r:
+            for chunk in r.iter_content(256 * 1024):
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                size += len(chunk)
+            ok = r.status_code < 400
+    except requests.RequestException:
+        ok = False
+    elapsed = time.perf_counter() - started
+    return {"ok": ok, "latency": elapsed, "ttfb": ttfb if ttfb is not None else elapsed, "bytes": size}
+
+
+def run_scenario(base: str, server_pid: int, route: str, concurrency: int, total: int, hot: bool) -> dict:
+    sampler = RssSampler(server_pid)
+    sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: _one(base, route, hot), range(total)))
+    wall = time.perf_counter() - started
+    peak = sampler.stop()
+    ok = [r for r in results if r["ok"]]
+    lat = [r["latency"] for r in ok]
+    ttfb = [r["ttfb"] for r in ok]
+    moved = sum(r["bytes"] for r in ok)
+    ms = lambda v: round(v * 1000, 1) if v is not None else None  # noqa: E731
+    return {
+        "route": route, "concurrency": concurrency, "requests": total, "errors": total - len(ok),
+        "rps": round(len(ok) / wall, 2), "p50_ms": ms(_percentile(lat, 50)), "p99_ms": ms(_percentile(lat, 99)),
+        "ttfb_p50_ms": ms(_percentile(ttfb, 50)), "ttfb_p99_ms": ms(_percentile(ttfb, 99)),
+        "mb_per_s": round(moved / wall / 1e6, 2),
+        "peak_rss_mb": round(peak / 1e6, 1) if peak else None,
+    }
+
+
+# -- processes ---------------------------------------------------------------
+def start_processes(args, scratch: str):
+    up_port, app_port = _free_port(), _free_port()
+    upstream = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "fake_upstream.py"), "--port", str(up_port),
+         "--rate", str(args.rate), "--latency", str(args.latency)])
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join([ROOT, BENCH_DIR]),
+               BENCH_UPSTREAM=f"http://127.0.0.1:{up_port}",
+               BENCH_MEDIA_BYTES=str(args.size),
+               BENCH_YTDLP_MODE=args.ytdlp_mode,
+               LOG_LEVEL="WARNING", WARMUP="0",
+               MEDIA_CACHE_DIR=os.path.join(scratch, "media"),
+               MEDIA_CACHE_MAX_BYTES=str(args.media_cache),
+               SPOOL_DIR=os.path.join(scratch, "spool"),
+               JOBS_DIR=os.path.join(scratch, "jobs"),
+               DELIVERY_DIR=os.path.join(scratch, "delivery"),
+               METRICS_DIR=os.path.join(scratch, "metrics"),
+               TRANSCRIPT_INDEX_PATH=os.path.join(scratch, "transcripts.sqlite3"))
+    if args.server == "gunicorn":
+        cmd = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-k", "gthread",
+               "--threads", str(args.threads), "-b", f"127.0.0.1:{app_port}", "--log-level", "warning",
+               "stubs:app"]
+    else:
+        cmd = [sys.executable, "-c",
+               "import logging, stubs; from werkzeug.serving import make_server; "
+               "logging.getLogger('werkzeug').setLevel(logging.WARNING); "
+               f"make_server('127.0.0.1', {app_port}, stubs.app, threaded=True).serve_forever()"]
+    server = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    try:
+        _wait_ready(f"http://127.0.0.1:{up_port}/transcript/x?lines=1", upstream)
+        _wait_ready(f"http://127.0.0.1:{app_port}/_health", server)
+    except Exception:
+        for p in (server, upstream):
+            p.kill()
+        raise
+    return upstream, server, f"http://127.0.0.1:{app_port}"
+
+
+def _regressions(results: list, baseline: list, tolerance: float) -> list:
+    base = {(b["route"], b["concurrency"]): b for b in baseline}
+    out = []
+    for r in results:
+        b = base.get((r["route"], r["concurrency"]))
+        if not b:
+            continue
+        for field, direction in _COMPARED.items():
+            old, new = b.get(field), r.get(field)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if change * direction > tolerance:
+                out.append(f"{r['route']} @ {r['concurrency']}: {field} {old} -> {new} ({change:+.0%})")
+    return out
+
+
+def _print_table(results: list):
+    cols = ("route", "concurrency", "requests", "errors", "rps", "p50_ms", "p99_ms",
+            "ttfb_p50_ms", "ttfb_p99_ms", "mb_per_s", "peak_rss_mb")
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in cols]
+    print("  ".join(c.rjust(w) for c, w in zip(cols, widths)))
+    for r in results:
+        print("  ".join(str(r[c]).rjust(w) for c, w in zip(cols, widths)))
+
+
+def main(argv=None) -> int:
+    p = argparse.ArgumentParser(description="Offline benchmark for the download routes.")
+    p.add_argument("--routes", default=",".join(ROUTES), help=f"comma-separated: {', '.join(ROUTES)}")
+    p.add_argument("--concurrency", default="1,8,32", help="comma-separated client concurrency levels")
+    p.add_argument("--requests", type=int, default=100, help="requests per scenario")
+    p.add_argument("--size", type=_size, default=_size("8MiB"), help="video size (audio is 1/8 of it)")
+    p.add_argument("--rate", type=_size, default=0, help="upstream bytes/s per connection (0 = unthrottled)")
+    p.add_argument("--latency", type=float, default=0, help="upstream ms before each response")
+    p.add_argument("--hot", action="store_true", help="reuse one video id (cache/coalescing path)")
+    p.add_argument("--media-cache", type=_size, default=0, help="MEDIA_CACHE_MAX_BYTES for the server")
+    p.add_argument("--ytdlp-mode", choices=("progressive", "merge"), default="progressive")
+    p.add_argument("--server", choices=("werkzeug", "gunicorn"), default="werkzeug")
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--json", help="write results to this file")
+    p.add_argument("--baseline", help="compare against a previous --json file; exit 1 on regression")
+    p.add_argument("--tolerance", type=float, default=0.15, help="allowed relative change for --baseline")
+    args = p.parse_args(argv)
+
+    routes = [r.strip() for r in args.routes.split(",") if r.strip()]
+    unknown = [r for r in routes if r not in ROUTES]
+    if unknown:
+        p.error(f"unknown routes: {', '.join(unknown)}")
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="deetalk-bench-") as scratch:
+        upstream, server, base = start_processes(args, scratch)
+        try:
+            for route in routes:
+                _one(base, route, args.hot)  # warm imports and pools outside the measurement
+                for concurrency in levels:
+                    result = run_scenario(base, server.pid, route, concurrency, args.requests, args.hot)
+                    results.append(result)
+                    print(json.dumps(result), file=sys.stderr, flush=True)
+        finally:
+            for proc in (server, upstream):
+                proc.terminate()
+                try:
+                    proc.wait(10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+
+    _print_table(results)
+    meta = {"size": args.size, "rate": args.rate, "latency": args.latency, "hot": args.hot,
+            "server": args.server, "ytdlp_mode": args.ytdlp_mode}
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": meta, "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != meta:
+            print(f"warning: baseline was run with {baseline.get('config')}", file=sys.stderr)
+        found = _regressions(results, baseline["results"], args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""The real app with its extractors pointed at ``fake_upstream``.
+
+Importing this module swaps pytubefix, yt-dlp and youtube-transcript-api
+for small fakes that resolve every id to ``BENCH_UPSTREAM`` URLs, and routes
+``i.ytimg.com`` through the shared session to the fake server. Everything
+else (routing, caches, coalescing, streaming, delivery) is the production
+code path. Exposes ``app`` for Gunicorn (``stubs:app``) or werkzeug.
+
+Environment: ``BENCH_UPSTREAM`` (fake server base URL), ``BENCH_MEDIA_BYTES``
+(size of every video/audio), ``BENCH_YTDLP_MODE`` (``progressive``: one
+direct file, piped through; ``merge``: yt-dlp "downloads" into a temp dir
+first, like an FFmpeg merge).
+"""
+import os
+import re
+import time
+import types
+import shutil
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import app as _app_module
+import streaming
+import transcripts
+
+UPSTREAM = os.getenv("BENCH_UPSTREAM", "http://127.0.0.1:9000").rstrip("/")
+MEDIA_BYTES = int(os.getenv("BENCH_MEDIA_BYTES", str(8 * 1024 ** 2)))
+YTDLP_MODE = os.getenv("BENCH_YTDLP_MODE", "progressive")
+
+_EXPIRE = int(time.time()) + 6 * 3600
+
+
+def _media_url(video_id: str, ext: str = "mp4", size: int = MEDIA_BYTES) -> str:
+    return f"{UPSTREAM}/media/{video_id}.{ext}?size={size}&expire={_EXPIRE}&lmt=1"
+
+
+# -- pytubefix ---------------------------------------------------------------
+class FakeStream:
+    def __init__(self, video_id: str, itag: int, ext: str, size: int):
+        self.itag = itag
+        self.filesize = size
+        self.url = _media_url(video_id, ext, size)
+
+    def iter_chunks(self, chunk_size):
+        return streaming.iter_url_range(self.url, 0, self.filesize - 1, range_param=True)
+
+
+class FakeStreamQuery:
+    def __init__(self, video_id: str):
+        self.video_id = video_id
+        self._audio = False
+
+    def filter(self, only_audio=False, **_):
+        q = FakeStreamQuery(self.video_id)
+        q._audio = only_audio
+        return q
+
+    def order_by(self, _):
+        return self
+
+    def desc(self):
+        return self
+
+    def first(self):
+        if self._audio:
+            return FakeStream(self.video_id, 140, "m4a", max(MEDIA_BYTES // 8, 1))
+        return self.get_highest_resolution()
+
+    def get_highest_resolution(self):
+        return FakeStream(self.video_id, 18, "mp4", MEDIA_BYTES)
+
+
+class FakeYouTube:
+    def __init__(self, url, *args, **kwargs):
+        q = parse_qs(urlparse(url).query)
+        self.video_id = q.get("v", [url.rstrip("/").rsplit("/", 1)[-1]])[0]
+        self.title = f"Benchmark {self.video_id}"
+        self._fmt_streams = None
+
+    @property
+    def streams(self):
+        if self._fmt_streams is None:
+            self._fmt_streams = [FakeStream(self.video_id, 18, "mp4", MEDIA_BYTES)]
+        return FakeStreamQuery(self.video_id)
+
+    @property
+    def thumbnail_url(self):
+        return f"{UPSTREAM}/vi/{self.video_id}/hqdefault.jpg"
+
+
+# -- yt-dlp ------------------------------------------------------------------
+class _CookieJar:
+    def get_cookie_header(self, url):
+        return ""
+
+
+class FakeYoutubeDL:
+    def __init__(self, opts=None):
+        self.opts = opts or {}
+        self.cookiejar = _CookieJar()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=False):
+        if "entries" in url:  # playlists are out of scope for the benchmark
+            raise ValueError("playlists are not stubbed")
+        parsed = urlparse(url)
+        video_id = (parse_qs(parsed.query).get("v", [""])[0]
+                    or re.sub(r"\W", "", parsed.path.rstrip("/").rsplit("/", 1)[-1]) or "item")
+        info = {"id": video_id, "title": f"Benchmark {video_id}", "ext": "mp4", "protocol": "http", "format_id": "18",
+                "url": _media_url(video_id), "filesize": MEDIA_BYTES, "http_headers": {},
+                "webpage_url": url}
+        info["formats"] = [dict(info)]
+        return self.process_ie_result(info, download) if download else info
+
+    def process_ie_result(self, info, download=False):
+        if YTDLP_MODE == "merge":
+            info["requested_formats"] = [dict(info), dict(info, ext="m4a")]
+        if download:
+            path = self.prepare_filename(info)
+            with requests.get(info["url"], stream=True, timeout=60) as r, open(path, "wb") as f:
+                r.raise_for_status()
+                shutil.copyfileobj(r.raw, f, 1024 * 1024)
+            info["requested_downloads"] = [{"filepath": path}]
+        return info
+
+    def prepare_filename(self, info):
+        tmpl = self.opts.get("outtmpl", "%(title)s [%(id)s].%(ext)s")
+        return tmpl % {"title": info["title"].replace(" ", "_"), "id": info["id"], "ext": info["ext"]}
+
+
+# -- youtube-transcript-api -------------------------------------------------
+class _Fetched:
+    def __init__(self, snippets):
+        self.language_code = "en"
+        self.is_generated = False
+        self._snippets = snippets
+
+    def to_raw_data(self):
+        return self._snippets
+
+
+class FakeTranscriptApi:
+    def __init__(self, http_client=None):
+        self._http = http_client or requests.Session()
+
+    def fetch(self, video_id, languages=("en",)):
+        r = self._http.get(f"{UPSTREAM}/transcript/{video_id}", timeout=30)
+        r.raise_for_status()
+        return _Fetched(r.json())
+
+
+# -- i.ytimg.com -> fake upstream ------------------------------------------
+class _RewriteAdapter(HTTPAdapter):
+    def send(self, request, **kwargs):
+        request.url = UPSTREAM + request.url[len("https://i.ytimg.com"):]
+        return super().send(request, **kwargs)
+
+
+def install():
+    _app_module.pytubefix = types.SimpleNamespace(YouTube=FakeYouTube)
+    _app_module.yt_dlp = types.SimpleNamespace(YoutubeDL=FakeYoutubeDL)
+    transcripts.yta = types.SimpleNamespace(YouTubeTranscriptApi=FakeTranscriptApi)
+    streaming.http_session().mount(
+        "https://i.ytimg.com/", _RewriteAdapter(pool_maxsize=streaming.PARALLEL_POOL_SIZE))
+
+
+install()
+app = _app_module.app
@@ -0,0 +1,174 @@
+"""Delivery of files that are already on disk (media cache, yt-dlp merges, job results).
+
+FILE_DELIVERY picks how the bytes move:
+
+* ``sendfile`` (default): the open file goes to the server's
+  ``wsgi.file_wrapper``; gunicorn turns that into ``os.sendfile`` from the
+  current offset for Content-Length bytes, so full and Range responses are
+  zero-copy. Servers without a file wrapper fall back to a bounded read loop.
+* ``x-accel``: nginx moves the bytes. The app only answers with
+  ``X-Accel-Redirect: X_ACCEL_LOCATION/<path relative to OFFLOAD_ROOT>``;
+  ``X_ACCEL_LOCATION`` must be an ``internal`` location aliased to
+  OFFLOAD_ROOT, and MEDIA_CACHE_DIR should live under it.
+* ``x-sendfile``: same idea with an absolute ``X-Sendfile`` path (Apache,
+  lighttpd, Caddy).
+* ``python``: a plain read loop in the worker.
+
+With offload, the proxy reads the file after our response is finished, so
+per-request temp files are parked under DELIVERY_DIR and reaped once older
+than DELIVERY_GRACE seconds instead of being deleted at response close.
+"""
+import os
+import time
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+from urllib.parse import quote
+
+from flask import Response, request, send_file
+from werkzeug.wsgi import FileWrapper
+
+from streaming import attachment_headers, requested_range
+
+log = logging.getLogger(__name__)
+
+FILE_DELIVERY = os.getenv("FILE_DELIVERY", "sendfile").lower()
+OFFLOAD_ROOT = os.getenv("OFFLOAD_ROOT", "")
+X_ACCEL_LOCATION = os.getenv("X_ACCEL_LOCATION", "/_media").rstrip("/")
+DELIVERY_DIR = os.getenv("DELIVERY_DIR") or (
+    os.path.join(OFFLOAD_ROOT, ".delivery") if OFFLOAD_ROOT
+    else os.path.join(tempfile.gettempdir(), "deetalk-delivery")
+)
+# Parked temp files outlive the slowest proxied transfer by this much
+DELIVERY_GRACE = float(os.getenv("DELIVERY_GRACE", "3600"))
+BLOCK_SIZE = 256 * 1024
+
+_sweep_lock = threading.Lock()
+_last_sweep = 0.0
+
+
+def _sweep_parked():
+    global _last_sweep
+    now = time.time()
+    with _sweep_lock:
+        if now - _last_sweep < 60 or not os.path.isdir(DELIVERY_DIR):
+            return
+        _last_sweep = now
+    for name in os.listdir(DELIVERY_DIR):
+        path = os.path.join(DELIVERY_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > DELIVERY_GRACE:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def _park(path: str, cleanup_dir: str) -> str:
+    """Move a per-request temp file where the janitor, not the response, removes it."""
+    _sweep_parked()
+    slot = os.path.join(DELIVERY_DIR, uuid.uuid4().hex)
+    os.makedirs(slot)
+    parked = os.path.join(slot, os.path.basename(path))
+    shutil.move(path, parked)
+    shutil.rmtree(cleanup_dir, ignore_errors=True)
+    return parked
+
+
+def _accel_uri(path: str):
+    if not OFFLOAD_ROOT:
+        return None
+    root = os.path.realpath(OFFLOAD_ROOT)
+    real = os.path.realpath(path)
+    if os.path.commonpath([root, real]) != root:
+        return None
+    rel = os.path.relpath(real, root).replace(os.sep, "/")
+    return f"{X_ACCEL_LOCATION}/{quote(rel)}"
+
+
+def _offload(path: str, download_name: str, mimetype: str, etag: str):
+    if FILE_DELIVERY == "x-accel":
+        header, value = "X-Accel-Redirect", _accel_uri(path)
+    else:
+        header, value = "X-Sendfile", os.path.realpath(path)
+    if not value:
+        return None
+    resp = Response(status=200, mimetype=mimetype)
+    resp.headers.update(attachment_headers(download_name))
+    resp.headers[header] = value
+    if etag:
+        resp.set_etag(etag)
+    return resp
+
+
+def _read_span(f, length: int):
+    try:
+        while length > 0:
+            data = f.read(min(BLOCK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def _sendfile_response(path: str, download_name: str, mimetype: str, etag: str, cleanup_dir=None):
+    f = open(path, "rb")
+    if cleanup_dir:
+        # The open descriptor keeps the data alive; the directory entry can go
+        # now. (Response close callbacks don't run for passthrough bodies.)
+        shutil.rmtree(cleanup_dir, ignore_errors=True)
+    size = os.fstat(f.fileno()).st_size
+    rng = requested_range(size, etag)
+    if rng is False:
+        f.close()
+        resp = Response(status=416)
+        resp.headers["Content-Range"] = f"bytes */{size}"
+        resp.headers["Accept-Ranges"] = "bytes"
+        return resp
+    start, end = rng or (0, size - 1)
+    length = end - start + 1 if size else 0
+    f.seek(start)
+    wrapper = request.environ.get("wsgi.file_wrapper") if FILE_DELIVERY != "python" else None
+    # gunicorn sendfiles from the current offset for exactly Content-Length
+    # bytes; other servers' wrappers may not, so they only get full bodies.
+    exact = request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn")
+    if wrapper and (rng is None or exact):
+        body = wrapper(f, BLOCK_SIZE)
+    elif rng is None:
+        body = FileWrapper(f, BLOCK_SIZE)
+    else:
+        body = _read_span(f, length)
+    resp = Response(body, status=206 if rng else 200, mimetype=mimetype, direct_passthrough=True)
+    resp.headers.update(attachment_headers(download_name))
+    resp.headers["Content-Length"] = str(length)
+    resp.headers["Accept-Ranges"] = "bytes"
+    if rng:
+        resp.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    if etag:
+        resp.set_etag(etag)
+    return resp
+
+
+def send_path(path: str, download_name: str, mimetype: str, etag: str = "", cleanup_dir=None,
+              as_attachment: bool = True) -> Response:
+    """Serve ``path`` using FILE_DELIVERY. ``cleanup_dir`` is a per-request
+    temp dir holding ``path`` that must go away once delivery is done."""
+    if etag and request.if_none_match.contains_weak(etag):
+        if cleanup_dir:
+            shutil.rmtree(cleanup_dir, ignore_errors=True)
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    if FILE_DELIVERY in ("x-accel", "x-sendfile") and as_attachment:
+        target = _park(path, cleanup_dir) if cleanup_dir else path
+        resp = _offload(target, download_name, mimetype, etag)
+        if resp is not None:
+            return resp
+        log.warning("%s can't offload %s; serving it directly", FILE_DELIVERY, target)
+        path, cleanup_dir = target, (os.path.dirname(target) if cleanup_dir else None)
+    if not as_attachment:
+        return send_file(path, download_name=download_name, mimetype=mimetype, etag=etag or True)
+    return _sendfile_response(path, download_name, mimetype, etag, cleanup_dir)
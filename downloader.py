@@ -13,6 +13,8 @@ import time
 from flask import after_this_request
 import mimetypes
 
+from streaming import safe_title, pytube_response
+
 
 app = Flask(__name__)
 
@@ -537,18 +539,14 @@ def download_audio():
         if not audio_stream:
             return jsonify({"error": "No audio stream found for the provided URL"}), 404
 
-        # Download stream data directly into a BytesIO object
-        file_data = io.BytesIO()
-        audio_stream.stream_to_buffer(file_data)
-        file_data.seek(0) # Reset pointer to the beginning of the file
-
-        sanitized_title = "".join(c for c in yt.title if c.isalnum() or c in (' ', '_')).rstrip().replace(' ', '_')
+        # Forward chunks as they arrive (honours Range for resumed downloads)
+        sanitized_title = safe_title(yt.title)
 
-        return send_file(
-            file_data,
-            as_attachment=True,
-            mimetype="audio/mp4",
-            download_name=f"{sanitized_title}.mp4"
+        return pytube_response(
+            audio_stream,
+            "audio/mp4",
+            f"{sanitized_title}.mp4",
+            label="download_audio",
         )
     except Exception as e:
         print(f"[download_audio] {e}")
@@ -567,18 +565,14 @@ def download_video():
         if not video_stream:
             return jsonify({"error": "No video stream found for the provided URL"}), 404
 
-        # Download stream data directly into a BytesIO object
-        file_data = io.BytesIO()
-        video_stream.stream_to_buffer(file_data)
-        file_data.seek(0) # Reset pointer to the beginning of the file
+        # Forward chunks as they arrive (honours Range for resumed downloads)
+        sanitized_title = safe_title(yt.title)
 
-        sanitized_title = "".join(c for c in yt.title if c.isalnum() or c in (' ', '_')).rstrip().replace(' ', '_')
-
-        return send_file(
-            file_data,
-            as_attachment=True,
-            mimetype="video/mp4",
-            download_name=f"{sanitized_title}.mp4"
+        return pytube_response(
+            video_stream,
+            "video/mp4",
+            f"{sanitized_title}.mp4",
+            label="download_video",
         )
     except Exception as e:
         print(f"[download_video] {e}")
@@ -0,0 +1,231 @@
+"""Extractor backends with ordered fallback and hedging.
+
+A backend turns a MediaRef and a kind (``video``/``audio``) into a
+``Resolved`` stream: one directly fetchable URL plus what the proxy needs
+to serve it. YouTube can be resolved by pytubefix and by yt-dlp (both are
+registered in ``app.py``). When one of them is slow or broken by a site
+change, the other can answer instead:
+
+* ``fallback``: try backends in order, moving on when one raises;
+* ``hedged`` (default): like fallback, but if the first backend hasn't
+  answered within its recent p95 latency (EXTRACTOR_HEDGE_DELAY until
+  there are enough samples), start the next one too and take whichever
+  succeeds first;
+* ``single``: only the first backend.
+
+The order is EXTRACTOR_ORDER, re-ranked from live stats: backends with
+EXTRACTOR_FAILURE_THRESHOLD consecutive failures go last for
+EXTRACTOR_COOLDOWN seconds, and backends with enough samples are ranked
+by median latency. Errors a backend marks as "the item itself is
+unavailable" (private, removed, region-blocked) are raised straight away
+and don't count against its health.
+
+Backend calls run on a small pool, so a losing hedge finishes in the
+background (its result still warms the metadata caches).
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+import tracing
+
+log = logging.getLogger(__name__)
+
+EXTRACTOR_ORDER = [n.strip() for n in os.getenv("EXTRACTOR_ORDER", "pytubefix,yt-dlp").split(",") if n.strip()]
+EXTRACTOR_MODE = os.getenv("EXTRACTOR_MODE", "hedged").lower()
+# Hedge deadline before a backend has EXTRACTOR_MIN_SAMPLES latencies, and its floor after
+EXTRACTOR_HEDGE_DELAY = float(os.getenv("EXTRACTOR_HEDGE_DELAY", "4"))
+EXTRACTOR_HEDGE_MIN = float(os.getenv("EXTRACTOR_HEDGE_MIN", "0.5"))
+EXTRACTOR_MIN_SAMPLES = int(os.getenv("EXTRACTOR_MIN_SAMPLES", "20"))
+EXTRACTOR_WINDOW = int(os.getenv("EXTRACTOR_WINDOW", "200"))
+EXTRACTOR_FAILURE_THRESHOLD = int(os.getenv("EXTRACTOR_FAILURE_THRESHOLD", "3"))
+EXTRACTOR_COOLDOWN = float(os.getenv("EXTRACTOR_COOLDOWN", "60"))
+EXTRACTOR_WORKERS = int(os.getenv("EXTRACTOR_WORKERS", "16"))
+
+# ``etag`` is stable across re-signed URLs; ``headers`` go with every upstream request
+Resolved = namedtuple("Resolved", "url title filesize etag headers backend")
+
+
+class Backend:
+    """``resolve(ref, kind)`` returns a Resolved, or None when the item has
+    no stream of that kind. ``unavailable(exc)`` tells whether an error is
+    about the item rather than the backend."""
+
+    def __init__(self, name: str, platforms, resolve, unavailable=None):
+        self.name = name
+        self.platforms = tuple(platforms)
+        self.resolve = resolve
+        self.unavailable = unavailable or (lambda exc: False)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=EXTRACTOR_WINDOW)
+        self.successes = 0
+        self.failures = 0
+        self.unavailable_errors = 0
+        self.consecutive_failures = 0
+        self.last_failure_at = 0.0
+        self.last_error = None
+        self.hedges = 0  # times this backend was started as a hedge
+        self.wins = 0    # hedged races it won
+
+    def record(self, seconds: float, exc=None):
+        with self._lock:
+            if exc is None:
+                self.successes += 1
+                self.consecutive_failures = 0
+                self._latencies.append(seconds)
+            elif self.unavailable(exc):
+                self.unavailable_errors += 1
+            else:
+                self.failures += 1
+                self.consecutive_failures += 1
+                self.last_failure_at = time.time()
+                self.last_error = f"{type(exc).__name__}: {exc}"[:300]
+
+    def quantile(self, q: float):
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < EXTRACTOR_MIN_SAMPLES:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def demoted(self) -> bool:
+        return (self.consecutive_failures >= EXTRACTOR_FAILURE_THRESHOLD
+                and time.time() - self.last_failure_at < EXTRACTOR_COOLDOWN)
+
+    def hedge_delay(self) -> float:
+        p95 = self.quantile(0.95)
+        return EXTRACTOR_HEDGE_DELAY if p95 is None else max(p95, EXTRACTOR_HEDGE_MIN)
+
+    def stats(self) -> dict:
+        p50, p95 = self.quantile(0.5), self.quantile(0.95)
+        return {"platforms": list(self.platforms), "successes": self.successes, "failures": self.failures,
+                "unavailable": self.unavailable_errors, "consecutive_failures": self.consecutive_failures,
+                "demoted": self.demoted(), "last_error": self.last_error, "hedges": self.hedges, "wins": self.wins,
+                "samples": len(self._latencies), "p50_seconds": p50, "p95_seconds": p95,
+                "hedge_delay_seconds": round(self.hedge_delay(), 3)}
+
+
+class Extractors:
+    def __init__(self, order, mode: str, workers: int):
+        self.order = list(order)
+        self.mode = mode
+        self.workers = workers
+        self._backends = {}
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def register(self, name: str, platforms, resolve, unavailable=None) -> Backend:
+        backend = Backend(name, platforms, resolve, unavailable)
+        self._backends[name] = backend
+        return backend
+
+    def ranked(self, platform: str):
+        """Enabled backends for ``platform``, best first."""
+        names = [n for n in self.order if n in self._backends] or list(self._backends)
+        candidates = [self._backends[n] for n in names if platform in self._backends[n].platforms]
+
+        def _key(backend):
+            p50 = backend.quantile(0.5)
+            return (backend.demoted(), p50 if p50 is not None else float("inf"), names.index(backend.name))
+        ranked = sorted(candidates, key=_key)
+        return ranked[:1] if self.mode == "single" else ranked
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="extract")
+            return self._pool
+
+    @staticmethod
+    def _call(backend: Backend, ref, kind: str):
+        started = time.perf_counter()
+        try:
+            with metrics.stage(f"extract_{backend.name.replace('-', '_')}"):
+                resolved = backend.resolve(ref, kind)
+        except Exception as e:
+            backend.record(time.perf_counter() - started, e)
+            raise
+        backend.record(time.perf_counter() - started)
+        return resolved._replace(backend=backend.name) if resolved else None
+
+    @classmethod
+    def _call_traced(cls, trace, backend: Backend, ref, kind: str):
+        # Runs on the extract pool; keep the stages on the request's trace
+        with tracing.attached(trace):
+            return cls._call(backend, ref, kind)
+
+    def resolve(self, ref, kind: str):
+        """Resolve ``ref`` with the ranked backends; raises the last error
+        when none of them succeeds."""
+        backends = self.ranked(ref.platform)
+        if not backends:
+            raise LookupError(f"No extractor backend for {ref.platform}")
+        if self.mode != "hedged" or len(backends) == 1:
+            return self._sequential(backends, ref, kind)
+        return self._hedged(backends, ref, kind)
+
+    def _sequential(self, backends, ref, kind: str):
+        error = None
+        for backend in backends:
+            try:
+                return self._call(backend, ref, kind)
+            except Exception as e:
+                if backend.unavailable(e):
+                    raise
+                log.warning("extractor %s failed for %s: %s", backend.name, ref.key, e)
+                error = e
+        raise error
+
+    def _hedged(self, backends, ref, kind: str):
+        queue = list(backends)
+        pending = {}
+        error = None
+        raced = []
+        trace = tracing.current()
+
+        def _launch(hedge: bool):
+            backend = queue.pop(0)
+            if hedge:
+                backend.hedges += 1
+                raced.append(backend)
+            pending[self._executor().submit(self._call_traced, trace, backend, ref, kind)] = backend
+            return time.monotonic() + backend.hedge_delay()
+
+        deadline = _launch(hedge=False)
+        while pending:
+            timeout = max(deadline - time.monotonic(), 0) if queue else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                log.info("extractor %s slow for %s, hedging with %s",
+                         ", ".join(b.name for b in pending.values()), ref.key, queue[0].name)
+                deadline = _launch(hedge=True)
+                continue
+            for future in done:
+                backend = pending.pop(future)
+                try:
+                    resolved = future.result()
+                except Exception as e:
+                    if backend.unavailable(e):
+                        raise
+                    log.warning("extractor %s failed for %s: %s", backend.name, ref.key, e)
+                    error = e
+                    if queue and not pending:
+                        deadline = _launch(hedge=False)
+                    continue
+                if raced:
+                    backend.wins += 1
+                return resolved
+        raise error
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "order": self.order,
+                "backends": {name: b.stats() for name, b in self._backends.items()},
+                "ranked": {p: [b.name for b in self.ranked(p)]
+                           for p in sorted({p for b in self._backends.values() for p in b.platforms})}}
+
+
+extractors = Extractors(EXTRACTOR_ORDER, EXTRACTOR_MODE, EXTRACTOR_WORKERS)
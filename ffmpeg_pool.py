@@ -0,0 +1,342 @@
+"""Bounded FFmpeg work: yt-dlp merges and audio transcodes.
+
+FFmpeg is CPU-heavy, and a burst of merges or transcodes would otherwise
+start one process per request. Every FFmpeg run takes a slot first:
+
+* FFMPEG_WORKERS slots per host (default: the CPU count), shared by all
+  gunicorn workers through lock files in FFMPEG_SLOTS_DIR;
+* a run that finds no free slot waits up to FFMPEG_QUEUE_WAIT seconds
+  (FFMPEG_MERGE_WAIT for merges, whose inputs are already downloaded),
+  with at most FFMPEG_QUEUE runs waiting per worker; otherwise
+  ``FfmpegBusy`` (``503``).
+
+``available()`` and ``encoders()`` probe the binary once per process.
+``transcode()`` turns an audio stream (bytes from upstream, or a file)
+into mp3/opus and yields the encoder output as it is produced; the
+caller closes it when the response is done.
+"""
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+FFMPEG_WORKERS = int(os.getenv("FFMPEG_WORKERS", "0")) or os.cpu_count() or 2
+FFMPEG_QUEUE = int(os.getenv("FFMPEG_QUEUE", "8"))
+FFMPEG_QUEUE_WAIT = float(os.getenv("FFMPEG_QUEUE_WAIT", "30"))
+FFMPEG_MERGE_WAIT = float(os.getenv("FFMPEG_MERGE_WAIT", "300"))
+FFMPEG_RETRY_AFTER = int(os.getenv("FFMPEG_RETRY_AFTER", "10"))
+FFMPEG_SLOTS_DIR = os.getenv("FFMPEG_SLOTS_DIR", os.path.join(tempfile.gettempdir(), "deetalk-ffmpeg"))
+
+# format -> (encoder, muxer, mimetype, extension, default kbps, (min, max) kbps)
+AUDIO_FORMATS = {
+    "mp3": ("libmp3lame", "mp3", "audio/mpeg", ".mp3", 192, (64, 320)),
+    "opus": ("libopus", "ogg", "audio/ogg", ".opus", 128, (32, 256)),
+}
+# Encoder output is passed on as soon as FFmpeg writes it, at most this much at a time
+STREAM_CHUNK = 64 * 1024
+
+_probe_lock = threading.Lock()
+_binary = False  # False = not probed yet
+_encoders = None
+
+
+class FfmpegBusy(Exception):
+    def __init__(self):
+        super().__init__("All FFmpeg slots are busy")
+        self.retry_after = FFMPEG_RETRY_AFTER
+
+
+def binary():
+    """Path of the ffmpeg executable, or None."""
+    global _binary
+    if _binary is False:
+        with _probe_lock:
+            if _binary is False:
+                _binary = shutil.which("ffmpeg") or shutil.which("ffmpeg.exe")
+    return _binary
+
+
+def available() -> bool:
+    return binary() is not None
+
+
+def encoders() -> set:
+    """Audio encoders this ffmpeg build has, among the ones we use."""
+    global _encoders
+    if _encoders is None:
+        found = set()
+        if available():
+            try:
+                out = subprocess.run([binary(), "-hide_banner", "-encoders"], capture_output=True,
+                                     text=True, timeout=10).stdout
+                found = {name for name, *_ in AUDIO_FORMATS.values() if f" {name} " in out}
+            except (OSError, subprocess.SubprocessError):
+                log.warning("could not list ffmpeg encoders")
+        _encoders = found
+    return _encoders
+
+
+def audio_formats() -> list:
+    """Transcode targets this host can produce."""
+    return [fmt for fmt, spec in AUDIO_FORMATS.items() if spec[0] in encoders()]
+
+
+class Slot:
+    def __init__(self, pool, kind: str, fd=None):
+        self._pool = pool
+        self.kind = kind
+        self._fd = fd
+        self._released = False
+
+    def release(self, ok: bool = True):
+        if not self._released:
+            self._released = True
+            self._pool._release(self, ok)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.release(ok=exc_type is None)
+        return False
+
+
+class FfmpegPool:
+    def __init__(self, slots: int, queue: int, wait: float, slots_dir: str):
+        self.slots = slots
+        self.queue = queue
+        self.wait = wait
+        self.slots_dir = slots_dir
+        self._lock = threading.Lock()
+        self._local_free = threading.Semaphore(slots)
+        self._in_use = 0
+        self._waiting = 0
+        self._counts = {}
+
+    def _count(self, field: str, kind: str):
+        with self._lock:
+            self._counts[(field, kind)] = self._counts.get((field, kind), 0) + 1
+
+    def _try_host_slot(self):
+        # One lock file per slot; flock is dropped by the kernel if the worker dies
+        for i in range(self.slots):
+            fd = os.open(os.path.join(self.slots_dir, f"slot-{i}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                os.close(fd)
+        return None
+
+    def acquire(self, kind: str, wait=None) -> Slot:
+        """A Slot for one FFmpeg run (``kind`` labels the stats: merge,
+        mp3, opus). Raises FfmpegBusy when none frees up within ``wait``
+        seconds (default FFMPEG_QUEUE_WAIT)."""
+        wait = self.wait if wait is None else wait
+        with self._lock:
+            if self._waiting >= self.queue:
+                busy = True
+            else:
+                busy = False
+                self._waiting += 1
+        if busy:
+            self._count("rejected", kind)
+            raise FfmpegBusy()
+        started = time.perf_counter()
+        deadline = time.monotonic() + wait
+        try:
+            # This worker's threads queue on the semaphore; workers share the lock files
+            if not self._local_free.acquire(timeout=max(wait, 0)):
+                self._count("rejected", kind)
+                raise FfmpegBusy()
+            fd = None
+            if fcntl is not None:
+                os.makedirs(self.slots_dir, exist_ok=True)
+                fd = self._try_host_slot()
+                while fd is None:
+                    if time.monotonic() >= deadline:
+                        self._local_free.release()
+                        self._count("rejected", kind)
+                        raise FfmpegBusy()
+                    time.sleep(0.05)
+                    fd = self._try_host_slot()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        with self._lock:
+            self._in_use += 1
+        metrics.registry.observe("deetalk_ffmpeg_queue_seconds", {"kind": kind}, time.perf_counter() - started)
+        self._count("started", kind)
+        return Slot(self, kind, fd)
+
+    def _release(self, slot: Slot, ok: bool):
+        if slot._fd is not None:
+            fcntl.flock(slot._fd, fcntl.LOCK_UN)
+            os.close(slot._fd)
+        with self._lock:
+            self._in_use -= 1
+        self._local_free.release()
+        self._count("completed" if ok else "failed", slot.kind)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {}
+            for (field, kind), n in self._counts.items():
+                counts.setdefault(kind, {})[field] = n
+            return {"ffmpeg": binary(), "audio_formats": audio_formats(), "slots": self.slots,
+                    "in_use": self._in_use, "waiting": self._waiting, "by_kind": counts}
+
+
+pool = FfmpegPool(FFMPEG_WORKERS, FFMPEG_QUEUE, FFMPEG_QUEUE_WAIT, FFMPEG_SLOTS_DIR)
+
+
+def parse_bitrate(fmt: str, value):
+    """kbps for ``fmt`` from a request value; None when out of range."""
+    _, _, _, _, default, (low, high) = AUDIO_FORMATS[fmt]
+    if value in (None, ""):
+        return default
+    try:
+        kbps = int(str(value).lower().rstrip("k"))
+    except ValueError:
+        return None
+    return kbps if low <= kbps <= high else None
+
+
+class Transcode:
+    """Encoder output for one transcode; iterate it for the bytes.
+
+    The slot is taken on creation, so FfmpegBusy is raised before a
+    response starts. FFmpeg itself only starts when the output is first
+    read. ``close()`` kills FFmpeg and gives the slot back whether or not
+    the output was read (a HEAD, a response that is never sent), so
+    pass it as the streamed response's ``on_close``."""
+
+    def __init__(self, source, fmt: str, kbps: int):
+        self._slot = None
+        self.fmt = fmt
+        self._source = source
+        self._from_file = isinstance(source, str)
+        encoder, muxer, _, _, _, _ = AUDIO_FORMATS[fmt]
+        # -xerror: a demux error (e.g. a truncated upstream body) fails the run
+        # instead of ending it early with a clean exit and a short file
+        self._cmd = [binary(), "-hide_banner", "-nostats", "-loglevel", "error", "-xerror",
+                     "-i", source if self._from_file else "pipe:0", "-vn", "-map", "0:a:0",
+                     "-c:a", encoder, "-b:a", f"{kbps}k", "-f", muxer, "pipe:1"]
+        self._lock = threading.Lock()
+        self._proc = None
+        self._started = None
+        self._ok = False
+        self._closed = False
+        self._slot = pool.acquire(fmt)
+
+    def __iter__(self):
+        return self._output()
+
+    def _spawn(self):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"ffmpeg {self.fmt} transcode already closed")
+            self._proc = subprocess.Popen(self._cmd, stdin=subprocess.DEVNULL if self._from_file else subprocess.PIPE,
+                                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self._started = time.perf_counter()
+            return self._proc
+
+    def _output(self):
+        try:
+            proc = self._spawn()
+        except Exception:
+            self.close()
+            raise
+        errors = []
+        feeder = None
+        if not self._from_file:
+            source = self._source
+
+            def _feed():
+                try:
+                    for chunk in source:
+                        proc.stdin.write(chunk)
+                except (BrokenPipeError, ValueError):
+                    pass  # FFmpeg exited (error or consumer gone); reported below
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except OSError:
+                        pass
+                    close = getattr(source, "close", None)
+                    if close:
+                        close()
+            feeder = threading.Thread(target=_feed, name=f"ffmpeg-feed-{self.fmt}", daemon=True)
+            feeder.start()
+        stderr = []
+        drain = threading.Thread(target=lambda: stderr.append(proc.stderr.read()), name="ffmpeg-stderr", daemon=True)
+        drain.start()
+        try:
+            while True:
+                chunk = proc.stdout.read1(STREAM_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+            proc.wait()
+            drain.join(5)
+            if feeder:
+                feeder.join(5)
+            if errors:
+                raise errors[0]
+            if proc.returncode != 0:
+                message = (b"".join(stderr).decode("utf-8", "replace").strip().splitlines() or ["?"])[-1]
+                raise RuntimeError(f"ffmpeg {self.fmt} encode failed: {message}")
+            self._ok = True
+        finally:
+            self.close()
+
+    def __del__(self):
+        # Last resort for a response that was dropped without being closed
+        try:
+            if self._slot is not None:
+                self.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Stop FFmpeg if it's still running and release the slot; safe to
+        call more than once, from the response or from the iterator."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            proc = self._proc
+        if proc is not None:
+            if proc.poll() is None:
+                proc.kill()  # client went away mid-encode
+                proc.wait()
+            proc.stdout.close()
+            metrics.registry.observe("deetalk_ffmpeg_run_seconds", {"kind": self.fmt},
+                                     time.perf_counter() - self._started)
+        else:
+            # Never started, so no feeder thread owns the source
+            close = getattr(self._source, "close", None)
+            if close:
+                close()
+        self._slot.release(self._ok)
+
+
+def transcode(source, fmt: str, kbps: int) -> Transcode:
+    """Re-encode ``source`` (a file path, or an iterator of bytes fed to
+    FFmpeg's stdin from a thread) as ``fmt`` at ``kbps``. Iterating the
+    result raises if FFmpeg fails."""
+    return Transcode(source, fmt, kbps)
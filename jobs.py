@@ -0,0 +1,174 @@
+"""Background download jobs.
+
+``POST /jobs`` queues a download on a bounded thread pool and returns at
+once, so a long transfer no longer pins a request thread (or runs into the
+serverless ``maxDuration``). Job state and finished artifacts live under
+JOBS_DIR, one directory per job, so any gunicorn worker can answer
+``GET /jobs/<id>`` and serve the result no matter which worker ran it.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.join(tempfile.gettempdir(), "deetalk-jobs"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Jobs waiting for a worker beyond this are rejected instead of queued
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "64"))
+# Finished jobs (and their artifacts) are swept after this many seconds
+JOB_TTL = float(os.getenv("JOB_TTL", "3600"))
+# Minimum seconds between progress writes to the state file
+PROGRESS_INTERVAL = 0.5
+
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, root: str, job_id: str):
+        self.id = job_id
+        self.dir = os.path.join(root, job_id)
+        self._last_write = 0.0
+        self._started = None
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.dir, os.path.basename(filename))
+
+    def load(self) -> dict:
+        try:
+            with open(os.path.join(self.dir, "state.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, **fields) -> dict:
+        state = self.load()
+        state.update(fields)
+        tmp = os.path.join(self.dir, f".state.{uuid.uuid4().hex}")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, os.path.join(self.dir, "state.json"))
+        return state
+
+    def progress(self, done: int, total=None, force: bool = False):
+        now = time.time()
+        if not force and now - self._last_write < PROGRESS_INTERVAL:
+            return
+        self._last_write = now
+        started = self._started or now
+        elapsed = max(now - started, 1e-6)
+        speed = done / elapsed if done else 0.0
+        eta = round((total - done) / speed, 1) if total and speed else None
+        self.save(bytes_done=done, bytes_total=total, speed=round(speed), eta_seconds=eta)
+
+    def adopt(self, src_path: str, filename: str, move: bool = False) -> str:
+        """Place a finished file in the job dir. Shared files (cache entries)
+        are hard-linked or copied so later eviction can't pull them away."""
+        dst = self.path(filename)
+        if move:
+            shutil.move(src_path, dst)
+            return dst
+        try:
+            os.link(src_path, dst)
+        except OSError:
+            shutil.copyfile(src_path, dst)
+        return dst
+
+
+class JobManager:
+    def __init__(self, root: str, workers: int, queue_limit: int, ttl: float):
+        self.root = root
+        self.queue_limit = queue_limit
+        self.ttl = ttl
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._last_sweep = 0.0
+
+    def submit(self, kind: str, url: str, runner) -> dict:
+        """``runner(job)`` does the work and returns the artifact as
+        ``{"filename", "download_name", "mimetype"}`` inside ``job.dir``."""
+        with self._lock:
+            if self._queued >= self.queue_limit:
+                raise QueueFull("job queue is full")
+            self._queued += 1
+        job = Job(self.root, uuid.uuid4().hex)
+        try:
+            self.sweep()
+            os.makedirs(job.dir)
+            state = job.save(id=job.id, kind=kind, url=url, state="queued", created_at=time.time(),
+                             bytes_done=0, bytes_total=None, eta_seconds=None)
+            self._pool.submit(self._run, job, runner)
+        except Exception:
+            # Never queued: give the slot back and drop the half-made job
+            with self._lock:
+                self._queued -= 1
+            shutil.rmtree(job.dir, ignore_errors=True)
+            raise
+        return state
+
+    def _run(self, job: Job, runner):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        job._started = time.time()
+        job.save(state="running", started_at=job._started)
+        try:
+            result = runner(job)
+            size = os.path.getsize(job.path(result["filename"]))
+            job.save(state="done", finished_at=time.time(), bytes_done=size, bytes_total=size,
+                     eta_seconds=0, **result)
+        except Exception as e:
+            log.exception("job %s (%s) failed", job.id, job.load().get("kind"))
+            job.save(state="failed", finished_at=time.time(), error=str(e))
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def get(self, job_id: str):
+        if not _JOB_ID.match(job_id or ""):
+            return None
+        state = Job(self.root, job_id).load()
+        return state or None
+
+    def result_path(self, job_id: str):
+        state = self.get(job_id)
+        if not state or state.get("state") != "done":
+            return None, state
+        return Job(self.root, job_id).path(state["filename"]), state
+
+    def sweep(self):
+        now = time.time()
+        if now - self._last_sweep < 60 or not os.path.isdir(self.root):
+            return
+        self._last_sweep = now
+        for name in os.listdir(self.root):
+            if not _JOB_ID.match(name):
+                continue
+            state = Job(self.root, name).load()
+            if state.get("state") in ("queued", "running"):
+                # Only reap unfinished jobs once they're clearly orphaned
+                if now - state.get("created_at", 0) < self.ttl * 4:
+                    continue
+            elif now - state.get("finished_at", 0) <= self.ttl:
+                continue
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"queued": self._queued, "running": self._running, "queue_limit": self.queue_limit}
+
+
+jobs = JobManager(JOBS_DIR, JOB_WORKERS, JOB_QUEUE_LIMIT, JOB_TTL)
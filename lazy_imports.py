@@ -0,0 +1,122 @@
+"""Deferred imports for the heavy extractor libraries.
+
+Every Vercel cold start imports ``app``. Loading yt-dlp, pytubefix,
+youtube-transcript-api and requests up front costs most of a second, even
+to answer ``/_health``. ``lazy_module(name)`` returns a stand-in that
+imports the real module on first attribute access, so each route only pays
+for what it uses. Each import's wall time is recorded for
+``/_debug/startup``.
+
+On long-lived workers, ``warmup()`` performs those imports in a background
+thread right after boot, so the first real request doesn't pay for them.
+"""
+import sys
+import time
+import logging
+import importlib
+import threading
+
+log = logging.getLogger(__name__)
+
+PROCESS_STARTED = time.time()
+
+_lock = threading.RLock()
+_timings = {}
+_registered = []
+_warmup_hooks = []
+_warmup = {"state": "idle"}
+
+
+def record(name: str, seconds: float, trigger: str = "eager"):
+    with _lock:
+        _timings[name] = {
+            "seconds": round(seconds, 4),
+            "at": round(time.time() - PROCESS_STARTED, 3),  # seconds after process start
+            "trigger": trigger,
+            "thread": threading.current_thread().name,
+        }
+
+
+def load(name: str, trigger: str = "first use"):
+    """Import ``name`` (once) and record how long it took."""
+    module = sys.modules.get(name)
+    if module is not None and name in _timings:
+        return module
+    with _lock:
+        if name in _timings:
+            return sys.modules[name]
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        record(name, time.perf_counter() - started, trigger)
+    return module
+
+
+class LazyModule:
+    """Module stand-in; the real import happens on first attribute access."""
+
+    def __init__(self, name: str):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            module = load(self._name)
+            object.__setattr__(self, "_module", module)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_module(name: str) -> LazyModule:
+    if name not in _registered:
+        _registered.append(name)
+    return LazyModule(name)
+
+
+def on_warmup(fn):
+    """Register ``fn()`` to run after the warmup imports (e.g. opening pools)."""
+    _warmup_hooks.append(fn)
+    return fn
+
+
+def _warm():
+    started = time.perf_counter()
+    for name in list(_registered):
+        try:
+            load(name, trigger="warmup")
+        except Exception:
+            log.exception("warmup import of %s failed", name)
+    for fn in _warmup_hooks:
+        try:
+            fn()
+        except Exception:
+            log.exception("warmup hook %s failed", getattr(fn, "__name__", fn))
+    _warmup.update(state="done", seconds=round(time.perf_counter() - started, 4))
+    log.info("warmup finished in %.2fs", _warmup["seconds"])
+
+
+def warmup():
+    """Import every lazy module in a background thread (idempotent)."""
+    with _lock:
+        if _warmup["state"] != "idle":
+            return
+        _warmup["state"] = "running"
+    threading.Thread(target=_warm, name="warmup", daemon=True).start()
+
+
+def report() -> dict:
+    with _lock:
+        imports = dict(_timings)
+        warm = dict(_warmup)
+    return {
+        "uptime": round(time.time() - PROCESS_STARTED, 3),
+        "imports": imports,
+        "not_loaded": [n for n in _registered if n not in imports],
+        "warmup": warm,
+    }
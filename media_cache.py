@@ -0,0 +1,198 @@
+"""On-disk media cache shared by the pytubefix routes and _dl_with_ytdlp.
+
+Entries are content-addressed by (platform, canonical id, format): the key is
+hashed into a file name, and each entry is a ``<hash>.bin`` payload plus a
+``<hash>.json`` sidecar carrying the download name, mimetype and ETag. File
+mtime doubles as the LRU clock, so every gunicorn worker pointing at the same
+directory shares one cache and one quota. Hit/miss/eviction counters are kept
+per process.
+"""
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from dataclasses import dataclass
+
+log = logging.getLogger(__name__)
+
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "deetalk-media-cache"))
+# 0 disables the cache entirely
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(1024 ** 3)))
+
+
+@dataclass
+class CachedMedia:
+    path: str
+    download_name: str
+    mimetype: str
+    etag: str
+    size: int
+
+
+class MediaCache:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "evicted_bytes": 0}
+        if self.enabled:
+            try:
+                os.makedirs(root, exist_ok=True)
+            except OSError:
+                log.warning("media cache dir %s unusable; cache disabled", root)
+                self.max_bytes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(platform: str, video_id: str, fmt: str) -> str:
+        return f"{platform}:{video_id}:{fmt}"
+
+    def _paths(self, key: str):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        base = os.path.join(self.root, digest)
+        return base + ".bin", base + ".json"
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            self._stats[name] += n
+
+    def get(self, key: str):
+        if not self.enabled:
+            return None
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            size = os.path.getsize(data_path)
+            os.utime(data_path)  # bump LRU position
+        except (OSError, ValueError):
+            self._count("misses")
+            return None
+        self._count("hits")
+        return CachedMedia(data_path, meta["download_name"], meta["mimetype"], meta.get("etag", ""), size)
+
+    def _admit(self, size) -> bool:
+        # A single entry may not take more than half the quota
+        return self.enabled and bool(size) and size <= self.max_bytes // 2
+
+    def _commit(self, key: str, tmp_path: str, download_name: str, mimetype: str, etag: str):
+        data_path, meta_path = self._paths(key)
+        meta = {"key": key, "download_name": download_name, "mimetype": mimetype, "etag": etag}
+        meta_tmp = f"{meta_path}.{uuid.uuid4().hex}.part"
+        with open(meta_tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, data_path)
+        os.utime(data_path)  # yt-dlp backdates mtime to the upstream Last-Modified
+        os.replace(meta_tmp, meta_path)
+        self._count("stores")
+        self.evict()
+        return data_path
+
+    def put_file(self, key: str, src_path: str, download_name: str, mimetype: str, etag: str = ""):
+        """Move a finished download into the cache. Returns the cached path,
+        or None when the file isn't admitted (caller keeps using src_path)."""
+        if not self._admit(os.path.getsize(src_path)):
+            return None
+        data_path, _ = self._paths(key)
+        tmp_path = f"{data_path}.{uuid.uuid4().hex}.part"
+        try:
+            shutil.move(src_path, tmp_path)
+            return self._commit(key, tmp_path, download_name, mimetype, etag)
+        except OSError:
+            log.exception("media cache store failed for %s", key)
+            if os.path.exists(tmp_path) and not os.path.exists(src_path):
+                shutil.move(tmp_path, src_path)
+            return None
+
+    def tee(self, key: str, chunks, size, download_name: str, mimetype: str, etag: str = ""):
+        """Pass ``chunks`` through unchanged while writing them to the cache;
+        the entry is committed only if exactly ``size`` bytes went by (with
+        ``size`` None, e.g. encoder output: only if ``chunks`` ran to the end)."""
+        if not (self._admit(size) if size is not None else self.enabled):
+            yield from chunks
+            return
+        data_path, _ = self._paths(key)
+        tmp_path = f"{data_path}.{uuid.uuid4().hex}.part"
+        f = open(tmp_path, "wb")
+        written = 0
+        complete = False
+        try:
+            for chunk in chunks:
+                if f:
+                    try:
+                        f.write(chunk)
+                        written += len(chunk)
+                    except OSError:
+                        # Disk trouble must never break the client's download
+                        log.warning("media cache write failed for %s; not caching", key)
+                        f.close()
+                        f = None
+                yield chunk
+            complete = True
+        finally:
+            if f:
+                f.close()
+            if f and (written == size if size is not None else complete and self._admit(written)):
+                try:
+                    self._commit(key, tmp_path, download_name, mimetype, etag)
+                except OSError:
+                    log.exception("media cache commit failed for %s", key)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.root) as it:
+            for e in it:
+                if e.name.endswith(".bin"):
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, e.path))
+        return entries
+
+    def evict(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for p in (path, path[:-4] + ".json"):
+                    try:
+                        os.unlink(p)
+                    except OSError:
+                        pass
+                total -= size
+                self._stats["evictions"] += 1
+                self._stats["evicted_bytes"] += size
+
+    def counters(self) -> dict:
+        """Hit/miss/eviction counts without scanning the cache directory."""
+        with self._lock:
+            return dict(self._stats)
+
+    def stats(self) -> dict:
+        out = self.counters()
+        lookups = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / lookups, 4) if lookups else 0.0
+        out["max_bytes"] = self.max_bytes
+        out["root"] = self.root
+        if self.enabled:
+            entries = self._entries()
+            out["entries"] = len(entries)
+            out["bytes"] = sum(size for _, size, _ in entries)
+        return out
+
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
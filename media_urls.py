@@ -0,0 +1,114 @@
+"""Canonical (platform, id) for every URL the app accepts.
+
+``youtu.be/X``, ``youtube.com/watch?v=X&t=10``, ``/shorts/X`` and
+``m.youtube.com`` links all name the same video; ``parse`` maps them to one
+``MediaRef`` with no network call, so caches, request coalescing and metrics
+agree on what an "item" is. Anything that doesn't match is rejected before
+we spend an upstream round trip on it.
+
+TikTok share links (``vm.tiktok.com/<code>``) only reveal the video id
+after a redirect; they are keyed by their short code instead.
+"""
+import re
+from functools import lru_cache
+from typing import NamedTuple, Optional
+from urllib.parse import urlsplit, parse_qs
+
+_YT_ID = re.compile(r"^[A-Za-z0-9_-]{11}$")
+_YT_HOSTS = re.compile(r"^(?:www\.|m\.|music\.)?(?:youtube\.com|youtube-nocookie\.com)$")
+_YT_PATH = re.compile(r"^/(?:shorts|embed|v|e|live)/([A-Za-z0-9_-]{11})(?:[/?#]|$)")
+_IG_HOSTS = re.compile(r"^(?:www\.|m\.)?instagram\.com$")
+_IG_PATH = re.compile(r"^/(?:[A-Za-z0-9._]+/)?(?:p|reels?|tv)/([A-Za-z0-9_-]{5,})(?:/|$)")
+_TT_HOSTS = re.compile(r"^(?:www\.|m\.)?tiktok\.com$")
+_TT_PATH = re.compile(r"^/(?:@[^/]+/(?:video|photo)|v|embed(?:/v2)?|share/video)/(\d{15,21})(?:\.html)?(?:/|$)")
+_TT_SHORT_HOSTS = re.compile(r"^(?:vm|vt)\.tiktok\.com$")
+_TT_SHORT_PATH = re.compile(r"^/([A-Za-z0-9]{5,16})/?$")
+_YT_LIST = re.compile(r"^[A-Za-z0-9_-]{10,64}$")
+_YT_CHANNEL_PATH = re.compile(r"^(/(?:@[A-Za-z0-9._-]{1,100}|channel/UC[A-Za-z0-9_-]{22}|(?:c|user)/[A-Za-z0-9._-]{1,100})"
+                              r"(?:/(?:videos|shorts|streams))?)/?$")
+
+
+class MediaRef(NamedTuple):
+    platform: str
+    id: str
+
+    @property
+    def key(self) -> str:
+        """Stable ``platform:id`` key for caches, dedupe and metrics."""
+        return f"{self.platform}:{self.id}"
+
+    @property
+    def url(self) -> str:
+        """Canonical URL for this item, free of tracking/time parameters."""
+        if self.platform == "youtube":
+            return f"https://www.youtube.com/watch?v={self.id}"
+        if self.platform == "instagram":
+            return f"https://www.instagram.com/p/{self.id}/"
+        if self.id.startswith("vm:"):
+            return f"https://vm.tiktok.com/{self.id[3:]}/"
+        return f"https://www.tiktok.com/@_/video/{self.id}"
+
+
+def _youtube(host: str, parts) -> Optional[str]:
+    if host == "youtu.be":
+        candidate = parts.path.strip("/").split("/")[0]
+        return candidate if _YT_ID.match(candidate) else None
+    if not _YT_HOSTS.match(host):
+        return None
+    if parts.path in ("/watch", "/watch/"):
+        candidate = parse_qs(parts.query).get("v", [""])[0]
+        return candidate if _YT_ID.match(candidate) else None
+    m = _YT_PATH.match(parts.path)
+    return m.group(1) if m else None
+
+
+@lru_cache(maxsize=4096)
+def parse(url: str) -> Optional[MediaRef]:
+    """Return the ``MediaRef`` for ``url`` or None if it isn't a supported
+    video link. A bare 11-character YouTube id is accepted as well."""
+    url = (url or "").strip()
+    if _YT_ID.match(url):
+        return MediaRef("youtube", url)
+    if "//" not in url:
+        url = "https://" + url
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or "").lower()
+    except ValueError:
+        return None
+    if parts.scheme not in ("http", "https"):
+        return None
+    video_id = _youtube(host, parts)
+    if video_id:
+        return MediaRef("youtube", video_id)
+    if _IG_HOSTS.match(host):
+        m = _IG_PATH.match(parts.path)
+        return MediaRef("instagram", m.group(1)) if m else None
+    if _TT_HOSTS.match(host):
+        m = _TT_PATH.match(parts.path)
+        return MediaRef("tiktok", m.group(1)) if m else None
+    if _TT_SHORT_HOSTS.match(host):
+        m = _TT_SHORT_PATH.match(parts.path)
+        return MediaRef("tiktok", "vm:" + m.group(1)) if m else None
+    return None
+
+
+def playlist(url: str) -> Optional[str]:
+    """Canonical URL for a YouTube playlist (``list=``) or channel link, or
+    None. Batch playlists are expanded by yt-dlp, so nothing else gets that
+    far."""
+    url = (url or "").strip()
+    if "//" not in url:
+        url = "https://" + url
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or "").lower()
+    except ValueError:
+        return None
+    if parts.scheme not in ("http", "https") or not _YT_HOSTS.match(host):
+        return None
+    list_id = parse_qs(parts.query).get("list", [""])[0]
+    if _YT_LIST.match(list_id):
+        return f"https://www.youtube.com/playlist?list={list_id}"
+    m = _YT_CHANNEL_PATH.match(parts.path)
+    return f"https://www.youtube.com{m.group(1)}" if m else None
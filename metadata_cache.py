@@ -0,0 +1,188 @@
+"""TTL'd, size-bounded caches for resolved extractor metadata.
+
+Resolving a video (pytubefix ``YouTube`` + ``streams``, yt-dlp
+``extract_info``) costs several upstream round trips before the first media
+byte. The resolved objects are kept here keyed by video id so a thumbnail,
+then a video, then an audio request for the same URL resolve it once.
+
+Entries never outlive the signed media URLs they carry: an entry expires
+SIGNED_URL_MARGIN seconds before the earliest ``expire`` stamp found in its
+stream URLs and is re-resolved on the next lookup.
+
+``get_direct`` keeps the final pick (one signed media URL per item and
+format) for ``mode=redirect``/``mode=resolve`` under the same rule.
+"""
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+from singleflight import Group
+from metrics import stage
+
+META_CACHE_TTL = float(os.getenv("META_CACHE_TTL", "1800"))
+META_CACHE_SIZE = int(os.getenv("META_CACHE_SIZE", "256"))
+SIGNED_URL_MARGIN = float(os.getenv("SIGNED_URL_MARGIN", "300"))
+
+
+class TTLCache:
+    """Thread-safe LRU map whose entries also carry their own deadline."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._stats["misses"] += 1
+                return default
+            value, expires_at = item
+            if expires_at <= now:
+                del self._data[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def set(self, key, value, expires_at=None):
+        if self.maxsize <= 0:
+            return
+        deadline = time.time() + self.ttl
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        with self._lock:
+            self._data[key] = (value, deadline)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._stats, size=len(self._data), maxsize=self.maxsize, ttl=self.ttl)
+        lookups = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / lookups, 4) if lookups else 0.0
+        return out
+
+
+def url_expiry(url):
+    """Best-effort expiry (epoch seconds) of a signed media URL, or None."""
+    if not url:
+        return None
+    q = parse_qs(urlparse(url).query)
+    for name in ("expire", "expires", "x-expires"):
+        if name in q:
+            try:
+                return float(q[name][0])
+            except ValueError:
+                pass
+    if "oe" in q:  # Instagram/Facebook CDN: hex epoch
+        try:
+            return float(int(q["oe"][0], 16))
+        except ValueError:
+            pass
+    return None
+
+
+def _earliest(urls):
+    stamps = [t for t in map(url_expiry, urls) if t]
+    return min(stamps) - SIGNED_URL_MARGIN if stamps else None
+
+
+youtube_cache = TTLCache(META_CACHE_SIZE, META_CACHE_TTL)
+ytdlp_cache = TTLCache(META_CACHE_SIZE, META_CACHE_TTL)
+direct_cache = TTLCache(META_CACHE_SIZE, META_CACHE_TTL)
+_extractions = Group()
+_MISSING = object()
+
+
+def _youtube_expiry(yt):
+    # Only inspect streams that were already resolved; never trigger a fetch.
+    streams = getattr(yt, "_fmt_streams", None) or ()
+    return _earliest(getattr(s, "url", None) for s in streams)
+
+
+# Striped locks so concurrent requests for one video don't race pytubefix's
+# lazy (and non-atomic) stream list construction on the shared object.
+_stripes = [threading.Lock() for _ in range(64)]
+
+
+def youtube_streams(yt):
+    with _stripes[hash(yt.video_id) % len(_stripes)]:
+        if getattr(yt, "_fmt_streams", None):
+            return yt.streams
+        with stage("youtube_resolve"):
+            return yt.streams
+
+
+def get_youtube(video_id: str, factory):
+    """Return a shared, possibly already-resolved ``factory()`` object
+    (pytubefix ``YouTube``) for ``video_id``."""
+    cached = youtube_cache.get(video_id)
+    if cached is not None:
+        expires_at = _youtube_expiry(cached)
+        if expires_at is None or expires_at > time.time():
+            return cached
+        # Signed stream URLs are about to lapse: resolve again
+        youtube_cache.pop(video_id)
+    yt = factory()  # lazy: no network until streams/title are read
+    youtube_cache.set(video_id, yt)
+    return yt
+
+
+def get_ytdlp_info(key: str, extract):
+    """Return a private copy of the cached ``extract()`` result for ``key``.
+    Callers get a deep copy because yt-dlp mutates info dicts while downloading."""
+    info = ytdlp_cache.get(key)
+    if info is None:
+        # Concurrent misses for one key share a single extraction
+        info = _extractions.do(key, lambda: _extract_and_store(key, extract))
+    return copy.deepcopy(info)
+
+
+def _extract_and_store(key: str, extract):
+    with stage("ytdlp_extract"):
+        info = extract()
+    formats = info.get("formats") or [info]
+    ytdlp_cache.set(key, info, expires_at=_earliest(f.get("url") for f in formats))
+    return info
+
+
+def get_direct(key: str, resolve):
+    """Return the cached ``resolve()`` result for ``key``: a dict with a
+    signed ``url`` (plus ``expires_at``), or None when the item has no single
+    directly fetchable URL. Both are kept until the URL is about to lapse."""
+    entry = direct_cache.get(key, _MISSING)
+    if entry is _MISSING:
+        entry = _extractions.do(("direct", key), lambda: _resolve_and_store(key, resolve))
+    return dict(entry) if entry else None
+
+
+def _resolve_and_store(key: str, resolve):
+    with stage("direct_resolve"):
+        entry = resolve()
+    expires_at = url_expiry(entry["url"]) if entry else None
+    if entry:
+        entry["expires_at"] = expires_at
+    direct_cache.set(key, entry, expires_at=expires_at - SIGNED_URL_MARGIN if expires_at else None)
+    return entry
+
+
+def stats() -> dict:
+    return {"youtube": youtube_cache.stats(), "ytdlp": dict(ytdlp_cache.stats(), shared_extractions=_extractions.shared),
+            "direct": direct_cache.stats()}
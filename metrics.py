@@ -0,0 +1,454 @@
+"""Prometheus text-format metrics, aggregated across gunicorn workers.
+
+Each worker keeps its counters, gauges and histograms in memory and
+snapshots them to ``METRICS_DIR/<pid>.json`` (every METRICS_FLUSH_INTERVAL
+seconds, and on every scrape of that worker). ``/_metrics`` on any worker
+merges every snapshot:
+
+* counters and histograms are summed over all workers, including ones
+  that exited (their last snapshot is folded into ``_dead.json``, so totals
+  never go backwards because a worker was recycled);
+* gauges are summed over live workers only;
+* "shared" gauges (disk usage of directories every worker shares) are
+  computed once by the scraping worker.
+
+``MetricsMiddleware`` times every request until its body is fully sent and
+counts the bytes actually streamed; it also opens and closes each request's
+trace (see ``tracing``). ``stage(name)`` times internal steps such as
+extraction, so resolve time can be told apart from transfer time.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import tracing
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "deetalk-metrics"))
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+# Seconds; downloads legitimately take minutes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_HELP = {
+    "deetalk_http_requests_total": ("counter", "Requests by route, method and status."),
+    "deetalk_http_request_duration_seconds": ("histogram", "Request time until the last body byte was sent."),
+    "deetalk_http_response_body_seconds": ("histogram", "Time spent streaming the response body (transfer)."),
+    "deetalk_http_response_bytes_total": ("counter", "Response body bytes sent to clients."),
+    "deetalk_http_in_flight": ("gauge", "Requests whose response body is still being sent."),
+    "deetalk_stage_duration_seconds": ("histogram", "Time spent in internal stages (extraction, downloads)."),
+    "deetalk_stage_errors_total": ("counter", "Internal stages that raised."),
+    "deetalk_cache_hits_total": ("counter", "Cache lookups answered from the cache."),
+    "deetalk_cache_misses_total": ("counter", "Cache lookups that had to go upstream."),
+    "deetalk_cache_evictions_total": ("counter", "Entries evicted to stay within a cache's bounds."),
+    "deetalk_jobs_queued": ("gauge", "Background jobs waiting for a worker."),
+    "deetalk_jobs_running": ("gauge", "Background jobs being run."),
+    "deetalk_singleflight_in_flight": ("gauge", "Downloads this worker is leading for other requests."),
+    "deetalk_admission_in_use": ("gauge", "Admitted requests per limited route still being served."),
+    "deetalk_admission_reserved_bytes": ("gauge", "Buffer memory reserved by admitted requests."),
+    "deetalk_admission_waiting": ("gauge", "Requests waiting for an admission slot."),
+    "deetalk_admission_rejected_total": ("counter", "Requests turned away with 503 by admission control."),
+    "deetalk_extractor_successes_total": ("counter", "Extractions a backend resolved."),
+    "deetalk_extractor_failures_total": ("counter", "Extractions a backend failed (counted against its health)."),
+    "deetalk_extractor_unavailable_total": ("counter", "Extractions that failed because the item is unavailable."),
+    "deetalk_extractor_hedges_total": ("counter", "Times a backend was started because another was slow."),
+    "deetalk_extractor_wins_total": ("counter", "Hedged extractions a backend answered first."),
+    "deetalk_extractor_demoted": ("gauge", "1 while a backend is ranked last after repeated failures."),
+    "deetalk_upstream_retries_total": ("counter", "Upstream calls retried after a transient failure."),
+    "deetalk_upstream_failures_total": ("counter", "Transient upstream failures (connection errors, timeouts, 429/5xx)."),
+    "deetalk_upstream_breaker_trips_total": ("counter", "Times a host's circuit breaker opened."),
+    "deetalk_upstream_short_circuits_total": ("counter", "Calls failed fast because the host's breaker was open."),
+    "deetalk_upstream_breaker_open": ("gauge", "Workers whose breaker for the host is open or half-open."),
+    "deetalk_scratch_committed_bytes": ("gauge", "Scratch bytes held or reserved by running downloads."),
+    "deetalk_scratch_dirs": ("gauge", "Scratch directories on disk."),
+    "deetalk_scratch_quota_bytes": ("gauge", "Scratch quota shared by all workers."),
+    "deetalk_scratch_rejected_total": ("counter", "Downloads refused because scratch space was full."),
+    "deetalk_scratch_reaped_total": ("counter", "Scratch directories removed by the janitor."),
+    "deetalk_ffmpeg_in_use": ("gauge", "FFmpeg slots this worker holds (merges and transcodes)."),
+    "deetalk_ffmpeg_waiting": ("gauge", "FFmpeg runs waiting for a slot."),
+    "deetalk_ffmpeg_completed_total": ("counter", "FFmpeg runs that finished."),
+    "deetalk_ffmpeg_failed_total": ("counter", "FFmpeg runs that failed or were cut short by the client."),
+    "deetalk_ffmpeg_rejected_total": ("counter", "FFmpeg runs refused because every slot stayed busy."),
+    "deetalk_ffmpeg_queue_seconds": ("histogram", "Time an FFmpeg run waited for a slot."),
+    "deetalk_ffmpeg_run_seconds": ("histogram", "Time a transcode held its FFmpeg slot."),
+    "deetalk_disk_usage_bytes": ("gauge", "Bytes on disk per scratch/cache area."),
+    "deetalk_disk_free_bytes": ("gauge", "Free bytes on the filesystem holding each area."),
+}
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._sources = []        # fn() -> [(type, name, labels, value)] per process
+        self._shared = []         # fn() -> [(name, labels, value)] computed at scrape
+        self._started = time.time()
+        self._flusher = None
+        self._last_flush = 0.0
+
+    # -- recording ---------------------------------------------------------
+    def inc(self, name: str, labels=None, value: float = 1):
+        k = (name, _key(labels))
+        with self._lock:
+            self._counters[k] = self._counters.get(k, 0) + value
+        self._ensure_flusher()
+
+    def gauge_add(self, name: str, labels=None, delta: float = 1):
+        k = (name, _key(labels))
+        with self._lock:
+            self._gauges[k] = self._gauges.get(k, 0) + delta
+        self._ensure_flusher()
+
+    def observe(self, name: str, labels, value: float, buckets=LATENCY_BUCKETS):
+        k = (name, _key(labels))
+        with self._lock:
+            h = self._histograms.get(k)
+            if h is None:
+                h = self._histograms[k] = {"buckets": list(buckets), "counts": [0] * len(buckets),
+                                           "sum": 0.0, "count": 0}
+            for i, bound in enumerate(h["buckets"]):
+                if value <= bound:
+                    h["counts"][i] += 1
+                    break
+            h["sum"] += value
+            h["count"] += 1
+        self._ensure_flusher()
+
+    def source(self, fn):
+        """Register ``fn() -> [(type, name, labels, value)]``: per-process
+        values read at snapshot time ("counter" is summed across all workers
+        ever, "gauge" across live ones)."""
+        self._sources.append(fn)
+        return fn
+
+    def shared(self, fn):
+        """Register ``fn() -> [(name, labels, value)]`` for gauges that are the
+        same from every worker (e.g. shared directory sizes)."""
+        self._shared.append(fn)
+        return fn
+
+    # -- snapshots ---------------------------------------------------------
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = [[n, dict(l), v] for (n, l), v in self._counters.items()]
+            gauges = [[n, dict(l), v] for (n, l), v in self._gauges.items()]
+            hists = [[n, dict(l), dict(h, counts=list(h["counts"]))] for (n, l), h in self._histograms.items()]
+        for fn in self._sources:
+            try:
+                for kind, name, labels, value in fn():
+                    (counters if kind == "counter" else gauges).append([name, labels or {}, value])
+            except Exception:
+                log.exception("metrics source %s failed", getattr(fn, "__name__", fn))
+        return {"pid": os.getpid(), "started": self._started, "counters": counters,
+                "gauges": gauges, "histograms": hists}
+
+    def flush(self):
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+            if not self._last_flush:
+                _retire_stale(path, self._started)
+            tmp = f"{path}.{uuid.uuid4().hex}.part"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+            self._last_flush = time.time()
+        except OSError:
+            log.warning("could not write metrics snapshot to %s", METRICS_DIR)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    # -- exposition --------------------------------------------------------
+    def render(self) -> str:
+        """Merge every worker's snapshot and render the Prometheus text format."""
+        self.flush()
+        counters, gauges, hists = {}, {}, {}
+        for snap, alive in _load_snapshots():
+            for name, labels, value in snap["counters"]:
+                k = (name, _key(labels))
+                counters[k] = counters.get(k, 0) + value
+            for name, labels, h in snap["histograms"]:
+                _merge_hist(hists, name, labels, h)
+            if alive:
+                for name, labels, value in snap["gauges"]:
+                    k = (name, _key(labels))
+                    gauges[k] = gauges.get(k, 0) + value
+        for fn in self._shared:
+            try:
+                for name, labels, value in fn():
+                    gauges[(name, _key(labels))] = value
+            except Exception:
+                log.exception("shared metrics %s failed", getattr(fn, "__name__", fn))
+
+        out = []
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({n for n, _ in series}):
+                out.append(_header(name, kind))
+                for (n, labels), value in sorted(series.items()):
+                    if n == name:
+                        out.append(f"{name}{_labels(labels)} {_num(value)}")
+        for name in sorted({n for n, _ in hists}):
+            out.append(_header(name, "histogram"))
+            for (n, labels), h in sorted(hists.items()):
+                if n != name:
+                    continue
+                running = 0
+                for bound, count in zip(h["buckets"], h["counts"]):
+                    running += count
+                    out.append(f"{name}_bucket{_labels(labels + (('le', _num(bound)),))} {running}")
+                out.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {h['count']}")
+                out.append(f"{name}_sum{_labels(labels)} {_num(h['sum'])}")
+                out.append(f"{name}_count{_labels(labels)} {h['count']}")
+        return "\n".join(out) + "\n"
+
+
+def _merge_hist(hists: dict, name: str, labels, h: dict):
+    k = (name, _key(labels))
+    cur = hists.get(k)
+    if cur is None:
+        hists[k] = {"buckets": list(h["buckets"]), "counts": list(h["counts"]), "sum": h["sum"], "count": h["count"]}
+        return
+    for i, count in enumerate(h["counts"]):
+        cur["counts"][i] += count
+    cur["sum"] += h["sum"]
+    cur["count"] += h["count"]
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def _dir_lock():
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(os.path.join(METRICS_DIR, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _read(path: str):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _fold_into_dead(snap: dict):
+    """Add an exited worker's counters and histograms to ``_dead.json``."""
+    dead_path = os.path.join(METRICS_DIR, "_dead.json")
+    dead = _read(dead_path) or {"pid": 0, "counters": [], "gauges": [], "histograms": []}
+    counters = {(n, _key(l)): v for n, l, v in dead["counters"]}
+    for n, l, v in snap["counters"]:
+        counters[(n, _key(l))] = counters.get((n, _key(l)), 0) + v
+    hists = {}
+    for n, l, h in dead["histograms"] + snap["histograms"]:
+        _merge_hist(hists, n, l, h)
+    dead["counters"] = [[n, dict(l), v] for (n, l), v in counters.items()]
+    dead["histograms"] = [[n, dict(l), h] for (n, l), h in hists.items()]
+    tmp = f"{dead_path}.{uuid.uuid4().hex}.part"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(dead, f)
+    os.replace(tmp, dead_path)
+
+
+def _retire_stale(path: str, started: float):
+    # A previous process with our pid left a snapshot behind
+    snap = _read(path)
+    if snap and snap.get("started") != started:
+        with _dir_lock():
+            _fold_into_dead(snap)
+            os.unlink(path)
+
+
+def _load_snapshots():
+    snaps = []
+    if not os.path.isdir(METRICS_DIR):
+        return snaps
+    with _dir_lock():
+        for name in os.listdir(METRICS_DIR):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(METRICS_DIR, name)
+            snap = _read(path)
+            if snap is None:
+                continue
+            if name == "_dead.json":
+                snaps.append((snap, False))
+            elif _alive(snap["pid"]):
+                snaps.append((snap, True))
+            else:
+                _fold_into_dead(snap)
+                os.unlink(path)
+                snaps.append((snap, False))
+    return snaps
+
+
+def _header(name: str, kind: str) -> str:
+    help_text = _HELP.get(name, (kind, name.replace("_", " ")))[1]
+    return f"# HELP {name} {help_text}\n# TYPE {name} {kind}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _num(value) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def dir_bytes(path: str) -> int:
+    """Total size of the files under ``path`` (0 if it doesn't exist)."""
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += dir_bytes(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue  # removed while we were walking
+    return total
+
+
+registry = Registry()
+
+
+def record_stage(name: str, started: float, seconds: float):
+    """Record a finished stage (``started`` is a perf_counter reading) in the
+    stage histogram and in the current request's trace."""
+    registry.observe("deetalk_stage_duration_seconds", {"stage": name}, seconds)
+    trace = tracing.current()
+    if trace is not None:
+        trace.add(name, started, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    """Time an internal step into deetalk_stage_duration_seconds{stage=name}
+    and the current request's trace."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        registry.inc("deetalk_stage_errors_total", {"stage": name})
+        raise
+    finally:
+        record_stage(name, started, time.perf_counter() - started)
+
+
+class _CountingBody:
+    def __init__(self, body, done):
+        self._body = body
+        self._done = done
+        self._bytes = 0
+        self._closed = False
+
+    def __iter__(self):
+        for chunk in self._body:
+            self._bytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self._body, "close", None)
+            if close:
+                close()
+        finally:
+            self._done(self._bytes)
+
+
+class MetricsMiddleware:
+    """WSGI wrapper recording per-route counts, latency, bytes and in-flight
+    bodies. The route label comes from ``environ["deetalk.route"]`` (the
+    matched URL rule, set by the app), so ids in paths don't explode it."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        trace = tracing.begin(environ)
+        started = trace.started
+        status = {}
+
+        def _start_response(code, headers, exc_info=None):
+            status["code"] = code.split(" ", 1)[0]
+            status["length"] = next((v for k, v in headers if k.lower() == "content-length"), None)
+            return start_response(code, headers, exc_info)
+
+        body = self.wsgi_app(environ, _start_response)
+        headers_done = time.perf_counter()
+        route = environ.get("deetalk.route", "unmatched")
+        labels = {"route": route}
+        registry.gauge_add("deetalk_http_in_flight", labels, 1)
+
+        def _done(sent: int):
+            now = time.perf_counter()
+            registry.gauge_add("deetalk_http_in_flight", labels, -1)
+            registry.inc("deetalk_http_requests_total",
+                         {"route": route, "method": environ.get("REQUEST_METHOD", ""), "status": status.get("code", "")})
+            registry.inc("deetalk_http_response_bytes_total", labels, sent)
+            registry.observe("deetalk_http_request_duration_seconds", labels, now - started)
+            registry.observe("deetalk_http_response_body_seconds", labels, now - headers_done)
+            tracing.finish(trace, route, status.get("code", ""), sent, headers_done)
+
+        if hasattr(body, "filelike"):
+            # Server file wrapper (sendfile): wrapping it would disable the
+            # zero-copy path, so count its declared length instead
+            _done(int(status.get("length") or 0))
+            return body
+        return _CountingBody(body, _done)
@@ -0,0 +1,184 @@
+"""Managed scratch space for yt-dlp downloads, FFmpeg merges and batches.
+
+Work directories live under SCRATCH_DIR instead of bare ``mkdtemp()``
+calls. Point it at a tmpfs (e.g. ``/dev/shm/deetalk-scratch``) to keep
+merges off the disk. They are released with ``shutil.rmtree`` like any
+temp dir. What this adds:
+
+* a quota: before it starts, a download reserves its estimated size
+  against SCRATCH_QUOTA. The quota is shared by every worker, and a
+  directory counts as the larger of its reservation and what it holds.
+  The reservation must also fit in the filesystem's free space minus
+  SCRATCH_MIN_FREE. If it doesn't fit, ``ScratchFull`` is raised (``503``)
+  instead of the merge failing halfway through with ENOSPC;
+* a janitor: every SCRATCH_JANITOR_INTERVAL seconds, each worker removes
+  directories whose owning process is gone (a crashed or killed worker),
+  and directories not modified for SCRATCH_MAX_AGE seconds (leaked
+  through a timeout or a disconnect).
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from metrics import dir_bytes
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", os.path.join(tempfile.gettempdir(), "deetalk-scratch"))
+# Bytes all workers' scratch dirs may hold together; 0 = only free space limits it
+SCRATCH_QUOTA = int(os.getenv("SCRATCH_QUOTA", str(4 * 1024 ** 3)))
+SCRATCH_MIN_FREE = int(os.getenv("SCRATCH_MIN_FREE", str(256 * 1024 ** 2)))
+# Reserved when a download's size can't be estimated up front
+SCRATCH_DEFAULT_RESERVE = int(os.getenv("SCRATCH_DEFAULT_RESERVE", str(512 * 1024 ** 2)))
+SCRATCH_MAX_AGE = float(os.getenv("SCRATCH_MAX_AGE", "21600"))
+SCRATCH_JANITOR_INTERVAL = float(os.getenv("SCRATCH_JANITOR_INTERVAL", "60"))
+SCRATCH_RETRY_AFTER = int(os.getenv("SCRATCH_RETRY_AFTER", "30"))
+
+_MARKER = ".scratch.json"  # owner pid and reservation; dotfile so globs skip it
+
+
+class ScratchFull(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.retry_after = SCRATCH_RETRY_AFTER
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Scratch:
+    def __init__(self, root: str, quota: int, min_free: int):
+        self.root = root
+        self.quota = quota
+        self.min_free = min_free
+        self._lock = threading.Lock()
+        self._janitor = None
+        self._counts = {"allocated": 0, "rejected": 0, "reaped_orphan": 0, "reaped_expired": 0}
+
+    @contextmanager
+    def _locked(self):
+        # Check-and-create is atomic across threads and workers
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(os.path.join(self.root, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def _entries(self):
+        """(path, marker or None) for every scratch dir."""
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return []
+        out = []
+        for name in names:
+            path = os.path.join(self.root, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                with open(os.path.join(path, _MARKER), "r", encoding="utf-8") as f:
+                    marker = json.load(f)
+            except (OSError, ValueError):
+                marker = None
+            out.append((path, marker))
+        return out
+
+    def usage(self) -> dict:
+        used = committed = dirs = 0
+        for path, marker in self._entries():
+            size = dir_bytes(path)
+            used += size
+            committed += max(size, (marker or {}).get("reserved", 0))
+            dirs += 1
+        return {"used_bytes": used, "committed_bytes": committed, "dirs": dirs}
+
+    def allocate(self, reserve: int, prefix: str = "dl-") -> str:
+        """A fresh scratch dir with ``reserve`` bytes set aside for it.
+        Raises ScratchFull when the quota or the disk can't take it."""
+        os.makedirs(self.root, exist_ok=True)
+        self._ensure_janitor()
+        with self._locked():
+            committed = self.usage()["committed_bytes"]
+            free = shutil.disk_usage(self.root).free
+            # A download bigger than the whole quota still runs, alone
+            if self.quota and committed and committed + reserve > self.quota:
+                self._counts["rejected"] += 1
+                raise ScratchFull(f"Scratch space is full ({committed} of {self.quota} bytes committed)")
+            if reserve + self.min_free > free:
+                self._counts["rejected"] += 1
+                raise ScratchFull(f"Not enough free disk for {reserve} bytes of scratch")
+            path = tempfile.mkdtemp(prefix=f"{prefix}{os.getpid()}-", dir=self.root)
+            with open(os.path.join(path, _MARKER), "w", encoding="utf-8") as f:
+                json.dump({"pid": os.getpid(), "reserved": int(reserve), "created": time.time()}, f)
+            self._counts["allocated"] += 1
+        return path
+
+    def reap(self) -> int:
+        """Remove orphaned and expired dirs; returns how many went."""
+        now, removed = time.time(), 0
+        for path, marker in self._entries():
+            pid = (marker or {}).get("pid")
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+            if pid and pid != os.getpid() and not _alive(pid):
+                reason = "orphan"
+            elif age > SCRATCH_MAX_AGE:
+                reason = "expired"
+            else:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            self._counts[f"reaped_{reason}"] += 1
+            removed += 1
+            log.info("scratch: reaped %s dir %s", reason, os.path.basename(path))
+        return removed
+
+    def _ensure_janitor(self):
+        if self._janitor is not None or SCRATCH_JANITOR_INTERVAL <= 0:
+            return
+        with self._lock:
+            if self._janitor is None:
+                self._janitor = threading.Thread(target=self._janitor_loop, name="scratch-janitor", daemon=True)
+                self._janitor.start()
+
+    def _janitor_loop(self):
+        while True:
+            try:
+                self.reap()
+            except Exception:
+                log.exception("scratch janitor failed")
+            time.sleep(SCRATCH_JANITOR_INTERVAL)
+
+    def counters(self) -> dict:
+        return dict(self._counts)
+
+    def stats(self) -> dict:
+        return dict(self.usage(), root=self.root, quota_bytes=self.quota, min_free_bytes=self.min_free,
+                    **self.counters())
+
+
+scratch = Scratch(SCRATCH_DIR, SCRATCH_QUOTA, SCRATCH_MIN_FREE)
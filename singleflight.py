@@ -0,0 +1,393 @@
+"""Request coalescing: one upstream fetch per (platform, id, format) at a time.
+
+``Group`` is the classic in-process single-flight for calls that return a
+value (metadata extraction).
+
+``shared_stream`` coalesces byte streams across threads *and* gunicorn
+workers. The first caller for a key takes an exclusive ``flock`` on
+``<spool>/<hash>.lock`` and runs the upstream fetch in a background thread,
+writing to a spool file; every caller (the leader's own client included)
+tails that file, so N concurrent clients cost one upstream transfer and the
+fetch survives any single client disconnecting. On completion the spool file
+is handed to ``on_complete`` (the media cache) so later requests hit disk.
+
+``run_once`` is the same election for fetches that produce a finished file
+(yt-dlp): followers wait for the leader and then pick up its result, from
+the cache or from a link the leader hands them.
+
+Without fcntl (Windows dev boxes) coalescing is limited to one process.
+"""
+import os
+import json
+import time
+import uuid
+import glob
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+COALESCE_DOWNLOADS = os.getenv("COALESCE_DOWNLOADS", "1") not in ("0", "false", "no")
+SPOOL_DIR = os.getenv("SPOOL_DIR", os.path.join(tempfile.gettempdir(), "deetalk-spool"))
+SPOOL_POLL_INTERVAL = float(os.getenv("SPOOL_POLL_INTERVAL", "0.05"))
+# Followers give up when the spool hasn't grown for this long
+SPOOL_STALL_TIMEOUT = float(os.getenv("SPOOL_STALL_TIMEOUT", "60"))
+# How long run_once waiters wait for the leader's download (yt-dlp + merge)
+COALESCE_WAIT_TIMEOUT = float(os.getenv("COALESCE_WAIT_TIMEOUT", "900"))
+READ_SIZE = 256 * 1024
+
+
+class Group:
+    """In-process single-flight: concurrent ``do(key, fn)`` calls share one ``fn()``."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Lead:
+    """Exclusive per-key leadership: a flock for other workers plus an
+    in-process registry (flock also conflicts between threads, but the
+    registry keeps the check cheap and works where fcntl doesn't exist)."""
+
+    _local = set()
+    _local_lock = threading.Lock()
+
+    def __init__(self, base: str):
+        self.base = base
+        self.fd = None
+
+    def acquire(self) -> bool:
+        with self._local_lock:
+            if self.base in self._local:
+                return False
+            if fcntl is not None:
+                fd = os.open(self.base + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    os.close(fd)
+                    return False
+                self.fd = fd
+            self._local.add(self.base)
+            return True
+
+    def release(self):
+        with self._local_lock:
+            self._local.discard(self.base)
+            if self.fd is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                os.close(self.fd)
+                self.fd = None
+
+    @classmethod
+    def busy(cls, base: str) -> bool:
+        if base in cls._local:
+            return True
+        if fcntl is None:
+            return False
+        try:
+            fd = os.open(base + ".lock", os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return False
+        except OSError:
+            return True
+        finally:
+            os.close(fd)
+
+
+_stats_lock = threading.Lock()
+_stats = {"leaders": 0, "followers": 0, "waiters": 0, "failures": 0}
+
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def stats() -> dict:
+    with _stats_lock:
+        out = dict(_stats)
+    out["in_flight"] = len(_Lead._local)
+    return out
+
+
+def _base(key: str) -> str:
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    return os.path.join(SPOOL_DIR, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+
+def _write_state(base: str, state: dict):
+    tmp = f"{base}.state.{uuid.uuid4().hex}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, base + ".state")
+
+
+def _read_state(base: str) -> dict:
+    try:
+        with open(base + ".state", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _produce(lead: _Lead, part_path: str, flight: str, chunks, on_complete):
+    base = lead.base
+    written = 0
+    try:
+        with open(part_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                f.flush()  # followers read through their own descriptors
+                written += len(chunk)
+        _write_state(base, {"flight": flight, "status": "done", "size": written})
+        kept = False
+        if on_complete:
+            try:
+                kept = bool(on_complete(part_path))
+            except Exception:
+                log.exception("spool completion hook failed for %s", os.path.basename(base))
+        if not kept and os.path.exists(part_path):
+            os.unlink(part_path)  # open follower descriptors keep reading
+    except Exception:
+        log.exception("coalesced upstream fetch failed")
+        _count("failures")
+        _write_state(base, {"flight": flight, "status": "failed", "size": written})
+        try:
+            os.unlink(part_path)
+        except OSError:
+            pass
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+        lead.release()
+
+
+def _follow(base: str, flight: str, f, length=None):
+    pos = 0
+    last_progress = time.monotonic()
+    try:
+        while True:
+            data = f.read(READ_SIZE)
+            if data:
+                pos += len(data)
+                last_progress = time.monotonic()
+                yield data
+                continue
+            state = _read_state(base)
+            if state.get("flight") == flight and state.get("status") == "done":
+                # Final bytes may have landed after our last read
+                for data in iter(lambda: f.read(READ_SIZE), b""):
+                    pos += len(data)
+                    yield data
+                if pos < state.get("size", 0):
+                    raise IOError("coalesced download truncated")
+                return
+            if state.get("flight") == flight and state.get("status") == "failed":
+                raise IOError("coalesced upstream fetch failed")
+            if state.get("flight") != flight or not _Lead.busy(base):
+                # Our flight is gone (a newer one started, or the leader died)
+                if length and pos >= length:
+                    return
+                raise IOError("coalesced upstream fetch ended early")
+            if time.monotonic() - last_progress > SPOOL_STALL_TIMEOUT:
+                raise IOError("coalesced upstream fetch stalled")
+            time.sleep(SPOOL_POLL_INTERVAL)
+    finally:
+        f.close()
+
+
+def _attach(base: str):
+    state = _read_state(base)
+    flight = state.get("flight")
+    if not flight or state.get("status") != "running":
+        return None, None
+    try:
+        return flight, open(f"{base}.{flight}.part", "rb")
+    except OSError:
+        return None, None
+
+
+def shared_stream(key: str, chunks, length=None, on_complete=None, lookup=None):
+    """Yield the bytes of ``chunks`` while coalescing with every other caller
+    for ``key``. ``chunks`` is only consumed if this caller becomes leader.
+    ``on_complete(path)`` may take ownership of the finished spool file by
+    returning True; ``lookup()`` returns a finished file path (e.g. a media
+    cache entry) for callers that arrive just after a flight completed.
+
+    Nothing happens until the first byte is asked for, so a response whose
+    body is never read (HEAD) starts no upstream fetch."""
+    try:
+        body = _join(key, chunks, length, on_complete, lookup)
+    except BaseException:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+        raise
+    yield from body
+
+
+def _join(key: str, chunks, length, on_complete, lookup):
+    base = _base(key)
+    deadline = time.monotonic() + SPOOL_STALL_TIMEOUT
+    while True:
+        lead = _Lead(base)
+        if lead.acquire():
+            _count("leaders")
+            flight = uuid.uuid4().hex
+            part_path = f"{base}.{flight}.part"
+            try:
+                open(part_path, "wb").close()
+                f = open(part_path, "rb")
+                _write_state(base, {"flight": flight, "status": "running"})
+            except Exception:
+                lead.release()
+                raise
+            threading.Thread(target=_produce, args=(lead, part_path, flight, chunks, on_complete),
+                             name=f"spool-{flight[:8]}", daemon=True).start()
+            return _follow(base, flight, f, length)
+
+        flight, f = _attach(base)
+        if f is not None:
+            _count("followers")
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+            return _follow(base, flight, f, length)
+
+        path = lookup() if lookup else None
+        if path:
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+            return _read_file(path)
+        if time.monotonic() > deadline:
+            raise IOError("could not attach to in-flight download")
+        # Leader is between taking the lock and publishing its state
+        time.sleep(SPOOL_POLL_INTERVAL)
+
+
+def _read_file(path: str):
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                return
+            yield data
+
+
+def _hand_over(base: str, path: str) -> int:
+    """Give every registered waiter its own link (or copy) of ``path``."""
+    given = 0
+    for wait_dir in glob.glob(base + ".wait-*"):
+        dest = os.path.join(wait_dir, os.path.basename(path))
+        try:
+            try:
+                os.link(path, dest)
+            except OSError:
+                shutil.copyfile(path, dest)  # spool and scratch on different filesystems
+            given += 1
+        except OSError:
+            log.warning("could not hand coalesced result to %s", os.path.basename(wait_dir))
+    return given
+
+
+def run_once(key: str, fn, lookup):
+    """Run ``fn()`` unless another thread/worker is already producing ``key``;
+    in that case wait for it and share its result. ``fn`` returns
+    ``(path, download_name, temp_dir)``.
+
+    A waiter registers a private directory first. When the leader's file
+    didn't go into the cache (too big, cache off), the leader links it
+    into every such directory, so each waiter gets a copy it owns (returned
+    as its ``temp_dir``) instead of downloading again. A leader error is
+    raised in the waiters too. Waiters give up after COALESCE_WAIT_TIMEOUT."""
+    base = _base(key)
+    lead = _Lead(base)
+    if lead.acquire():
+        _count("leaders")
+        flight = uuid.uuid4().hex
+        _write_state(base, {"flight": flight, "status": "running"})
+        try:
+            result = fn()
+        except Exception as e:
+            _write_state(base, {"flight": flight, "status": "failed", "error": f"{type(e).__name__}: {e}"[:500]})
+            lead.release()
+            raise
+        except BaseException:
+            lead.release()
+            raise
+        path, name, temp_dir = result
+        try:
+            given = _hand_over(base, path) if temp_dir else 0
+            _write_state(base, {"flight": flight, "status": "done", "name": name,
+                                "file": os.path.basename(path), "handed_over": given})
+        finally:
+            lead.release()
+        return result
+
+    _count("waiters")
+    wait_dir = tempfile.mkdtemp(prefix=os.path.basename(base) + ".wait-", dir=SPOOL_DIR)
+    deadline = time.monotonic() + COALESCE_WAIT_TIMEOUT
+    try:
+        while _Lead.busy(base):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"gave up waiting {COALESCE_WAIT_TIMEOUT:.0f} s for a coalesced download")
+            time.sleep(SPOOL_POLL_INTERVAL)
+        state = _read_state(base)
+        if state.get("status") == "failed":
+            raise IOError(f"coalesced download failed: {state.get('error')}")
+        if state.get("status") == "done" and state.get("file"):
+            path = os.path.join(wait_dir, state["file"])
+            if os.path.exists(path):
+                return path, state["name"], wait_dir
+    except BaseException:
+        shutil.rmtree(wait_dir, ignore_errors=True)
+        raise
+    shutil.rmtree(wait_dir, ignore_errors=True)
+    # Cached by the leader (or registered too late for a hand-over)
+    return lookup() or fn()
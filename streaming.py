@@ -0,0 +1,409 @@
+"""Chunked response helpers shared by the download routes.
+
+Bytes are forwarded to the client as they arrive from upstream instead of
+being collected in a BytesIO first, so per-request memory stays at roughly
+one chunk and the first byte leaves as soon as upstream produces it.
+
+Range requests are translated into upstream range fetches, so a resumed
+download only pulls the missing bytes from the origin.
+
+googlevideo throttles each connection, so large YouTube bodies are split
+into PARALLEL_SEGMENT_SIZE ranges fetched over up to PARALLEL_CONNECTIONS
+pooled connections at once and reassembled in order while streaming.
+
+Every upstream request is opened through ``upstream.call`` (retries and
+per-host circuit breakers); failures after the first byte are resumed by
+the segment fetchers instead.
+"""
+import os
+import time
+import logging
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlparse, parse_qs
+
+from flask import Response, request, stream_with_context
+from werkzeug.http import parse_range_header
+
+import upstream
+
+from lazy_imports import lazy_module
+
+requests = lazy_module("requests")
+
+log = logging.getLogger(__name__)
+
+# pytubefix fetches googlevideo in ranges of this size; one range is the most
+# we ever hold in memory per request.
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(1024 * 1024)))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "15"))
+# Concurrent upstream connections per download (1 = sequential) and the
+# range each one fetches; memory per download is about their product.
+PARALLEL_CONNECTIONS = int(os.getenv("PARALLEL_CONNECTIONS", "4"))
+PARALLEL_SEGMENT_SIZE = int(os.getenv("PARALLEL_SEGMENT_SIZE", str(4 * 1024 * 1024)))
+# Segment fetchers shared by all downloads in this worker
+PARALLEL_POOL_SIZE = int(os.getenv("PARALLEL_POOL_SIZE", "32"))
+SEGMENT_RETRIES = int(os.getenv("SEGMENT_RETRIES", "3"))
+
+_session = None
+_session_lock = threading.Lock()
+_segment_pool = ThreadPoolExecutor(max_workers=PARALLEL_POOL_SIZE, thread_name_prefix="segment")
+
+
+def http_session():
+    """Keep-alive pool for all upstream media fetches (default headers mirror
+    pytubefix). Built on first use so importing this module stays cheap."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.headers.update({"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"})
+                adapter = requests.adapters.HTTPAdapter(pool_connections=16,
+                                                        pool_maxsize=max(PARALLEL_POOL_SIZE, 10))
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def safe_title(title: str) -> str:
+    return "".join(c for c in (title or "") if c.isalnum() or c in (' ', '_')).rstrip().replace(' ', '_')
+
+
+def attachment_headers(download_name: str) -> dict:
+    # Same encoding rules as flask.send_file: ASCII fallback + RFC 5987 name
+    try:
+        download_name.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name).encode("ascii", "ignore").decode("ascii")
+        quoted = quote(download_name, safe="!#$&+-.^_`|~")
+        value = f"attachment; filename=\"{simple}\"; filename*=UTF-8''{quoted}"
+    else:
+        value = f"attachment; filename=\"{download_name}\""
+    return {"Content-Disposition": value}
+
+
+def _guarded(chunks, label: str):
+    # Headers are already on the wire once the first chunk goes out, so an
+    # upstream failure can only be logged and the body cut short.
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+    except GeneratorExit:
+        log.info("%s: client went away", label)
+        raise
+    except Exception:
+        log.exception("%s: upstream failed mid-stream", label)
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+
+
+class _ClosingBody:
+    # Passthrough bodies go to the server as-is, so Response.call_on_close
+    # never runs; the server does call close() on the body itself.
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+
+    def __iter__(self):
+        return iter(self._body)
+
+    def close(self):
+        try:
+            self._body.close()
+        finally:
+            self._on_close()
+
+
+def stream_response(chunks, mimetype: str, download_name, length=None, label: str = "stream",
+                    status: int = 200, on_close=None) -> Response:
+    """Stream ``chunks``; ``download_name`` None sends the body inline.
+    ``on_close`` runs when the server closes the body, read or not."""
+    body = stream_with_context(_guarded(chunks, label))
+    if on_close:
+        body = _ClosingBody(body, on_close)
+    resp = Response(
+        body,
+        status=status,
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
+    if download_name:
+        resp.headers.update(attachment_headers(download_name))
+    if length:
+        resp.headers["Content-Length"] = str(length)
+    # Ask nginx-style proxies not to buffer the whole body before relaying it
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+def iter_media(url: str, length=None, headers=None, range_param: bool = False):
+    """The whole body of ``url``, in parallel segments when it's big enough."""
+    if not length:
+        return iter_url(url, headers)
+    return iter_media_range(url, 0, length - 1, headers, range_param)
+
+
+def pytube_filesize(stream):
+    try:
+        return stream.filesize or None
+    except Exception:
+        log.warning("could not determine filesize for itag %s", getattr(stream, "itag", "?"))
+        return None
+
+
+def requested_range(length, etag=None):
+    """Return ``(start, end)`` (inclusive) for a satisfiable single Range,
+    None to serve the whole body, or ``False`` when the range is out of bounds."""
+    if not length or "Range" not in request.headers:
+        return None
+    if_range = request.if_range
+    if if_range.date or (if_range.etag and if_range.etag != (etag or "").strip('"')):
+        # Representation changed (or can't be validated): send it all again
+        return None
+    parsed = parse_range_header(request.headers.get("Range"))
+    if parsed is None or len(parsed.ranges) != 1:
+        # Malformed or multipart ranges: a full 200 is always a valid answer
+        return None
+    bounds = parsed.range_for_length(length)
+    if bounds is None:
+        return False
+    return bounds[0], bounds[1] - 1
+
+
+def ranged_stream_response(open_chunks, mimetype: str, download_name: str, length=None,
+                           etag=None, label: str = "stream") -> Response:
+    """Serve ``open_chunks(rng)`` with Range support; ``rng`` is None for the
+    full body or an inclusive ``(start, end)`` tuple for a partial one."""
+    rng = requested_range(length, etag)
+    if rng is False:
+        resp = Response(status=416)
+        resp.headers["Content-Range"] = f"bytes */{length}"
+        resp.headers["Accept-Ranges"] = "bytes"
+        return resp
+    # HEAD gets the same headers without opening the body at all
+    head = request.method == "HEAD"
+    if rng is None:
+        resp = stream_response(iter(()) if head else open_chunks(None), mimetype, download_name,
+                               length=length, label=label)
+    else:
+        start, end = rng
+        resp = stream_response(iter(()) if head else open_chunks(rng), mimetype, download_name,
+                               length=end - start + 1, label=label, status=206)
+        resp.headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    if length:
+        resp.headers["Accept-Ranges"] = "bytes"
+    if etag:
+        resp.set_etag(etag.strip('"'))
+    return resp
+
+
+def _open_range(url: str, start: int, stop: int, headers=None, range_param: bool = False):
+    """GET bytes ``start..stop`` (inclusive) of ``url`` as a streamed response.
+    googlevideo takes the range as a query parameter (``range_param``);
+    everything else gets a Range header."""
+    if range_param:
+        sep = "&" if "?" in url else "?"
+        target, hdrs = f"{url}{sep}range={start}-{stop}", headers
+    else:
+        target, hdrs = url, {**(headers or {}), "Range": f"bytes={start}-{stop}"}
+
+    def _get():
+        r = http_session().get(target, headers=hdrs, stream=True, timeout=UPSTREAM_TIMEOUT)
+        try:
+            r.raise_for_status()
+            if not range_param and start and r.status_code != 206:
+                raise IOError(f"upstream ignored range {start}-{stop}")
+        except Exception:
+            r.close()
+            raise
+        return r
+    return upstream.call(url, _get)
+
+
+def iter_url_range(url: str, start: int, end: int, headers=None, range_param: bool = False):
+    """Yield bytes ``start..end`` (inclusive) of ``url``, one upstream request
+    per STREAM_CHUNK_SIZE window."""
+    pos = start
+    while pos <= end:
+        stop = min(pos + STREAM_CHUNK_SIZE, end + 1) - 1
+        before = pos
+        with _open_range(url, pos, stop, headers, range_param) as r:
+            for chunk in r.iter_content(64 * 1024):
+                # An upstream that ignores the range (a 200 for start 0) sends
+                # more than asked; never pass on bytes past the window
+                chunk = chunk[:stop + 1 - pos]
+                pos += len(chunk)
+                yield chunk
+                if pos > stop:
+                    break
+        if pos == before:
+            raise IOError(f"upstream returned no data for range {pos}-{stop}")
+
+
+class _Segment:
+    """One byte range being fetched by the pool; the consumer reads its
+    chunks as they land, so the head segment streams without waiting."""
+
+    def __init__(self, start: int, end: int):
+        self.start, self.end = start, end
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.future = None
+        self.cond = threading.Condition()
+
+    def fetch(self, url, headers, range_param, cancelled):
+        pos, attempt = self.start, 0
+        try:
+            while pos <= self.end and not cancelled.is_set():
+                try:
+                    with _open_range(url, pos, self.end, headers, range_param) as r:
+                        for chunk in r.iter_content(64 * 1024):
+                            if cancelled.is_set():
+                                return
+                            chunk = chunk[:self.end + 1 - pos]
+                            pos += len(chunk)
+                            with self.cond:
+                                self.chunks.append(chunk)
+                                self.cond.notify()
+                            if pos > self.end:
+                                break
+                    if pos <= self.end:
+                        raise IOError(f"upstream closed range {pos}-{self.end} early")
+                except upstream.CircuitOpen:
+                    raise
+                except Exception:
+                    # Resume from the first missing byte; what was read stays
+                    attempt += 1
+                    if attempt > SEGMENT_RETRIES:
+                        raise
+                    log.warning("segment %s-%s failed at %s, retry %s/%s",
+                                self.start, self.end, pos, attempt, SEGMENT_RETRIES)
+                    time.sleep(min(0.25 * 2 ** attempt, 4))
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify()
+
+    def drain(self):
+        while True:
+            with self.cond:
+                while not self.chunks and not self.done:
+                    self.cond.wait()
+                ready, self.chunks = self.chunks, []
+                finished = self.done
+            yield from ready
+            if finished:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+def iter_parallel_range(url: str, start: int, end: int, headers=None, range_param: bool = False,
+                        connections=None, segment_size=None):
+    """Yield bytes ``start..end`` (inclusive) of ``url`` in order while up to
+    ``connections`` PARALLEL_SEGMENT_SIZE ranges download concurrently.
+    Each segment retries SEGMENT_RETRIES times from where it stopped."""
+    connections = connections or PARALLEL_CONNECTIONS
+    segment_size = segment_size or PARALLEL_SEGMENT_SIZE
+    bounds = [(s, min(s + segment_size, end + 1) - 1) for s in range(start, end + 1, segment_size)]
+    cancelled = threading.Event()
+    window = []
+
+    def _submit(i):
+        seg = _Segment(*bounds[i])
+        seg.future = _segment_pool.submit(seg.fetch, url, headers, range_param, cancelled)
+        window.append(seg)
+
+    try:
+        nxt = 0
+        while nxt < len(bounds) and len(window) < connections:
+            _submit(nxt)
+            nxt += 1
+        while window:
+            seg = window.pop(0)
+            if nxt < len(bounds):
+                _submit(nxt)
+                nxt += 1
+            yield from seg.drain()
+    finally:
+        # Client went away or a segment gave up: stop the rest of the window
+        cancelled.set()
+        for seg in window:
+            seg.future.cancel()
+
+
+def iter_url(url: str, headers=None):
+    """Yield the whole body of ``url`` over one pooled connection."""
+    def _get():
+        r = http_session().get(url, headers=headers, stream=True, timeout=UPSTREAM_TIMEOUT)
+        if r.status_code >= 400:
+            r.close()
+            r.raise_for_status()
+        return r
+    with upstream.call(url, _get) as r:
+        yield from r.iter_content(64 * 1024)
+
+
+def iter_media_range(url: str, start: int, end: int, headers=None, range_param: bool = False):
+    if PARALLEL_CONNECTIONS > 1 and end - start + 1 > PARALLEL_SEGMENT_SIZE:
+        return iter_parallel_range(url, start, end, headers=headers, range_param=range_param)
+    return iter_url_range(url, start, end, headers=headers, range_param=range_param)
+
+
+def probe_length(url: str, headers=None):
+    try:
+        def _head():
+            r = http_session().head(url, headers=headers, allow_redirects=True, timeout=UPSTREAM_TIMEOUT)
+            r.raise_for_status()
+            return r
+        return int(upstream.call(url, _head).headers["Content-Length"]) or None
+    except Exception:
+        log.warning("could not probe length of %s", urlparse(url).netloc)
+        return None
+
+
+def media_etag(url: str, itag, length) -> str:
+    # lmt is the media's last-modified stamp, stable across re-signed URLs
+    try:
+        lmt = parse_qs(urlparse(url).query).get("lmt", [""])[0]
+    except Exception:
+        lmt = ""
+    return f"{itag}-{lmt}-{length or 0}"
+
+
+def pytube_etag(stream, length) -> str:
+    return media_etag(stream.url, stream.itag, length)
+
+
+def media_response(url: str, mimetype: str, download_name: str, length=None, etag=None, headers=None,
+                   range_param: bool = False, label: str = "stream", on_full=None) -> Response:
+    """Proxy ``url`` with Range support. ``on_full(chunks, length, etag)`` may
+    wrap the full-body iterator, e.g. to tee it into the media cache;
+    partial bodies are never wrapped."""
+    upstream.check(url)
+    length = length or probe_length(url, headers)
+
+    def _open(rng):
+        if rng is None:
+            chunks = iter_media(url, length, headers, range_param)
+            return on_full(chunks, length, etag) if on_full else chunks
+        return iter_media_range(url, *rng, headers=headers, range_param=range_param)
+
+    return ranged_stream_response(_open, mimetype, download_name, length=length,
+                                  etag=etag, label=label)
+
+
+def pytube_response(stream, mimetype: str, download_name: str, label: str = "stream",
+                    on_full=None) -> Response:
+    length = pytube_filesize(stream)
+    return media_response(stream.url, mimetype, download_name, length=length, etag=pytube_etag(stream, length),
+                          range_param=True, label=label, on_full=on_full)
@@ -0,0 +1,123 @@
+"""YouTube thumbnails without extraction.
+
+Thumbnail URLs can be derived from the video id
+(``i.ytimg.com/vi/<id>/<variant>.jpg``), so no ``YouTube()`` resolve is
+needed. A missing variant (not every video has ``maxresdefault``) falls
+back to the next smaller one. Missing variants are remembered for a while.
+Images are fetched over the shared keep-alive session and kept in their
+own on-disk LRU, separate from media so large videos can't evict them.
+"""
+import os
+import uuid
+import hashlib
+import logging
+from typing import NamedTuple, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from media_cache import MediaCache, MEDIA_CACHE_DIR
+from metadata_cache import TTLCache
+from singleflight import Group
+import upstream
+from metrics import stage
+from streaming import http_session, UPSTREAM_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+THUMB_CACHE_DIR = os.getenv("THUMB_CACHE_DIR", os.path.join(MEDIA_CACHE_DIR, "thumbs"))
+# 0 disables the on-disk thumbnail cache
+THUMB_CACHE_MAX_BYTES = int(os.getenv("THUMB_CACHE_MAX_BYTES", str(128 * 1024 ** 2)))
+# Cache-Control max-age for thumbnail responses
+THUMB_MAX_AGE = int(os.getenv("THUMB_MAX_AGE", "86400"))
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "8"))
+
+# Largest first; a request for one variant may be answered by a smaller one
+VARIANTS = ("maxres", "sd", "hq", "mq", "default")
+_FILES = {"maxres": "maxresdefault.jpg", "sd": "sddefault.jpg", "hq": "hqdefault.jpg",
+          "mq": "mqdefault.jpg", "default": "default.jpg"}
+
+thumb_cache = MediaCache(THUMB_CACHE_DIR, THUMB_CACHE_MAX_BYTES)
+_missing = TTLCache(4096, 3600)
+_fetches = Group()
+_pool = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix="thumb")
+
+
+class Thumbnail(NamedTuple):
+    variant: str
+    mimetype: str
+    etag: str
+    path: Optional[str] = None   # cached file, or
+    data: Optional[bytes] = None  # the bytes themselves when the cache is off
+
+
+def _download(key: str, url: str, variant: str):
+    with stage("thumbnail_fetch"):
+        r = upstream.call(url, lambda: upstream.check_status(http_session().get(url, timeout=UPSTREAM_TIMEOUT)))
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    data = r.content
+    mimetype = r.headers.get("Content-Type", "image/jpeg").split(";")[0]
+    etag = hashlib.sha1(data).hexdigest()[:20]
+    if thumb_cache.enabled:
+        tmp = os.path.join(THUMB_CACHE_DIR, f".{uuid.uuid4().hex}.part")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        path = thumb_cache.put_file(key, tmp, f"{variant}.jpg", mimetype, etag)
+        if path:
+            return Thumbnail(variant, mimetype, etag, path=path)
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return Thumbnail(variant, mimetype, etag, data=data)
+
+
+def _get_variant(video_id: str, variant: str, url=None):
+    key = MediaCache.key("youtube", video_id, f"thumb:{variant}")
+    hit = thumb_cache.get(key)
+    if hit:
+        return Thumbnail(variant, hit.mimetype, hit.etag, path=hit.path)
+    if _missing.get(key):
+        return None
+    url = url or f"https://i.ytimg.com/vi/{video_id}/{_FILES[variant]}"
+    thumb = _fetches.do(key, lambda: _download(key, url, variant))
+    if thumb is None:
+        _missing.set(key, True)
+    return thumb
+
+
+def get(video_id: str, variant: str = "maxres", fallback_url=None):
+    """Best available thumbnail at or below ``variant``, or None.
+    ``fallback_url()`` (usually a full extraction) is only consulted when
+    none of the derived URLs exist."""
+    for candidate in VARIANTS[VARIANTS.index(variant):]:
+        thumb = _get_variant(video_id, candidate)
+        if thumb:
+            return thumb
+    url = fallback_url() if fallback_url else None
+    return _get_variant(video_id, "source", url) if url else None
+
+
+def get_many(video_ids, variant: str = "maxres"):
+    """Yield ``(index, thumbnail, error)`` in completion order; at most
+    2 * THUMB_WORKERS of this caller's fetches are pending at once."""
+    todo = deque(enumerate(video_ids))
+    pending = {}
+    try:
+        while todo or pending:
+            while todo and len(pending) < 2 * THUMB_WORKERS:
+                idx, video_id = todo.popleft()
+                pending[_pool.submit(get, video_id, variant)] = idx
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                idx = pending.pop(fut)
+                try:
+                    yield idx, fut.result(), None
+                except Exception as e:
+                    yield idx, None, e
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+
+def stats() -> dict:
+    return dict(thumb_cache.stats(), missing_variants=_missing.stats()["size"], shared_fetches=_fetches.shared)
@@ -0,0 +1,114 @@
+"""Per-request stage traces.
+
+Every request gets a request id (the client's ``X-Request-ID`` when it
+looks sane, otherwise a fresh one) and a trace that collects the stages it
+runs through (``metrics.stage``): YouTube object construction, stream
+selection, extraction, yt-dlp download and FFmpeg merge, and finally the
+body transfer. Stages finished before the headers go out are sent back
+as a ``Server-Timing`` header. The full trace is logged as one JSON record
+when the response body is done: at DEBUG normally, at WARNING (and kept
+for ``/_debug/slow``) when the request took longer than
+SLOW_REQUEST_SECONDS.
+
+The current trace lives in a thread-local, so only stages that run on the
+request's own thread are attributed to it, or on a thread that adopted it
+with ``attached`` (hedged extractor backends). Other pool threads (segment
+fetchers, batch workers, jobs) record to metrics only.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+log = logging.getLogger("trace")
+
+# 0 disables the slow-request log
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "10"))
+SLOW_REQUEST_KEEP = int(os.getenv("SLOW_REQUEST_KEEP", "100"))
+
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+_local = threading.local()
+_slow = deque(maxlen=SLOW_REQUEST_KEEP)
+
+
+class Trace:
+    def __init__(self, request_id: str, method: str, path: str):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.spans = []  # (name, start offset, duration), seconds
+
+    def add(self, name: str, started: float, seconds: float):
+        self.spans.append((name, started - self.started, seconds))
+
+    def server_timing(self) -> str:
+        """``Server-Timing`` value for the stages finished so far, plus ``app``
+        (time until the headers were built)."""
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, _, seconds in self.spans]
+        parts.append(f"app;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(parts)
+
+    def record(self, **fields) -> dict:
+        out = {"request_id": self.request_id, "method": self.method, "path": self.path}
+        out.update(fields)
+        out["spans"] = [{"name": name, "start_ms": round(start * 1000, 1), "duration_ms": round(seconds * 1000, 1)}
+                        for name, start, seconds in self.spans]
+        return out
+
+
+def request_id(environ) -> str:
+    incoming = environ.get("HTTP_X_REQUEST_ID", "")
+    return incoming if _REQUEST_ID.match(incoming) else uuid.uuid4().hex[:16]
+
+
+def begin(environ) -> Trace:
+    trace = Trace(request_id(environ), environ.get("REQUEST_METHOD", ""), environ.get("PATH_INFO", ""))
+    environ["deetalk.request_id"] = trace.request_id
+    _local.trace = trace
+    return trace
+
+
+def current():
+    """The trace of the request this thread is serving, or None."""
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def attached(trace):
+    """Attribute this thread's stages to ``trace`` (another thread's request)
+    until the block exits."""
+    previous = getattr(_local, "trace", None)
+    _local.trace = trace
+    try:
+        yield
+    finally:
+        _local.trace = previous
+
+
+def finish(trace: Trace, route: str, status: str, sent: int, headers_done: float):
+    """Close ``trace`` once the body is done and log it."""
+    now = time.perf_counter()
+    trace.add("transfer", headers_done, now - headers_done)
+    if getattr(_local, "trace", None) is trace:
+        _local.trace = None
+    total = now - trace.started
+    slow = SLOW_REQUEST_SECONDS > 0 and total >= SLOW_REQUEST_SECONDS
+    if not slow and not log.isEnabledFor(logging.DEBUG):
+        return
+    record = trace.record(route=route, status=status, bytes=sent, duration_ms=round(total * 1000, 1),
+                          headers_ms=round((headers_done - trace.started) * 1000, 1))
+    if slow:
+        _slow.append(record)
+        log.warning("slow request %s", json.dumps(record))
+    else:
+        log.debug("%s", json.dumps(record))
+
+
+def slow_requests() -> list:
+    return list(_slow)
@@ -0,0 +1,176 @@
+"""Full-text index over every transcript we fetch.
+
+Each fetched transcript's segments go into an SQLite FTS5 table. The text
+is tokenized, and the video id and start/duration in milliseconds are
+stored alongside. "Where do they say X" becomes one index query across the
+whole corpus instead of refetching and scanning transcripts.
+
+Writes are incremental. ``submit`` queues a transcript, and one writer
+thread per process commits queued transcripts in small batches. The
+database runs in WAL mode, so searches never wait on indexing and several
+gunicorn workers can share one file.
+"""
+import os
+import re
+import time
+import queue
+import sqlite3
+import logging
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+# Empty string disables indexing and search
+TRANSCRIPT_INDEX_PATH = os.getenv(
+    "TRANSCRIPT_INDEX_PATH", os.path.join(tempfile.gettempdir(), "deetalk-transcripts.sqlite3"))
+# Transcripts waiting to be indexed beyond this are dropped (and logged)
+INDEX_QUEUE_LIMIT = 10000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT NOT NULL,
+    language_code TEXT NOT NULL,
+    is_generated INTEGER,
+    segments INTEGER NOT NULL,
+    indexed_at REAL NOT NULL,
+    PRIMARY KEY (video_id, language_code)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS segments USING fts5(
+    text,
+    video_id UNINDEXED,
+    language_code UNINDEXED,
+    start_ms UNINDEXED,
+    duration_ms UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+_PHRASE = re.compile(r'"([^"]+)"|(\S+)')
+
+
+class TranscriptIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self.enabled = bool(path)
+        self._local = threading.local()
+        self._queue = queue.Queue(maxsize=INDEX_QUEUE_LIMIT)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._dropped = 0
+        if self.enabled:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                self._conn().executescript(_SCHEMA)
+            except sqlite3.Error:
+                log.exception("transcript index unavailable at %s; search disabled", path)
+                self.enabled = False
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def submit(self, entry: dict):
+        """Queue a transcript (as returned by ``transcripts.get``) for indexing."""
+        if not self.enabled:
+            return
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self._dropped += 1
+            log.warning("transcript index queue full; skipped %s", entry.get("video_id"))
+            return
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="transcript-index", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 64:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.add(batch)
+            except Exception:
+                log.exception("indexing %d transcripts failed", len(batch))
+
+    def add(self, entries):
+        """Index ``entries`` now; transcripts already indexed are skipped."""
+        conn = self._conn()
+        with conn:
+            for entry in entries:
+                lang = entry.get("language_code") or ""
+                snippets = entry.get("snippets") or []
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO videos (video_id, language_code, is_generated, segments, indexed_at)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (entry["video_id"], lang, entry.get("is_generated"), len(snippets), time.time()))
+                if not cur.rowcount:
+                    continue
+                conn.executemany(
+                    "INSERT INTO segments (text, video_id, language_code, start_ms, duration_ms)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    [(s.get("text") or "", entry["video_id"], lang,
+                      int(round(float(s.get("start") or 0) * 1000)),
+                      int(round(float(s.get("duration") or 0) * 1000)))
+                     for s in snippets if s.get("text")])
+
+    @staticmethod
+    def match_expression(query: str) -> str:
+        """User text -> FTS5 query: every word (or "quoted phrase") must
+        appear; FTS operators in the input are treated as plain words."""
+        terms = []
+        for phrase, word in _PHRASE.findall(query or ""):
+            term = (phrase or word).replace('"', " ").strip()
+            if term:
+                terms.append('"' + term + '"')
+        return " ".join(terms)
+
+    def search(self, query: str, limit: int = 50, video_id=None, language=None) -> list:
+        """Matching segments grouped by video, best video first. Each hit
+        has ``start_ms``/``duration_ms`` and a ``snippet`` with the match in
+        [brackets]."""
+        expr = self.match_expression(query)
+        if not expr:
+            return []
+        sql = ("SELECT video_id, language_code, start_ms, duration_ms,"
+               " snippet(segments, 0, '[', ']', '…', 16), bm25(segments)"
+               " FROM segments WHERE segments MATCH ?")
+        args = [expr]
+        if video_id:
+            sql += " AND video_id = ?"
+            args.append(video_id)
+        if language:
+            sql += " AND language_code = ?"
+            args.append(language)
+        sql += " ORDER BY rank LIMIT ?"
+        args.append(limit)
+        videos = {}
+        for vid, lang, start_ms, duration_ms, snippet, score in self._conn().execute(sql, args):
+            video = videos.setdefault((vid, lang), {"video_id": vid, "language_code": lang or None,
+                                                    "score": score, "hits": []})
+            video["hits"].append({"start_ms": start_ms, "duration_ms": duration_ms, "snippet": snippet})
+        for video in videos.values():
+            video["hits"].sort(key=lambda h: h["start_ms"])
+            video["score"] = round(-video["score"], 4)  # bm25 is lower-is-better
+        return list(videos.values())
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        videos, segments = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(segments), 0) FROM videos").fetchone()
+        return {"enabled": True, "videos": videos, "segments": segments,
+                "queued": self._queue.qsize(), "dropped": self._dropped}
+
+
+transcript_index = TranscriptIndex(TRANSCRIPT_INDEX_PATH)
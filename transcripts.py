@@ -0,0 +1,134 @@
+"""Cached, concurrent YouTube transcript fetching.
+
+Transcripts are cached per (video id, language preference) with a TTL and
+an LRU bound. Definitive "no transcript" answers (disabled, none in the
+requested languages, video gone) are cached for a shorter time, so bulk
+runs don't keep asking. Throttling errors are never cached. Concurrent
+misses for the same key share one fetch, and ``fetch_many`` spreads
+misses over a bounded pool that all requests in the worker share.
+Every fetched transcript is also queued for the full-text index.
+"""
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from lazy_imports import lazy_module
+from metadata_cache import TTLCache
+from metrics import stage
+from singleflight import Group
+from transcript_index import transcript_index
+import upstream
+
+TRANSCRIPT_CACHE_TTL = float(os.getenv("TRANSCRIPT_CACHE_TTL", "86400"))
+TRANSCRIPT_CACHE_SIZE = int(os.getenv("TRANSCRIPT_CACHE_SIZE", "2048"))
+# How long "this video has no transcript" is remembered
+TRANSCRIPT_NEGATIVE_TTL = float(os.getenv("TRANSCRIPT_NEGATIVE_TTL", "600"))
+TRANSCRIPT_WORKERS = int(os.getenv("TRANSCRIPT_WORKERS", "8"))
+
+requests = lazy_module("requests")
+yta = lazy_module("youtube_transcript_api")
+
+# Errors that won't change if we ask again soon ("there is no transcript")
+_NO_TRANSCRIPT = ("TranscriptsDisabled", "NoTranscriptFound", "VideoUnavailable", "InvalidVideoId")
+
+
+def no_transcript(error: Exception) -> bool:
+    return isinstance(error, tuple(getattr(yta, name) for name in _NO_TRANSCRIPT if hasattr(yta, name)))
+
+
+_cache = TTLCache(TRANSCRIPT_CACHE_SIZE, TRANSCRIPT_CACHE_TTL)
+_fetches = Group()
+_pool = ThreadPoolExecutor(max_workers=TRANSCRIPT_WORKERS, thread_name_prefix="transcript")
+_local = threading.local()
+
+
+class _Missing:
+    """Negative cache entry: re-raised on every hit until it expires."""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+def _api():
+    # One client (and keep-alive session) per thread
+    api = getattr(_local, "api", None)
+    if api is None:
+        api = _local.api = yta.YouTubeTranscriptApi(http_client=requests.Session())
+    return api
+
+
+def _fetch(video_id: str, languages: tuple) -> dict:
+    if hasattr(yta.YouTubeTranscriptApi, "get_transcript"):  # youtube-transcript-api < 1.0
+        snippets = yta.YouTubeTranscriptApi.get_transcript(video_id, languages=languages)
+        return {"video_id": video_id, "language_code": None, "is_generated": None, "snippets": snippets}
+    fetched = _api().fetch(video_id, languages=languages)
+    return {"video_id": video_id, "language_code": fetched.language_code,
+            "is_generated": fetched.is_generated, "snippets": fetched.to_raw_data()}
+
+
+def _fetch_and_store(key, video_id: str, languages: tuple) -> dict:
+    try:
+        with stage("transcript_fetch"):
+            entry = upstream.call(upstream.YOUTUBE, lambda: _fetch(video_id, languages))
+    except Exception as e:
+        if no_transcript(e):
+            _cache.set(key, _Missing(e), expires_at=time.time() + TRANSCRIPT_NEGATIVE_TTL)
+        raise
+    _cache.set(key, entry)
+    transcript_index.submit(entry)
+    return entry
+
+
+def get(video_id: str, languages=("en",)) -> dict:
+    """Return ``{"video_id", "language_code", "is_generated", "snippets"}``;
+    ``snippets`` are ``{"text", "start", "duration"}`` dicts. Raises the
+    youtube-transcript-api error when there is no transcript."""
+    languages = tuple(languages)
+    key = (video_id, languages)
+    entry = _cache.get(key)
+    if entry is None:
+        entry = _fetches.do(key, lambda: _fetch_and_store(key, video_id, languages))
+    if isinstance(entry, _Missing):
+        raise entry.error
+    return entry
+
+
+def text(entry: dict) -> str:
+    return " ".join(s.get("text", "") for s in entry["snippets"] if s.get("text"))
+
+
+def fetch_many(video_ids, languages=("en",)):
+    """Yield ``(index, entry, error)`` for every id, in completion order.
+    Cache hits come back immediately; misses go through the shared pool
+    with at most 2 * TRANSCRIPT_WORKERS of this caller's fetches pending."""
+    languages = tuple(languages)
+    todo = deque(enumerate(video_ids))
+    pending = {}
+    try:
+        while todo or pending:
+            while todo and len(pending) < 2 * TRANSCRIPT_WORKERS:
+                idx, video_id = todo.popleft()
+                entry = _cache.get((video_id, languages))
+                if isinstance(entry, dict):
+                    yield idx, entry, None
+                    continue
+                pending[_pool.submit(get, video_id, languages)] = idx
+            if not pending:
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                idx = pending.pop(fut)
+                try:
+                    yield idx, fut.result(), None
+                except Exception as e:
+                    yield idx, None, e
+    finally:
+        # Caller went away: don't keep fetching for nobody
+        for fut in pending:
+            fut.cancel()
+
+
+def stats() -> dict:
+    return dict(_cache.stats(), shared_fetches=_fetches.shared)
@@ -0,0 +1,250 @@
+"""Retries and circuit breakers for upstream calls.
+
+``call(host, fn)`` runs one idempotent upstream operation (a GET, a range
+open, a pytubefix resolve, a yt-dlp extraction). It retries transient
+failures (connection errors, timeouts, 408/429/5xx) up to
+UPSTREAM_RETRIES times with full-jitter exponential backoff, and reports
+every outcome to the host's circuit breaker.
+
+After BREAKER_THRESHOLD transient failures in a row, a breaker opens and
+calls to that host fail at once with ``CircuitOpen`` (routes answer
+``503`` with ``Retry-After``) instead of waiting for a timeout. After
+BREAKER_COOLDOWN seconds it lets a single probe through: success closes it,
+failure opens it for another cooldown. Non-transient errors (404, private
+video, parse errors) mean the host answered, so they count as success.
+
+Hosts are keyed by registrable domain (``rr3---sn-x.googlevideo.com`` is
+``googlevideo.com``), and breakers are per worker.
+"""
+import os
+import re
+import time
+import asyncio
+import random
+import logging
+import threading
+from urllib.parse import urlparse
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Extra attempts per call; 0 disables retries (breakers still apply)
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF = float(os.getenv("UPSTREAM_BACKOFF", "0.25"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "4"))
+# Consecutive transient failures that open a host's breaker; 0 disables breakers
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+
+YOUTUBE = "youtube.com"
+
+_TRANSIENT_STATUS = {408, 425, 429, 500, 502, 503, 504}
+_TRANSIENT_ERRORS = {
+    "ConnectionError", "ConnectTimeout", "ReadTimeout", "Timeout", "TimeoutError", "ChunkedEncodingError",
+    "ProtocolError", "IncompleteRead", "RemoteDisconnected", "ConnectionResetError", "ServerDisconnectedError",
+    "ClientConnectionError", "ClientPayloadError",  # aiohttp (async_app)
+}
+# yt-dlp and youtube-transcript-api wrap HTTP errors into their own, keeping the text
+_TRANSIENT_TEXT = re.compile(
+    r"HTTP Error (408|429|5\d\d)|\b(408|429|5\d\d) (Client|Server) Error|timed out|Connection reset"
+    r"|Remote end closed connection|Temporary failure in name resolution", re.I)
+
+
+class CircuitOpen(Exception):
+    def __init__(self, host: str, retry_after: int):
+        super().__init__(f"{host} is unavailable, retry in {retry_after} s")
+        self.host = host
+        self.retry_after = retry_after
+
+
+def transient(exc) -> bool:
+    """Whether ``exc`` is worth retrying (and counts against the host)."""
+    if isinstance(exc, CircuitOpen):
+        return False
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None) or getattr(exc, "code", None) or getattr(exc, "status", None)
+    if isinstance(status, int):
+        return status in _TRANSIENT_STATUS
+    if any(cls.__name__ in _TRANSIENT_ERRORS for cls in type(exc).__mro__):
+        return True
+    return bool(_TRANSIENT_TEXT.search(str(exc)))
+
+
+def check_status(response):
+    """Raise for retryable statuses (so ``call`` retries them); any other
+    response, 404 included, is returned for the caller to handle."""
+    if response.status_code in _TRANSIENT_STATUS:
+        response.close()
+        response.raise_for_status()
+    return response
+
+
+def host_key(url: str) -> str:
+    host = (urlparse(url).hostname or url).lower()
+    labels = host.split(".")
+    if len(labels) <= 2 or labels[-1].isdigit():
+        return host
+    return ".".join(labels[-2:])
+
+
+def _name(host: str) -> str:
+    # call sites pass either a breaker name or the URL they are about to fetch
+    return host_key(host) if "/" in host else host
+
+
+class Breaker:
+    def __init__(self, host: str):
+        self.host = host
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < BREAKER_COOLDOWN or self._probing:
+                return False
+            self._probing = True  # half-open: one call finds out
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def failure(self) -> bool:
+        """Record a transient failure; True when it opened the breaker."""
+        with self._lock:
+            self.failures += 1
+            probe, self._probing = self._probing, False
+            if probe or (self.opened_at is None and BREAKER_THRESHOLD and self.failures >= BREAKER_THRESHOLD):
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                return True
+            return False
+
+    def abandon(self):
+        # The call never finished (e.g. the client left): let another probe go
+        with self._lock:
+            self._probing = False
+
+    def retry_after(self) -> int:
+        if self.opened_at is None:
+            return 0
+        return max(1, int(BREAKER_COOLDOWN - (time.monotonic() - self.opened_at) + 0.999))
+
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < BREAKER_COOLDOWN else "half_open"
+
+    def stats(self) -> dict:
+        return {"state": self.state(), "consecutive_failures": self.failures, "trips": self.trips,
+                "retry_after": self.retry_after()}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(host: str) -> Breaker:
+    b = _breakers.get(host)
+    if b is None:
+        with _breakers_lock:
+            b = _breakers.setdefault(host, Breaker(host))
+    return b
+
+
+def check(host: str):
+    """Raise CircuitOpen if ``host``'s breaker is open. For responses that
+    open upstream lazily, so they fail before their headers go out."""
+    b = breaker(_name(host))
+    if b.state() == "open":
+        metrics.registry.inc("deetalk_upstream_short_circuits_total", {"host": b.host})
+        raise CircuitOpen(b.host, b.retry_after())
+
+
+def backoff(attempt: int) -> float:
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF * 2 ** attempt))
+
+
+def _retry(b: Breaker, host: str, exc, attempt: int, retries: int) -> bool:
+    """Record a failed attempt against ``b``; True when it's worth another."""
+    if not transient(exc):
+        b.success()
+        return False
+    metrics.registry.inc("deetalk_upstream_failures_total", {"host": host})
+    if b.failure():
+        metrics.registry.inc("deetalk_upstream_breaker_trips_total", {"host": host})
+        log.warning("upstream %s: breaker open for %ss after %s: %s", host, BREAKER_COOLDOWN, type(exc).__name__, exc)
+        return False
+    if attempt >= retries:
+        return False
+    metrics.registry.inc("deetalk_upstream_retries_total", {"host": host})
+    log.info("upstream %s: %s, retry %s/%s", host, exc, attempt + 1, retries)
+    return True
+
+
+def _admit(b: Breaker, host: str):
+    if not b.allow():
+        metrics.registry.inc("deetalk_upstream_short_circuits_total", {"host": host})
+        raise CircuitOpen(host, b.retry_after())
+
+
+def call(host: str, fn, retries=None):
+    """Run ``fn()`` against ``host`` (a name or a URL) with retries and the
+    host's breaker. ``fn`` must be safe to repeat."""
+    host = _name(host)
+    retries = UPSTREAM_RETRIES if retries is None else retries
+    b = breaker(host)
+    attempt = 0
+    while True:
+        _admit(b, host)
+        try:
+            result = fn()
+        except Exception as e:
+            if not _retry(b, host, e, attempt, retries):
+                raise
+            attempt += 1
+            time.sleep(backoff(attempt))
+            continue
+        except BaseException:
+            b.abandon()
+            raise
+        b.success()
+        return result
+
+
+async def call_async(host: str, fn, retries=None):
+    """``call`` for coroutines: awaits ``fn()`` and sleeps without blocking
+    the event loop. Same breakers as the threaded callers."""
+    host = _name(host)
+    retries = UPSTREAM_RETRIES if retries is None else retries
+    b = breaker(host)
+    attempt = 0
+    while True:
+        _admit(b, host)
+        try:
+            result = await fn()
+        except Exception as e:
+            if not _retry(b, host, e, attempt, retries):
+                raise
+            attempt += 1
+            await asyncio.sleep(backoff(attempt))
+            continue
+        except BaseException:
+            b.abandon()  # cancelled, e.g. the client went away
+            raise
+        b.success()
+        return result
+
+
+def stats() -> dict:
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {host: b.stats() for host, b in sorted(breakers.items())}
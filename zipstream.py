@@ -0,0 +1,71 @@
+"""Incremental ZIP writer for streaming archives to the client.
+
+zipfile already supports unseekable outputs (it writes data descriptors
+instead of seeking back to patch headers); this wraps it around a small
+buffer that is drained after every write, so an archive of any size is
+produced chunk by chunk with no archive-sized temp file or memory.
+Entries are STORED: media is already compressed.
+"""
+import io
+import time
+import zipfile
+
+READ_SIZE = 256 * 1024
+
+
+class _Sink(io.RawIOBase):
+    def __init__(self):
+        self._buf = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buf += b
+        return len(b)
+
+    def drain(self) -> bytes:
+        out = bytes(self._buf)
+        self._buf.clear()
+        return out
+
+
+class ZipStream:
+    def __init__(self):
+        self._sink = _Sink()
+        self._zip = zipfile.ZipFile(self._sink, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+        self._names = set()
+
+    def _unique(self, name: str) -> str:
+        base, dot, ext = name.rpartition(".")
+        if not base:
+            base, dot, ext = name, "", ""
+        candidate, n = name, 1
+        while candidate in self._names:
+            n += 1
+            candidate = f"{base} ({n}){dot}{ext}"
+        self._names.add(candidate)
+        return candidate
+
+    def add_file(self, name: str, fileobj, size=None):
+        """Yield the archive bytes for ``fileobj`` stored as ``name``."""
+        info = zipfile.ZipInfo(self._unique(name), date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        if size is not None:
+            info.file_size = size  # lets zipfile pick zip64 headers up front for big files
+        with self._zip.open(info, "w", force_zip64=size is None) as dest:
+            while True:
+                data = fileobj.read(READ_SIZE)
+                if not data:
+                    break
+                dest.write(data)
+                yield self._sink.drain()
+        yield self._sink.drain()
+
+    def add_bytes(self, name: str, data: bytes):
+        yield from self.add_file(name, io.BytesIO(data), len(data))
+
+    def close(self):
+        """Yield the central directory; the archive is complete afterwards."""
+        self._zip.close()
+        yield self._sink.drain()